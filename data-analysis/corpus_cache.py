@@ -0,0 +1,280 @@
+"""
+Tokenize comments once, save the tokens, and load them (memory-mapped) every
+time after that, so trying something new with the comments doesn't mean waiting
+for them all to get tokenized again.
+
+Each cached corpus is a directory in `corpus-cache/`, named after a hash of the
+input files' contents and how they were tokenized (the preset), so changing
+either makes a new one:
+- `tokens.bin` - Every comment's token IDs (int32), back to back
+- `offsets.npy` - Where each comment's tokens start in `tokens.bin` (int64, one
+  more than there are comments)
+- `ids.npy` - Each comment's ID (int64, base 36 decoded)
+- `vocab.json` - The token each token ID stands for
+- `meta.json` - The preset, input files, and so on
+
+Presets:
+- `lemmas` - `pipeline.tokenize`, for `main.py` and `ngram_index.py`. Bot
+  comments are left out
+- `words` - Lowercase runs of 2 or more word characters, for `fastbigrams.py`
+- `w2v` - What `clean_process` in word2vec_generator does
+
+    python corpus_cache.py out/run_*/comments.csv --preset w2v
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+from typing import Callable, Iterator, NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+import pipeline
+from pipeline import (
+    CHUNK_SIZE,
+    Postings,
+    chunk_postings_from_ids,
+    map_chunks,
+    merge_postings,
+    read_comments,
+)
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(curr_dir, "corpus-cache")
+
+CACHE_VERSION = 3
+"""Bump this when a preset changes, so old caches don't get used. Also bump
+`TokenizedCorpus.CACHE_VERSION` in word2vec_generator's preprocess.py"""
+
+WORD_RE = re.compile(r"(?u)\b\w\w+\b")
+"""`CountVectorizer`'s default `token_pattern`"""
+W2V_CLEAN_RE = re.compile(r"[^ \nA-Za-z0-9À-ÖØ-öø-ÿ]+")
+"""Same as `CLEAN_RE` in word2vec_generator's preprocess.py"""
+
+
+def _words(body: str) -> list[str]:
+    return WORD_RE.findall(body.lower())
+
+
+def _w2v(body: str) -> list[str]:
+    stop_words = pipeline.stop_words()
+    text = W2V_CLEAN_RE.sub("", body.lower())
+    return [word for word in text.split() if word not in stop_words]
+
+
+class Preset(NamedTuple):
+    tokenize: Callable[[str], list[str]]
+    skip_bots: bool
+    use_nltk: bool
+
+
+PRESETS = {
+    "lemmas": Preset(pipeline.tokenize, skip_bots=True, use_nltk=True),
+    "words": Preset(_words, skip_bots=False, use_nltk=False),
+    "w2v": Preset(_w2v, skip_bots=False, use_nltk=True),
+}
+
+
+class TokenizedCorpus:
+    """A cached corpus. Token lists are only made when you ask for them"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(path, "vocab.json")) as f:
+            self.vocab: list[str] = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+        tokens_path = os.path.join(path, "tokens.bin")
+        # np.memmap doesn't like empty files
+        if os.path.getsize(tokens_path) > 0:
+            self.tokens = np.memmap(tokens_path, dtype=np.int32, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def token_ids(self, i: int) -> np.ndarray:
+        return self.tokens[self.offsets[i] : self.offsets[i + 1]]
+
+    def __getitem__(self, i: int) -> list[str]:
+        return [self.vocab[token] for token in self.token_ids(i).tolist()]
+
+    def __iter__(self) -> Iterator[list[str]]:
+        """Every comment's tokens. Can be gone through more than once (gensim
+        needs that)"""
+        vocab = self.vocab
+        for start in range(0, len(self), CHUNK_SIZE):
+            tokens, lengths, _ = self.chunk(start, start + CHUNK_SIZE)
+            for doc in np.split(tokens, np.cumsum(lengths)[:-1]):
+                yield [vocab[token] for token in doc.tolist()]
+
+    def chunk(
+        self, start: int, end: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Token IDs, number of tokens, and comment IDs of comments `start:end`"""
+        end = min(end, len(self))
+        offsets = self.offsets[start : end + 1]
+        tokens = self.tokens[offsets[0] : offsets[-1]]
+        return tokens, np.diff(offsets), self.ids[start:end]
+
+    def chunks(
+        self, size: int = CHUNK_SIZE
+    ) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        for start in range(0, len(self), size):
+            yield self.chunk(start, start + size)
+
+
+def _file_digest(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(paths: list[str], preset: str) -> str:
+    key = hashlib.blake2b(digest_size=8)
+    key.update(f"{CACHE_VERSION}\n{preset}\n".encode())
+    for path in paths:
+        key.update(f"{_file_digest(path)}\n".encode())
+    return f"{preset}-{key.hexdigest()}"
+
+
+def _tokenize_chunk(
+    chunk: pd.DataFrame, preset: str
+) -> tuple[list[str], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the chunk's vocab, the ID and number of tokens of each comment, and
+    the token IDs (numbered just for this chunk)
+    """
+    tokenize, skip_bots, _ = PRESETS[preset]
+    keep = pipeline.keep_comment if skip_bots else lambda body: isinstance(body, str)
+    vocab: dict[str, int] = {}
+    ids = []
+    lengths = []
+    tokens = []
+    for b36_id, body in zip(chunk["id"], chunk["body"]):
+        if not keep(body):
+            continue
+        doc = tokenize(body)
+        ids.append(int(b36_id, 36))
+        lengths.append(len(doc))
+        tokens.extend(vocab.setdefault(token, len(vocab)) for token in doc)
+    return (
+        list(vocab),
+        np.array(ids, dtype=np.int64),
+        np.array(lengths, dtype=np.int64),
+        np.array(tokens, dtype=np.int32),
+    )
+
+
+def build_corpus(
+    paths: list[str],
+    preset: str,
+    path: str,
+    workers: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+):
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    vocab: dict[str, int] = {}
+    all_ids = []
+    all_lengths = []
+    chunks = (chunk for file in paths for chunk in read_comments(file, chunk_size))
+    results = map_chunks(
+        _tokenize_chunk, chunks, (preset,), workers, PRESETS[preset].use_nltk
+    )
+    with open(os.path.join(tmp_path, "tokens.bin"), "wb") as f:
+        for chunk_vocab, ids, lengths, tokens in results:
+            # Renumber the chunk's tokens to match everything so far
+            mapping = np.fromiter(
+                (vocab.setdefault(token, len(vocab)) for token in chunk_vocab),
+                dtype=np.int32,
+                count=len(chunk_vocab),
+            )
+            f.write(mapping[tokens].tobytes())
+            all_ids.append(ids)
+            all_lengths.append(lengths)
+
+    lengths = np.concatenate(all_lengths) if all_lengths else np.zeros(0, np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.concatenate(all_ids) if all_ids else np.zeros(0, np.int64)
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp_path, "ids.npy"), ids)
+    with open(os.path.join(tmp_path, "vocab.json"), "w") as f:
+        json.dump(list(vocab), f)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        meta = {
+            "version": CACHE_VERSION,
+            "preset": preset,
+            "files": [os.path.abspath(file) for file in paths],
+            "comments": len(ids),
+            "tokens": int(offsets[-1]),
+        }
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_corpus(
+    paths: list[str],
+    preset: str = "lemmas",
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    workers: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> TokenizedCorpus:
+    """
+    Load the tokens of the comments in `paths` from the cache, tokenizing them
+    first if they're not in there yet
+
+    # Arguments
+    * `paths` - comments.csv/comments.parquet files
+    * `preset` - One of `PRESETS`
+    * `workers` - Processes to tokenize with, or all cores if None
+    """
+    path = os.path.join(cache_dir, cache_key(paths, preset))
+    if os.path.exists(os.path.join(path, "meta.json")):
+        print(f"Using cached tokens from {path}")
+    else:
+        print(f"Tokenizing into {path}")
+        build_corpus(paths, preset, path, workers, chunk_size)
+    return TokenizedCorpus(path)
+
+
+def postings_from_corpus(corpus: TokenizedCorpus, n: int = 2) -> Postings:
+    """`pipeline.build_postings`, but from tokens that are already cached"""
+    return merge_postings(
+        chunk_postings_from_ids(tokens, lengths, ids, corpus.vocab, n)
+        for tokens, lengths, ids in corpus.chunks(5 * CHUNK_SIZE)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Tokenize some comments ahead of time"
+    )
+    parser.add_argument(
+        "files", nargs="+", help="comments.csv/comments.parquet files"
+    )
+    parser.add_argument("--preset", choices=list(PRESETS), default="lemmas")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--workers", "-w", type=int)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    corpus = load_corpus(
+        args.files, args.preset, args.cache_dir, args.workers, args.chunk_size
+    )
+    print(f"{len(corpus)} comments, {len(corpus.tokens)} tokens")
+    print(corpus.path)
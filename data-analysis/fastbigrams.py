@@ -1,24 +1,334 @@
-# FAST BIRGAMSSSS ZOOOOOOOOOOOOOOOOOOOOOOOOOOM
-# got to install sklearn
-from sklearn.feature_extraction.text import CountVectorizer
+# FAST BIRGAMSSSS ZOOOOOOOOOOOOOOOOOOOOOOOOOOOM
+"""
+Count bigrams (or any n-grams) over a whole bunch of comments without ever
+holding all of them, or all of their bigrams, in memory.
+
+Comments are read in chunks. Each n-gram is hashed into a count-min sketch: a few
+rows of counters, where each row uses a different hash, and an n-gram's count is
+the smallest of its counters (collisions only ever add, so that's the closest
+one). The sketch is the same size no matter how many comments go into it. On top
+of that, we keep the text of the `top_k` n-grams with the highest counts so far,
+since the sketch itself only knows hashes.
+
+Sketches can be saved and merged, so you can count each run separately (or on
+different machines) and add them up later.
+
+Tokens are the same as what `CountVectorizer` used to give us: lowercase, and
+runs of 2 or more word characters.
+"""
+
+import argparse
+import hashlib
+import itertools
+import numpy as np
+import os
 import pandas as pd
+import pyarrow.parquet as pq
+from typing import Callable, Iterable, Iterator, Optional
+
+from corpus_cache import WORD_RE, load_corpus
+from pipeline import csv_to_multiline
 
 COMMENT_COLS = ["id", "subreddit", "body"]
+"""Columns in the old `sample-all.csv`, which doesn't have a header"""
 FILE = "sample-all.csv"
 
-def run_fast_bigrams(file, save=False):
-    df = pd.read_csv(FILE, sep=",", names=COMMENT_COLS)
-    df = df[df['body'].notna()]
+CHUNK_SIZE = 100_000
+"""Comments to read at a time"""
+
+MAX_CACHED_TOKENS = 1 << 20
+"""Forget all the token hashes we've computed once there are this many"""
+
+_MUL = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix(x: np.ndarray) -> np.ndarray:
+    """SplitMix64's finalizer, so that similar inputs get very different hashes"""
+    x = (x ^ (x >> np.uint64(30))) * _MIX_1
+    x = (x ^ (x >> np.uint64(27))) * _MIX_2
+    return x ^ (x >> np.uint64(31))
+
+
+class NgramSketch:
+    def __init__(
+        self, n: int = 2, width_bits: int = 22, depth: int = 4, top_k: int = 10000
+    ):
+        """
+        # Arguments
+        * `n` - 2 for bigrams, 3 for trigrams, etc.
+        * `width_bits` - Each row has 2 ** `width_bits` counters. More means fewer
+          collisions, so counts are closer to the truth
+        * `depth` - Number of rows
+        * `top_k` - How many of the most common n-grams to remember the text of
+
+        The defaults take 64 MiB, and with a hundred million bigrams, counts are
+        usually off by less than a hundred.
+        """
+        self.n = n
+        self.top_k = top_k
+        self.tables = np.zeros((depth, 1 << width_bits), dtype=np.uint32)
+        self.seeds = _mix(np.arange(1, depth + 1, dtype=np.uint64) * _MUL)
+        self.total = 0
+        """Number of n-grams added"""
+        self._mask = np.uint64((1 << width_bits) - 1)
+        self._candidates: dict[int, str] = {}
+        """Hash -> text of the n-grams that might be in the top k"""
+        self._threshold = 0
+        """Smallest count among the top k candidates, once there are k of them"""
+        self._token_hashes: dict[str, int] = {}
+        self._vocab: Optional[list[str]] = None
+        self._vocab_hashes = np.zeros(0, dtype=np.uint64)
+
+    def _hash_tokens(self, tokens: list[str]) -> np.ndarray:
+        # Python's hash() is different in every process, so use something stable
+        # enough to merge sketches from different runs
+        if len(self._token_hashes) > MAX_CACHED_TOKENS:
+            self._token_hashes = {}
+        hashes = self._token_hashes
+        for token in set(tokens).difference(hashes):
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            hashes[token] = int.from_bytes(digest, "little")
+        return np.fromiter(
+            (hashes[token] for token in tokens), dtype=np.uint64, count=len(tokens)
+        )
+
+    def _indices(self, ngram_hashes: np.ndarray) -> np.ndarray:
+        """Which counter each n-gram goes into in each row (depth x len)"""
+        return (_mix(ngram_hashes[None, :] ^ self.seeds[:, None]) & self._mask).astype(
+            np.intp
+        )
+
+    def estimate(self, ngram_hashes: np.ndarray) -> np.ndarray:
+        indices = self._indices(ngram_hashes)
+        rows = np.arange(len(self.tables))[:, None]
+        return self.tables[rows, indices].min(axis=0)
+
+    def add_texts(self, texts: Iterable[str]):
+        """Tokenize some comments and count their n-grams"""
+        docs = [WORD_RE.findall(text.lower()) for text in texts]
+        lengths = np.fromiter((len(doc) for doc in docs), dtype=np.int64)
+        tokens = list(itertools.chain.from_iterable(docs))
+        if len(tokens) < self.n:
+            return
+        self._add(
+            self._hash_tokens(tokens),
+            lengths,
+            lambda start: " ".join(tokens[start : start + self.n]),
+        )
+
+    def add_token_ids(
+        self, token_ids: np.ndarray, lengths: np.ndarray, vocab: list[str]
+    ):
+        """
+        Count the n-grams in some comments that have already been tokenized, e.g.
+        a chunk from `corpus_cache.TokenizedCorpus.chunks`
+        """
+        if len(token_ids) < self.n:
+            return
+        if self._vocab is not vocab:
+            self._vocab = vocab
+            self._vocab_hashes = self._hash_tokens(vocab)
+        self._add(
+            self._vocab_hashes[token_ids],
+            lengths,
+            lambda start: " ".join(
+                vocab[token] for token in token_ids[start : start + self.n].tolist()
+            ),
+        )
+
+    def _add(
+        self, token_hashes: np.ndarray, lengths: np.ndarray, text: Callable[[int], str]
+    ):
+        """`text(i)` gives the n-gram starting at token i"""
+        n = self.n
+        # Only n-grams that don't cross from one comment into the next
+        doc_ids = np.repeat(np.arange(len(lengths)), lengths)
+        num_starts = len(token_hashes) - n + 1
+        starts = np.flatnonzero(doc_ids[:num_starts] == doc_ids[n - 1 :])
+        if len(starts) == 0:
+            return
+        ngram_hashes = token_hashes[starts]
+        for i in range(1, n):
+            ngram_hashes = _mix(ngram_hashes * _MUL + token_hashes[starts + i])
+
+        unique, first, counts = np.unique(
+            ngram_hashes, return_index=True, return_counts=True
+        )
+        indices = self._indices(unique)
+        for row, row_indices in zip(self.tables, indices):
+            np.add.at(row, row_indices, counts.astype(np.uint32))
+        self.total += len(ngram_hashes)
+
+        # Remember the text of anything that could be in the top k now
+        estimates = self.estimate(unique)
+        for i in np.flatnonzero(estimates >= self._threshold):
+            hash = int(unique[i])
+            if hash not in self._candidates:
+                self._candidates[hash] = text(int(starts[first[i]]))
+        if len(self._candidates) > 2 * self.top_k:
+            self._prune()
+
+    def _prune(self):
+        """Only keep the top k candidates"""
+        hashes = np.fromiter(self._candidates, dtype=np.uint64)
+        estimates = self.estimate(hashes)
+        order = np.argsort(-estimates.astype(np.int64), kind="stable")[: self.top_k]
+        self._candidates = {
+            int(hashes[i]): self._candidates[int(hashes[i])] for i in order
+        }
+        if len(order) >= self.top_k:
+            self._threshold = int(estimates[order[-1]])
+
+    def top(self, k: Optional[int] = None) -> pd.DataFrame:
+        """The k most common n-grams (at most `top_k`), most common first"""
+        self._prune()
+        hashes = np.fromiter(self._candidates, dtype=np.uint64)
+        df = pd.DataFrame(
+            {
+                "Bigram" if self.n == 2 else "Ngram": list(self._candidates.values()),
+                "Count": self.estimate(hashes).astype(np.int64),
+            }
+        )
+        df = df.sort_values(by="Count", ascending=False, kind="stable")
+        return df.head(k) if k is not None else df
+
+    def merge(self, other: "NgramSketch"):
+        """Add another sketch's counts to this one. They have to be the same shape"""
+        assert (
+            self.n == other.n
+            and self.tables.shape == other.tables.shape
+            and np.array_equal(self.seeds, other.seeds)
+        ), "Can only merge sketches made with the same settings"
+        self.tables += other.tables
+        self.total += other.total
+        self._candidates.update(other._candidates)
+        self._threshold = 0
+        self._prune()
+
+    def save(self, path: str):
+        hashes = np.fromiter(self._candidates, dtype=np.uint64)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                n=self.n,
+                top_k=self.top_k,
+                total=self.total,
+                tables=self.tables,
+                seeds=self.seeds,
+                candidate_hashes=hashes,
+                candidate_texts=np.array(list(self._candidates.values()), dtype=str),
+            )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "NgramSketch":
+        with np.load(path) as f:
+            depth, width = f["tables"].shape
+            sketch = NgramSketch(
+                int(f["n"]), width.bit_length() - 1, depth, int(f["top_k"])
+            )
+            sketch.tables[:] = f["tables"]
+            sketch.seeds = f["seeds"]
+            sketch.total = int(f["total"])
+            sketch._candidates = dict(
+                zip(f["candidate_hashes"].tolist(), f["candidate_texts"].tolist())
+            )
+        sketch._prune()
+        return sketch
+
+
+def read_bodies(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.Series]:
+    """
+    Read the body column of some comments in chunks. Works with the collector's
+    `comments.csv` and `comments.parquet`, and with the old header-less
+    `sample-all.csv`. Newlines escaped in CSVs are turned back into newlines
+    """
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(
+            batch_size=chunk_size, columns=["body"]
+        ):
+            yield batch.column("body").to_pandas().dropna()
+        return
+
+    with open(path, newline="") as f:
+        header = f.readline().strip().split(",")
+    names = None if "body" in header else COMMENT_COLS
+    chunks = pd.read_csv(
+        path,
+        names=names,
+        usecols=["body"],
+        dtype={"body": str},
+        chunksize=chunk_size,
+        keep_default_na=False,
+    )
+    for chunk in chunks:
+        yield chunk["body"].map(csv_to_multiline)
+
 
-    ngram_vectorizer = CountVectorizer(ngram_range=(2, 2)) # Count all bigrams
-    count_matrix = ngram_vectorizer.fit_transform(df["body"])
-    bigram_counts = count_matrix.sum(axis=0)
+def run_fast_bigrams(
+    file: str = FILE,
+    save: bool = False,
+    *,
+    n: int = 2,
+    sketch: Optional[NgramSketch] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> pd.DataFrame:
+    """Count the bigrams in a file (into `sketch`, if given) and return the most
+    common ones"""
+    if sketch is None:
+        sketch = NgramSketch(n)
+    for bodies in read_bodies(file, chunk_size):
+        sketch.add_texts(bodies)
+    df_bigram_counts_sorted = sketch.top()
+    if save:
+        df_bigram_counts_sorted.to_csv("out_put_run1.csv", index=False)
+    return df_bigram_counts_sorted
 
-    feature_names = ngram_vectorizer.get_feature_names_out()
-    df_bigram_counts = pd.DataFrame({'Bigram': feature_names, 'Count': bigram_counts.A1})
 
-    df_bigram_counts_sorted = df_bigram_counts.sort_values(by='Count', ascending=False)
-    if save: df_bigram_counts_sorted.to_csv("out_put_run1.csv", index=False)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Count the most common bigrams in some comments"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        default=[FILE],
+        help="comments.csv/comments.parquet files (e.g. out/run_*/comments.csv)"
+        ", or sketches (.npz) saved with --save-sketch to merge",
+    )
+    parser.add_argument("-n", type=int, default=2, help="Size of the n-grams")
+    parser.add_argument("--top", type=int, default=10000, help="How many to output")
+    parser.add_argument(
+        "--width-bits", type=int, default=22, help="Size of the sketch's rows"
+    )
+    parser.add_argument("--out", default="out_put_run1.csv")
+    parser.add_argument("--save-sketch", help="Save the counts here to merge later")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument(
+        "--cache",
+        help="Save the tokens to corpus-cache/, or use them if they're already there",
+        action="store_true",
+    )
+    args = parser.parse_args()
 
-if(__name__ == "__main__"):
-    df_birgams = run_fast_bigrams(FILE, save=True)
\ No newline at end of file
+    sketch = NgramSketch(args.n, args.width_bits, top_k=args.top)
+    sketch_files = [file for file in args.files if file.endswith(".npz")]
+    comment_files = [file for file in args.files if not file.endswith(".npz")]
+    for file in sketch_files:
+        print(f"Merging {file}")
+        sketch.merge(NgramSketch.load(file))
+    if args.cache and comment_files:
+        corpus = load_corpus(comment_files, "words", chunk_size=args.chunk_size)
+        for tokens, lengths, _ in corpus.chunks(args.chunk_size):
+            sketch.add_token_ids(tokens, lengths, corpus.vocab)
+    else:
+        for file in comment_files:
+            print(f"Counting {file}")
+            run_fast_bigrams(file, sketch=sketch, chunk_size=args.chunk_size)
+    print(f"{sketch.total} n-grams")
+    sketch.top().to_csv(args.out, index=False)
+    if args.save_sketch is not None:
+        sketch.save(args.save_sketch)
@@ -1,64 +1,68 @@
-from nltk import ngrams
-import nltk
-import string
-
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
-from nltk.tokenize.casual import casual_tokenize
-
-nltk.download("punkt")
-nltk.download("stopwords")
-nltk.download("wordnet")
-import pandas as pd
+import argparse
 import csv
 
-stop_words = set(stopwords.words("english"))
-
-COMMENT_COLS = ["id", "subreddit", "body"]
-df = pd.read_csv("sample-all.csv", sep=",", names=COMMENT_COLS)
-df = df.reset_index()
-
-wnl = WordNetLemmatizer()
-n_grams_list = {}
-for row in df.iterrows():
-    body = row[1].body
-    if type(body) == str:
-        # TODO better bot detection?
-        if "I am a bot" in body:
-            continue
-
-        if "traumatizing" in body:
-            print(row[1].id, body)
-
-        sent = []
-        for token in casual_tokenize(
-            body, preserve_case=False, reduce_len=True, strip_handles=False
-        ):
-            token = token.strip().lower()
-            if token not in stop_words:
-                if token not in string.punctuation:
-                    if any(c.isalpha() for c in token): # Need at least one letter
-                        sent.append(wnl.lemmatize(token))
+import numpy as np
 
-        n_grams = nltk.ngrams(sent, 2)
+from corpus_cache import load_corpus, postings_from_corpus
+from ngram_index import check_index_path, save_index
+from pipeline import CHUNK_SIZE, build_postings, to_b36
 
-        for n_g in n_grams:
-            if n_g not in n_grams_list:
-                n_grams_list[n_g] = []
-            n_grams_list[n_g].append(row[1].id)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find the comments each bigram is in (most common first)"
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        default=["sample-all.csv"],
+        help="comments.csv/comments.parquet files (e.g. out/run_*/comments.csv)",
+    )
+    parser.add_argument("-n", type=int, default=2, help="Size of the n-grams")
+    parser.add_argument(
+        "--workers", "-w", type=int, help="Processes to use (default: all cores)"
+    )
+    parser.add_argument(
+        "--filter",
+        help='Only output n-grams with a word containing this, e.g. "trauma"',
+    )
+    parser.add_argument("--out", default="./out.csv")
+    parser.add_argument(
+        "--index", help="Also save an index to search with ngram_index.py here"
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument(
+        "--cache",
+        help="Save the tokens to corpus-cache/, or use them if they're already there",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.index is not None:
+        check_index_path(args.index)
 
-# filter = "trauma"
-filter = None
+    if args.cache:
+        corpus = load_corpus(
+            args.files, "lemmas", workers=args.workers, chunk_size=args.chunk_size
+        )
+        postings = postings_from_corpus(corpus, args.n)
+    else:
+        postings = build_postings(args.files, args.n, args.workers, args.chunk_size)
+    print(f"{len(postings.ngrams)} n-grams in {len(np.unique(postings.ids))} comments")
+    if args.index is not None:
+        save_index(postings, args.index, args.n)
 
-with open("./out.csv", "w") as file:
-    csv_out = csv.writer(file)
+    with open(args.out, "w") as file:
+        csv_out = csv.writer(file)
 
-    for n_g in sorted(
-        list(n_grams_list.keys()), key=lambda n_g: -len(n_grams_list[n_g])
-    ):
-        if filter:
-            if all(filter not in w for w in n_g):
-                continue
-        ids = n_grams_list[n_g]
-        csv_out.writerow([";".join(n_g), len(ids), ";".join(list(set(ids)))])
+        for i in np.argsort(-postings.counts, kind="stable"):
+            n_g = postings.ngrams[i]
+            if args.filter:
+                if all(args.filter not in w for w in n_g):
+                    continue
+            ids = postings.comment_ids(i)
+            csv_out.writerow(
+                [
+                    ";".join(n_g),
+                    postings.counts[i],
+                    ";".join(to_b36(id) for id in ids.tolist()),
+                ]
+            )
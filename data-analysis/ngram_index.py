@@ -0,0 +1,291 @@
+"""
+An index of which comments each n-gram is in, saved to disk so you can look
+things up without tokenizing everything again.
+
+An index is a directory of .npy files, which get memory-mapped, so opening one
+is instant and only the postings you look at get read:
+- `ngrams.npy` - Every n-gram (words joined by spaces), UTF-8, back to back, in
+  sorted order so they can be binary searched
+- `ngram_offsets.npy` - Where each n-gram starts in `ngrams.npy`
+- `counts.npy` - How many times each n-gram came up
+- `postings.npy` - The comment IDs each n-gram is in, sorted. Each ID is stored
+  as the difference from the one before it (the first one as is), as a varint
+  (7 bits per byte, and the top bit is set on every byte but the last). Common
+  n-grams are in lots of comments close together, so most IDs only take a byte
+- `posting_offsets.npy` - Where each n-gram's IDs start in `postings.npy`
+
+Words are what `pipeline.tokenize` gives, so they're lowercase and lemmatized,
+and so are the n-grams you look up.
+
+    python ngram_index.py build out/run_*/comments.csv --out index
+    python ngram_index.py query index "mental health" AND "feel like" OR "ptsd"
+    python ngram_index.py query index --filter trauma
+"""
+
+import argparse
+import bisect
+import json
+import os
+import shutil
+from typing import Iterable, Sequence, Union
+
+import numpy as np
+
+from corpus_cache import load_corpus, postings_from_corpus
+from pipeline import CHUNK_SIZE, Postings, build_postings, to_b36
+
+Ngram = Union[str, Sequence[str]]
+"""Either "mental health" or ("mental", "health")"""
+
+META_FILE_NAME = "meta.json"
+
+
+def _key(ngram: Ngram) -> str:
+    return ngram if isinstance(ngram, str) else " ".join(ngram)
+
+
+def varint_encode(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the bytes, and how many bytes each value took"""
+    values = values.astype(np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        sizes += rest > 0
+        rest >>= np.uint64(7)
+
+    starts = np.cumsum(sizes) - sizes
+    data = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for i in range(int(sizes.max(initial=0))):
+        has = sizes > i
+        part = (values[has] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = (sizes[has] > i + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[has] + i] = part | more
+    return data, sizes
+
+
+def varint_decode(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.zeros(len(ends), dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+    value_starts = np.repeat(starts, ends - starts + 1)
+    shifts = (7 * (np.arange(len(data)) - value_starts)).astype(np.uint64)
+    parts = (data & 0x7F).astype(np.uint64) << shifts
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+class _StringTable(Sequence[bytes]):
+    """Strings stored back to back, so `bisect` can search them"""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes()
+
+
+def check_index_path(path: str):
+    """
+    Raise `FileExistsError` if there's something at `path` other than an index,
+    so that saving an index there doesn't delete it
+    """
+    if os.path.exists(path) and not os.path.exists(os.path.join(path, META_FILE_NAME)):
+        raise FileExistsError(f"{path} exists and isn't an index, not replacing it")
+
+
+def save_index(postings: Postings, path: str, n: int):
+    """
+    Write `postings` (from `pipeline.build_postings`) to the directory `path`,
+    replacing the index that's there (see `check_index_path`)
+    """
+    check_index_path(path)
+    keys = [" ".join(ngram).encode() for ngram in postings.ngrams]
+    order = np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int64)
+
+    key_lengths = np.array([len(key) for key in keys], dtype=np.int64)[order]
+    ngram_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(key_lengths, out=ngram_offsets[1:])
+    ngram_data = np.frombuffer(b"".join(keys[i] for i in order), dtype=np.uint8)
+
+    # Put the postings in the same order as the n-grams
+    lengths = np.diff(postings.offsets)[order]
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    gather = np.repeat(postings.offsets[:-1][order] - offsets[:-1], lengths)
+    ids = postings.ids[gather + np.arange(len(gather))]
+
+    # Every n-gram is in at least one comment, so there aren't any empty ones
+    gaps = np.diff(ids, prepend=0)
+    gaps[offsets[:-1]] = ids[offsets[:-1]]
+    posting_data, sizes = varint_encode(gaps)
+    posting_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    posting_offsets[1:] = np.cumsum(sizes)[offsets[1:] - 1]
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "ngrams.npy"), ngram_data)
+    np.save(os.path.join(tmp_path, "ngram_offsets.npy"), ngram_offsets)
+    np.save(os.path.join(tmp_path, "counts.npy"), postings.counts[order])
+    np.save(os.path.join(tmp_path, "postings.npy"), posting_data)
+    np.save(os.path.join(tmp_path, "posting_offsets.npy"), posting_offsets)
+    with open(os.path.join(tmp_path, META_FILE_NAME), "w") as f:
+        json.dump({"n": n}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+class NgramIndex:
+    def __init__(self, path: str):
+        load = lambda name: np.load(os.path.join(path, name), mmap_mode="r")
+        with open(os.path.join(path, META_FILE_NAME)) as f:
+            self.n: int = json.load(f)["n"]
+        self.ngrams = _StringTable(load("ngrams.npy"), load("ngram_offsets.npy"))
+        self.counts = load("counts.npy")
+        self.postings = load("postings.npy")
+        self.posting_offsets = load("posting_offsets.npy")
+
+    def __len__(self) -> int:
+        return len(self.ngrams)
+
+    def ngram(self, i: int) -> str:
+        return self.ngrams[i].decode()
+
+    def find(self, ngram: Ngram) -> int:
+        """Index of an n-gram, or -1 if it's not in any comment"""
+        key = _key(ngram).encode()
+        i = bisect.bisect_left(self.ngrams, key)
+        return i if i < len(self) and self.ngrams[i] == key else -1
+
+    def comment_ids_at(self, i: int) -> np.ndarray:
+        start, end = self.posting_offsets[i], self.posting_offsets[i + 1]
+        return np.cumsum(varint_decode(self.postings[start:end])).astype(np.int64)
+
+    def comment_ids(self, ngram: Ngram) -> np.ndarray:
+        """Sorted IDs (as ints) of the comments an n-gram is in"""
+        i = self.find(ngram)
+        return self.comment_ids_at(i) if i >= 0 else np.zeros(0, dtype=np.int64)
+
+    def count(self, ngram: Ngram) -> int:
+        """How many times an n-gram came up (more than once in a comment counts)"""
+        i = self.find(ngram)
+        return int(self.counts[i]) if i >= 0 else 0
+
+    def all_of(self, ngrams: Iterable[Ngram]) -> np.ndarray:
+        """Comments that have every one of these n-grams"""
+        indices = [self.find(ngram) for ngram in ngrams]
+        if not indices or min(indices) < 0:
+            return np.zeros(0, dtype=np.int64)
+        # Start with the shortest, so there's less to go through each time
+        indices.sort(
+            key=lambda i: self.posting_offsets[i + 1] - self.posting_offsets[i]
+        )
+        ids = self.comment_ids_at(indices[0])
+        for i in indices[1:]:
+            if len(ids) == 0:
+                break
+            ids = np.intersect1d(ids, self.comment_ids_at(i), assume_unique=True)
+        return ids
+
+    def any_of(self, ngrams: Iterable[Ngram]) -> np.ndarray:
+        """Comments that have at least one of these n-grams"""
+        return self.union([self.find(ngram) for ngram in ngrams])
+
+    def union(self, indices: Iterable[int]) -> np.ndarray:
+        parts = [self.comment_ids_at(i) for i in indices if i >= 0]
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+
+    def matching(self, filter: str) -> list[int]:
+        """Indices of the n-grams with a word that contains `filter`"""
+        return [
+            i
+            for i in range(len(self))
+            if any(filter in word for word in self.ngram(i).split(" "))
+        ]
+
+    def query(self, terms: list[str]) -> np.ndarray:
+        """
+        Comments matching something like `["a b", "AND", "c d", "OR", "e f"]`.
+        AND goes before OR, so that's (a b AND c d) OR e f
+        """
+        groups = [[]]
+        for term in terms:
+            if term == "OR":
+                groups.append([])
+            elif term != "AND":
+                groups[-1].append(term)
+        parts = [self.all_of(group) for group in groups if group]
+        return np.unique(np.concatenate(parts)) if parts else np.zeros(0, np.int64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or search an n-gram index")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Index some comments")
+    build_parser.add_argument(
+        "files", nargs="+", help="comments.csv/comments.parquet files"
+    )
+    build_parser.add_argument("--out", "-o", default="index")
+    build_parser.add_argument("-n", type=int, default=2, help="Size of the n-grams")
+    build_parser.add_argument("--workers", "-w", type=int)
+    build_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    build_parser.add_argument(
+        "--cache",
+        help="Save the tokens to corpus-cache/, or use them if they're already there",
+        action="store_true",
+    )
+
+    query_parser = subparsers.add_parser(
+        "query", help="Print the IDs of comments that match"
+    )
+    query_parser.add_argument("index")
+    query_parser.add_argument(
+        "terms",
+        nargs="*",
+        help='N-grams, with AND/OR between them, e.g. "a b" AND "c d"',
+    )
+    query_parser.add_argument(
+        "--filter",
+        help="Instead, list the n-grams with a word containing this, and how many"
+        " comments each is in",
+    )
+    query_parser.add_argument(
+        "--count", action="store_true", help="Only print how many comments match"
+    )
+    args = parser.parse_args()
+
+    if args.command == "build":
+        check_index_path(args.out)
+        if args.cache:
+            corpus = load_corpus(
+                args.files, "lemmas", workers=args.workers, chunk_size=args.chunk_size
+            )
+            postings = postings_from_corpus(corpus, args.n)
+        else:
+            postings = build_postings(
+                args.files, args.n, args.workers, args.chunk_size
+            )
+        save_index(postings, args.out, args.n)
+        print(f"Indexed {len(postings.ngrams)} n-grams to {args.out}")
+    else:
+        index = NgramIndex(args.index)
+        if args.filter is not None:
+            matches = index.matching(args.filter)
+            matches.sort(key=lambda i: -index.counts[i])
+            for i in matches:
+                num_comments = len(index.comment_ids_at(i))
+                print(f"{index.ngram(i)}\t{index.counts[i]}\t{num_comments}")
+        else:
+            ids = index.query(args.terms)
+            if args.count:
+                print(len(ids))
+            else:
+                for id in ids.tolist():
+                    print(to_b36(id))
@@ -0,0 +1,312 @@
+"""
+Tokenize and lemmatize comments on all cores, and find which comments every
+n-gram shows up in.
+
+Comments are read in chunks, and each chunk goes to a worker process. Workers
+lemmatize each distinct token once (the cache lives as long as the worker does,
+so it sees a lot of chunks), and send back n-grams as integer arrays instead of
+lists of strings. These get merged into one `Postings` at the end.
+"""
+
+import collections
+import functools
+import multiprocessing
+import os
+import re
+import string
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+import nltk
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize.casual import casual_tokenize
+
+COMMENT_COLS = ["id", "subreddit", "body"]
+"""Columns in the old `sample-all.csv`, which doesn't have a header"""
+
+CHUNK_SIZE = 20_000
+"""Comments to send to a worker at a time"""
+
+LEMMA_CACHE_SIZE = 1 << 20
+"""Distinct tokens each worker remembers the lemma of"""
+
+B36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+ESCAPED_NEWLINE_RE = re.compile(r"\\(\\?)n")
+"""Same as in data-collection's util.py"""
+
+# Set up in each worker by `_init_worker`
+_stop_words: frozenset[str] = frozenset()
+_wnl: Optional[WordNetLemmatizer] = None
+
+
+def download_nltk_data():
+    for name in ["punkt", "stopwords", "wordnet"]:
+        nltk.download(name, quiet=True)
+
+
+def to_b36(id: int) -> str:
+    digits = []
+    while True:
+        id, digit = divmod(id, 36)
+        digits.append(B36_DIGITS[digit])
+        if id == 0:
+            return "".join(reversed(digits))
+
+
+def csv_to_multiline(s: str) -> str:
+    """
+    Undo the collector's `multiline_to_csv`, which escapes newlines in CSV bodies.
+    Same as `csv_to_multiline` in data-collection's util.py
+    """
+    return ESCAPED_NEWLINE_RE.sub(lambda m: r"\n" if m.group(1) else "\n", s)
+
+
+def read_comments(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """
+    Read the id and body columns of some comments in chunks. Works with the
+    collector's `comments.csv` and `comments.parquet`, and with the old
+    header-less `sample-all.csv`. Newlines escaped in CSVs are turned back into
+    newlines
+    """
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(
+            batch_size=chunk_size, columns=["id", "body"]
+        ):
+            yield batch.to_pandas()
+        return
+
+    with open(path, newline="") as f:
+        header = f.readline().strip().split(",")
+    names = None if "body" in header else COMMENT_COLS
+    chunks = pd.read_csv(
+        path,
+        names=names,
+        usecols=["id", "body"],
+        dtype={"id": str, "body": str},
+        chunksize=chunk_size,
+    )
+    for chunk in chunks:
+        chunk["body"] = chunk["body"].map(csv_to_multiline, na_action="ignore")
+        yield chunk
+
+
+@functools.lru_cache(maxsize=None)
+def stop_words() -> frozenset[str]:
+    """NLTK's English stop words. The NLTK data has to be downloaded first (see
+    `download_nltk_data`)"""
+    return frozenset(stopwords.words("english"))
+
+
+def _init_worker():
+    global _stop_words, _wnl
+    _stop_words = stop_words()
+    _wnl = WordNetLemmatizer()
+
+
+@functools.lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def normalize(token: str) -> Optional[str]:
+    """The lemma of a token, or None if it should be left out"""
+    token = token.strip().lower()
+    if token in _stop_words or token in string.punctuation:
+        return None
+    if not any(c.isalpha() for c in token):  # Need at least one letter
+        return None
+    return _wnl.lemmatize(token)
+
+
+def tokenize(body: str) -> list[str]:
+    """Lemmas of the tokens in a comment that aren't stop words or punctuation"""
+    tokens = casual_tokenize(
+        body, preserve_case=False, reduce_len=True, strip_handles=False
+    )
+    return [lemma for lemma in map(normalize, tokens) if lemma is not None]
+
+
+def keep_comment(body) -> bool:
+    # TODO better bot detection?
+    return isinstance(body, str) and "I am a bot" not in body
+
+
+class ChunkPostings(NamedTuple):
+    """N-grams from one chunk of comments, numbered from 0 just for this chunk"""
+
+    ngrams: list[tuple[str, ...]]
+    counts: np.ndarray
+    """How many times each n-gram came up (int64)"""
+    ngram_indices: np.ndarray
+    """Together with `comment_ids`, each (n-gram, comment) pair once (int32)"""
+    comment_ids: np.ndarray
+    """int64"""
+
+
+def process_chunk(chunk: pd.DataFrame, n: int = 2) -> ChunkPostings:
+    indices: dict[tuple[str, ...], int] = {}
+    counts = []
+    pair_ngrams = []
+    pair_ids = []
+    for b36_id, body in zip(chunk["id"], chunk["body"]):
+        if not keep_comment(body):
+            continue
+        id = int(b36_id, 36)
+        seen = set()
+        for ngram in nltk.ngrams(tokenize(body), n):
+            index = indices.setdefault(ngram, len(indices))
+            if index == len(counts):
+                counts.append(0)
+            counts[index] += 1
+            if index not in seen:
+                seen.add(index)
+                pair_ngrams.append(index)
+                pair_ids.append(id)
+    return ChunkPostings(
+        list(indices),
+        np.array(counts, dtype=np.int64),
+        np.array(pair_ngrams, dtype=np.int32),
+        np.array(pair_ids, dtype=np.int64),
+    )
+
+
+class Postings(NamedTuple):
+    """
+    Every n-gram, how many times it came up, and the comments it's in. Comment
+    IDs are ints (base 36 decoded), sorted, and the ones for n-gram `i` are
+    `ids[offsets[i] : offsets[i + 1]]`
+    """
+
+    ngrams: list[tuple[str, ...]]
+    counts: np.ndarray
+    """int64"""
+    offsets: np.ndarray
+    """int64, one longer than `ngrams`"""
+    ids: np.ndarray
+    """int64"""
+
+    def comment_ids(self, i: int) -> np.ndarray:
+        return self.ids[self.offsets[i] : self.offsets[i + 1]]
+
+
+def merge_postings(chunks: Iterator[ChunkPostings]) -> Postings:
+    indices: dict[tuple[str, ...], int] = {}
+    counts = np.zeros(0, dtype=np.int64)
+    all_ngrams = []
+    all_ids = []
+    for chunk in chunks:
+        # Renumber the chunk's n-grams to match everything so far
+        mapping = np.fromiter(
+            (indices.setdefault(ngram, len(indices)) for ngram in chunk.ngrams),
+            dtype=np.int64,
+            count=len(chunk.ngrams),
+        )
+        if len(indices) > len(counts):
+            grown = np.zeros(max(len(indices), 2 * len(counts)), dtype=np.int64)
+            grown[: len(counts)] = counts
+            counts = grown
+        np.add.at(counts, mapping, chunk.counts)
+        all_ngrams.append(mapping[chunk.ngram_indices])
+        all_ids.append(chunk.comment_ids)
+
+    ngram_indices = np.concatenate(all_ngrams) if all_ngrams else np.zeros(0, np.int64)
+    ids = np.concatenate(all_ids) if all_ids else np.zeros(0, np.int64)
+    order = np.lexsort((ids, ngram_indices))
+    ngram_indices = ngram_indices[order]
+    ids = ids[order]
+    # The same comment can be in more than one file
+    keep = np.ones(len(ids), dtype=bool)
+    keep[1:] = (ngram_indices[1:] != ngram_indices[:-1]) | (ids[1:] != ids[:-1])
+    ngram_indices = ngram_indices[keep]
+    ids = ids[keep]
+
+    offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ngram_indices, minlength=len(indices)), out=offsets[1:])
+    return Postings(list(indices), counts[: len(indices)], offsets, ids)
+
+
+def map_chunks(
+    func: Callable,
+    chunks: Iterable,
+    args: tuple = (),
+    workers: Optional[int] = None,
+    use_nltk: bool = True,
+) -> Iterator:
+    """
+    `func(chunk, *args)` for each chunk, in order, spread over `workers` processes
+    (all cores if None). With 1, everything happens in this process. Only a few
+    chunks are read ahead, so they don't all have to fit in memory.
+
+    With `use_nltk`, the NLTK data is downloaded if need be and `normalize` is
+    ready to use in `func`.
+    """
+    if use_nltk:
+        download_nltk_data()
+        # Load WordNet before forking so the workers don't each load their own
+        _init_worker()
+        _wnl.lemmatize("comments")
+    if workers == 1:
+        for chunk in chunks:
+            yield func(chunk, *args)
+        return
+
+    ctx = multiprocessing.get_context("fork")
+    workers = workers or os.cpu_count()
+    initializer = _init_worker if use_nltk else None
+    with ctx.Pool(workers, initializer=initializer) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(func, (chunk, *args)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def build_postings(
+    paths: list[str],
+    n: int = 2,
+    workers: Optional[int] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> Postings:
+    """
+    # Arguments
+    * `paths` - comments.csv/comments.parquet files
+    * `n` - 2 for bigrams, 3 for trigrams, etc.
+    * `workers` - Number of processes, or all cores if None
+    """
+    chunks = (chunk for path in paths for chunk in read_comments(path, chunk_size))
+    return merge_postings(map_chunks(process_chunk, chunks, (n,), workers))
+
+
+def chunk_postings_from_ids(
+    token_ids: np.ndarray,
+    lengths: np.ndarray,
+    comment_ids: np.ndarray,
+    vocab: list[str],
+    n: int = 2,
+) -> ChunkPostings:
+    """
+    Like `process_chunk`, but for comments that have already been tokenized
+    (e.g. by `corpus_cache.py`), so it's all numpy
+    """
+    doc_indices = np.repeat(np.arange(len(lengths)), lengths)
+    num_starts = len(token_ids) - n + 1
+    if num_starts <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return ChunkPostings([], empty, empty.astype(np.int32), empty)
+    # Only n-grams that don't cross from one comment into the next
+    starts = np.flatnonzero(doc_indices[:num_starts] == doc_indices[n - 1 :])
+    rows = np.stack([token_ids[starts + i] for i in range(n)], axis=1)
+    unique, inverse, counts = np.unique(
+        rows, axis=0, return_inverse=True, return_counts=True
+    )
+    pairs = np.unique(
+        inverse.reshape(-1).astype(np.int64) * len(lengths) + doc_indices[starts]
+    )
+    return ChunkPostings(
+        [tuple(vocab[token] for token in row) for row in unique.tolist()],
+        counts.astype(np.int64),
+        (pairs // len(lengths)).astype(np.int32),
+        np.asarray(comment_ids)[pairs % len(lengths)],
+    )
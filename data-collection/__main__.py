@@ -6,7 +6,11 @@ import sys
 from alive_progress import alive_bar
 
 from config import Config
+from clients import CLIENTS
+from coordinator import Coordinator, load_credentials
 from runner import gems_runner
+from util import EXTRA_FIELDS
+from writers import OUTPUT_FORMATS
 
 
 curr_dir = os.path.dirname(__file__)
@@ -60,6 +64,56 @@ parser.add_argument(
     default=1234,
     type=int,
 )
+parser.add_argument(
+    "--workers",
+    "-w",
+    help="How many requests to Reddit to have in flight at once",
+    default=1,
+    type=int,
+)
+
+parser.add_argument(
+    "--dashboard-rate",
+    help="Most updates to send to the dashboard per second",
+    default=4,
+    type=float,
+)
+parser.add_argument(
+    "--output-format",
+    help="Format to write collected comments in",
+    choices=OUTPUT_FORMATS,
+    default="csv",
+)
+parser.add_argument(
+    "--client",
+    help="How to talk to Reddit (direct skips PRAW and makes plain HTTP requests)",
+    choices=CLIENTS,
+    default="praw",
+)
+parser.add_argument(
+    "--extra-fields",
+    help="Fields to collect on top of the usual ones",
+    nargs="*",
+    choices=list(EXTRA_FIELDS),
+    default=[],
+)
+parser.add_argument(
+    "--sampling",
+    help="How to pick IDs within each time range (adaptive favors parts with more hits)",
+    choices=["uniform", "adaptive"],
+    default="uniform",
+)
+parser.add_argument(
+    "--api-url",
+    help="Send requests here instead of to Reddit (e.g. http://localhost:8080 for"
+    " mock_reddit.py)",
+)
+parser.add_argument(
+    "--shards",
+    help="Use every set of credentials in the env file (REDDIT_ID_2, REDDIT_SECRET_2"
+    ", etc.), each in its own process",
+    action="store_true",
+)
 
 args = parser.parse_args()
 
@@ -70,12 +124,12 @@ if not load_dotenv(args.env_file):
     print(f"You need a env file at {args.env_file}")
     exit(1)
 
-reddit_secret = os.getenv("REDDIT_SECRET")
-client_id = os.getenv("REDDIT_ID")
+credentials = load_credentials()
 
-if reddit_secret is None or client_id is None:
+if len(credentials) == 0:
     print("Bad env")
     exit(1)
+client_id, reddit_secret = credentials[0]
 
 if args.verbose and args.silent:
     print("Both --verbose and --silent were given", file=sys.stderr)
@@ -104,16 +158,41 @@ if args.output_dir is None:
 else:
     output_dir = args.output_dir
 
-runner = gems_runner(
-    config,
-    client_id,
-    reddit_secret,
-    output_dir=output_dir,
-    prev_file=args.prev_file,
-    log_level=log_level,
-    praw_log_level=praw_log_level,
-    port=args.port,
+runner_kwargs = dict(
+    workers=args.workers,
+    output_format=args.output_format,
+    client=args.client,
+    extra_fields=args.extra_fields,
+    sampling=args.sampling,
+    api_url=args.api_url,
 )
+if args.shards and len(credentials) > 1:
+    if args.prev_file is not None:
+        print("--prev-file can't be used with --shards", file=sys.stderr)
+        exit(1)
+    runner = Coordinator(
+        config,
+        credentials,
+        output_dir=output_dir,
+        log_level=log_level,
+        praw_log_level=praw_log_level,
+        port=args.port,
+        dashboard_rate=args.dashboard_rate,
+        **runner_kwargs,
+    )
+else:
+    runner = gems_runner(
+        config,
+        client_id,
+        reddit_secret,
+        output_dir=output_dir,
+        prev_file=args.prev_file,
+        log_level=log_level,
+        praw_log_level=praw_log_level,
+        port=args.port,
+        dashboard_rate=args.dashboard_rate,
+        **runner_kwargs,
+    )
 
 try:
     total_needed = runner.time_ranges.needed
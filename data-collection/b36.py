@@ -0,0 +1,95 @@
+"""
+Converting IDs to and from base 36, which is how Reddit writes them.
+
+We do this for every ID we ever request, store, or load, so there are fast
+versions for single IDs and batch versions that work on whole NumPy arrays.
+"""
+
+import numpy as np
+import operator
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+_PAIRS = [a + b for a in DIGITS for b in DIGITS]
+"""Every two-digit string, so we can do two digits per division"""
+
+_DIGIT_BYTES = np.frombuffer(DIGITS.encode(), dtype=np.uint8)
+
+_DIGIT_VALUES = np.full(256, -1, dtype=np.int64)
+"""Value of each base 36 digit, indexed by its ASCII code (-1 if it's not a digit)"""
+for _i, _c in enumerate(DIGITS):
+    _DIGIT_VALUES[ord(_c)] = _i
+    _DIGIT_VALUES[ord(_c.upper())] = _i
+
+_POWERS = 36 ** np.arange(13, dtype=np.int64)
+"""Powers of 36 that fit in an int64"""
+
+
+def to_b36(id: int) -> str:
+    """Get the base 36 repr of an ID to pass to Reddit or store"""
+    id = operator.index(id)
+    if id < 0:
+        raise ValueError(f"Negative ID {id}")
+    if id < 36:
+        return DIGITS[id]
+    parts = []
+    while id >= 1296:
+        id, rem = divmod(id, 1296)
+        parts.append(_PAIRS[rem])
+    parts.append(_PAIRS[id] if id >= 36 else DIGITS[id])
+    return "".join(reversed(parts))
+
+
+def from_b36(id: str) -> int:
+    """Parse a base 36 ID"""
+    return int(id, 36)
+
+
+def to_b36_array(ids) -> np.ndarray:
+    """
+    Get the base 36 reprs of a whole bunch of IDs at once, as an array of strings.
+    Much faster than calling `to_b36` on each of them.
+    """
+    ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+    if len(ids) == 0:
+        return np.array([], dtype=str)
+    if np.any(ids < 0):
+        raise ValueError(f"Negative IDs: {ids[ids < 0][:10]}")
+    # Number of digits in each ID (0 still needs one digit)
+    lengths = np.searchsorted(_POWERS, ids, side="right")
+    lengths = np.maximum(lengths, 1)
+    width = int(lengths.max())
+    # Write each ID as a row of ASCII bytes, padded with 0s on the right
+    chars = np.zeros((len(ids), width), dtype=np.uint8)
+    for col in range(width):
+        place = lengths - 1 - col
+        in_id = place >= 0
+        digits = (ids // _POWERS[np.maximum(place, 0)]) % 36
+        chars[:, col] = np.where(in_id, _DIGIT_BYTES[digits], 0)
+    return chars.view(f"S{width}").reshape(-1).astype(str)
+
+
+def from_b36_array(ids) -> np.ndarray:
+    """
+    Parse a whole bunch of base 36 IDs at once. Much faster than calling
+    `from_b36` on each of them.
+
+    Works on anything NumPy can turn into an array of ASCII strings
+    """
+    raw = np.asarray(ids, dtype=np.bytes_).reshape(-1)
+    res = np.zeros(raw.size, dtype=np.int64)
+    if raw.size == 0:
+        return res
+    # Each ID becomes a row of bytes, padded with 0s on the right
+    chars = raw.view(np.uint8).reshape(raw.size, raw.dtype.itemsize)
+    digits = _DIGIT_VALUES[chars]
+    lengths = np.count_nonzero(chars, axis=1)
+    # IDs of the same length can all be parsed with one matrix multiplication
+    present = np.flatnonzero(np.bincount(lengths))
+    for length in present:
+        rows = lengths == length if len(present) > 1 else slice(None)
+        group = digits[rows, :length]
+        if length == 0 or length > len(_POWERS) or np.any(group < 0):
+            raise ValueError(f"Invalid base 36 IDs: {raw[rows][:10]}")
+        res[rows] = group @ _POWERS[length - 1 :: -1]
+    return res
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for `bins.py`, without any requests or files involved (see
+`benchmark.py` for the whole collector).
+
+Each benchmark is run on the time ranges from config.yaml, and on ones with 10x
+and 100x as many time ranges (each of config.yaml's split up evenly), since how
+long most of this takes depends on how many bins there are. Hits and misses are
+random, with a fixed seed so that every run does the same thing.
+
+Every run is added to a history file along with the commit it was run on, and
+compared to the last run from a different commit, so if something gets slower,
+you can tell which commit did it.
+"""
+
+import argparse
+import datetime
+import json
+import numpy as np
+import os
+import subprocess
+import time
+from typing import Callable
+
+import bins
+from bins import BinBinBin, TimeRange
+from config import Config
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+HIT_RATE = 0.5
+BATCH_SIZE = 100
+SLOWER_THRESHOLD = 1.2
+"""Point out benchmarks that took this many times as long as last time"""
+
+
+def scaled_time_ranges(
+    config: Config, scale: int, min_comments: int
+) -> list[TimeRange]:
+    """Split each of the config's time ranges into `scale` time ranges"""
+    time_ranges = []
+    for time_range in config.time_ranges:
+        step = (time_range.end_id - time_range.start_id) // scale
+        for i in range(scale):
+            start = time_range.start_id + i * step
+            end = time_range.end_id if i == scale - 1 else start + step
+            time_ranges.append(
+                TimeRange(
+                    time_range.start_date, time_range.end_date, start, end, min_comments
+                )
+            )
+    return time_ranges
+
+
+def per_call(f: Callable[[], float], min_seconds: float) -> float:
+    """
+    Keep calling `f` (which returns how long the part we care about took) until
+    it's taken up `min_seconds`, then return the average in microseconds
+    """
+    total = 0.0
+    calls = 0
+    start = time.perf_counter()
+    while calls == 0 or time.perf_counter() - start < min_seconds:
+        total += f()
+        calls += 1
+    return 1e6 * total / calls
+
+
+def run_benchmarks(
+    config: Config, scale: int, min_comments: int, min_seconds: float
+) -> dict[str, float]:
+    """Returns the time each benchmark took, in microseconds per call"""
+    rng = np.random.default_rng(0)
+    # Nothing ever reaches its minimum, like for most of an actual run
+    time_ranges = scaled_time_ranges(config, scale, 1 << 40)
+    copies = lambda: [time_range.copy() for time_range in time_ranges]
+    results = {}
+
+    def build() -> float:
+        start = time.perf_counter()
+        BinBinBin(copies())
+        return time.perf_counter() - start
+
+    results["build"] = per_call(build, min_seconds)
+
+    time_bins = BinBinBin(copies())
+
+    def next_ids() -> float:
+        start = time.perf_counter()
+        ids = time_bins.next_ids(BATCH_SIZE)
+        elapsed = time.perf_counter() - start
+        time_bins.notify_requested_many(ids, rng.random(len(ids)) < HIT_RATE)
+        return elapsed
+
+    results["next_ids"] = per_call(next_ids, min_seconds)
+
+    def notify_requested() -> float:
+        ids = time_bins.next_ids(BATCH_SIZE)
+        hits = (rng.random(len(ids)) < HIT_RATE).tolist()
+        start = time.perf_counter()
+        for id, hit in zip(ids, hits):
+            time_bins.notify_requested(id, hit)
+        return time.perf_counter() - start
+
+    results["notify_requested (x100)"] = per_call(notify_requested, min_seconds)
+
+    def notify_requested_many() -> float:
+        ids = time_bins.next_ids(BATCH_SIZE)
+        hits = rng.random(len(ids)) < HIT_RATE
+        start = time.perf_counter()
+        time_bins.notify_requested_many(ids, hits)
+        return time.perf_counter() - start
+
+    results["notify_requested_many"] = per_call(notify_requested_many, min_seconds)
+
+    def needed() -> float:
+        start = time.perf_counter()
+        time_bins.needed
+        return time.perf_counter() - start
+
+    results["needed"] = per_call(needed, min_seconds)
+
+    lookup_ids = rng.integers(time_bins.start_id, time_bins.end_id, 1000).tolist()
+
+    def find_bin() -> float:
+        start = time.perf_counter()
+        for id in lookup_ids:
+            time_bins.find_bin(id)
+        return (time.perf_counter() - start) / len(lookup_ids)
+
+    results["find_bin"] = per_call(find_bin, min_seconds)
+
+    sim_time_ranges = scaled_time_ranges(config, scale, min_comments)
+
+    def simulate() -> float:
+        """Request IDs until every minimum is met"""
+        sim_bins = BinBinBin([time_range.copy() for time_range in sim_time_ranges])
+        start = time.perf_counter()
+        while sim_bins.needed > 0:
+            ids = sim_bins.next_ids(BATCH_SIZE)
+            sim_bins.notify_requested_many(ids, rng.random(len(ids)) < HIT_RATE)
+        return time.perf_counter() - start
+
+    results["full run"] = per_call(simulate, min_seconds)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=curr_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_history(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bins.py")
+    parser.add_argument(
+        "--config-file", "-c", default=os.path.join(curr_dir, "config.yaml")
+    )
+    parser.add_argument(
+        "--sizes",
+        help="How many times more time ranges than the config to try",
+        nargs="+",
+        type=int,
+        default=[1, 10, 100],
+    )
+    parser.add_argument(
+        "--min",
+        help="Minimum for each time range in the full run benchmark",
+        type=int,
+        default=20,
+    )
+    parser.add_argument(
+        "--seconds",
+        help="About how long to spend on each benchmark",
+        type=float,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--adaptive", help="Use adaptive sampling", action="store_true"
+    )
+    parser.add_argument(
+        "--history",
+        help="File to add results to and compare with",
+        default=os.path.join(curr_dir, "bench-bins.jsonl"),
+    )
+    args = parser.parse_args()
+
+    TimeRange.adaptive = args.adaptive
+    config = Config.load(args.config_file)
+    commit = git_commit()
+    history = load_history(args.history)
+    # Only compare with runs that did the same amount of work the same way
+    settings = {
+        "adaptive": args.adaptive,
+        "check_counts": bins.CHECK_COUNTS,
+        "min": args.min,
+        "seconds": args.seconds,
+    }
+    prev = next(
+        (
+            entry
+            for entry in reversed(history)
+            if entry["commit"] != commit
+            and all(entry.get(key) == value for key, value in settings.items())
+        ),
+        None,
+    )
+    if prev is not None:
+        print(f"Comparing with {prev['commit']} ({prev['timestamp']})")
+
+    results = {}
+    for size in args.sizes:
+        size_results = run_benchmarks(config, size, args.min, args.seconds)
+        results[str(size)] = size_results
+
+        print(f"\n{size}x ({len(config.time_ranges) * size} time ranges)")
+        prev_results = {} if prev is None else prev["results"].get(str(size), {})
+        for name, micros in size_results.items():
+            line = f"  {name:<24} {micros:>12.1f} us"
+            if name in prev_results:
+                ratio = micros / prev_results[name]
+                line += f"  {ratio:>5.2f}x"
+                if ratio >= SLOWER_THRESHOLD:
+                    line += "  <- slower"
+            print(line)
+
+    with open(args.history, "a") as f:
+        entry = {
+            "commit": commit,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            **settings,
+            "results": results,
+        }
+        f.write(json.dumps(entry) + "\n")
+
+
+if __name__ == "__main__":
+    main()
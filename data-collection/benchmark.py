@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+See how fast the collector goes against `mock_reddit.py`, so slowdowns in
+`bins.py` or `runner.py` show up before a run that takes days.
+
+For each config size, this makes a config with that many times more time ranges
+than config.yaml (by splitting each of its time ranges up), runs a collector on
+it in a fresh process until it's requested `--ids` IDs, and reports:
+- Startup: Seconds to make the `gems_runner` (loading the config and setting up)
+- IDs/s: IDs requested per second after that
+- CPU/batch: CPU time (all threads) per batch of 100 IDs, in milliseconds
+- Peak RSS: Most memory the process used, in MiB
+
+Pass `--json results.json` to save the results, e.g. to compare between commits.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+from b36 import from_b36, to_b36
+from config import Config
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def make_config(base_path: str, scale: int, total_ids: int, out_path: str) -> int:
+    """
+    Write a config with `scale` time ranges for every one in the config at
+    `base_path`. The minimums are big enough that the collector won't finish
+    before requesting `total_ids` IDs. Returns the number of time ranges
+    """
+    with open(base_path) as f:
+        base = yaml.safe_load(f)
+    starts = [from_b36(time_range["start"]) for time_range in base["timeRanges"]]
+    starts.append(from_b36(base["timeRanges"][-1]["end"]))
+
+    time_ranges = []
+    for start, end in zip(starts, starts[1:]):
+        step = (end - start) // scale
+        time_ranges.extend({"start": to_b36(start + i * step)} for i in range(scale))
+    for time_range in time_ranges:
+        time_range["min"] = 2 * total_ids // len(time_ranges) + 1
+    time_ranges[-1]["end"] = to_b36(starts[-1])
+
+    config = {
+        "timeStart": datetime.date(2000, 1, 1),
+        # So that there's room for lots of time ranges without going past year 9999
+        "timeStep": 1,
+        "timeRanges": time_ranges,
+    }
+    with open(out_path, "w") as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+    return len(time_ranges)
+
+
+def _run_case(config_path: str, out_dir: str, api_url: str, args, results):
+    """Run one collector and put its stats in `results`. Runs in its own process"""
+    # Imported here so that it's not counted towards the startup time
+    import util
+    from runner import REQUEST_PER_CALL, gems_runner
+
+    util.out_dir = out_dir
+    start = time.perf_counter()
+    runner = gems_runner(
+        Config.load(config_path),
+        "bench",
+        "bench",
+        output_dir=out_dir,
+        prev_file=None,
+        log_level=logging.WARNING,
+        praw_log_level=logging.WARNING,
+        port=free_port(),
+        workers=args.workers,
+        output_format=args.output_format,
+        client=args.client,
+        sampling=args.sampling,
+        api_url=api_url,
+    )
+    startup = time.perf_counter() - start
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    try:
+        while runner.time_ranges.requested < args.ids and runner.run_step():
+            pass
+        elapsed = time.perf_counter() - start
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+    finally:
+        runner.close()
+
+    num_ids = runner.time_ranges.requested
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (
+        usage_after.ru_stime - usage_before.ru_stime
+    )
+    results.put(
+        {
+            "startup": startup,
+            "ids": num_ids,
+            "ids_per_sec": num_ids / elapsed,
+            "cpu_ms_per_batch": 1000 * cpu / max(num_ids / REQUEST_PER_CALL, 1),
+            # ru_maxrss is in KiB on Linux
+            "peak_rss_mib": usage_after.ru_maxrss / 1024,
+        }
+    )
+
+
+def run_case(config_path: str, api_url: str, args) -> dict:
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    with tempfile.TemporaryDirectory() as out_dir:
+        process = ctx.Process(
+            target=_run_case, args=(config_path, out_dir, api_url, args, results)
+        )
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise Exception(f"Benchmark exited with code {process.exitcode}")
+        return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the collector against a mock Reddit"
+    )
+    parser.add_argument(
+        "--config-file", "-c", default=os.path.join(curr_dir, "config.yaml")
+    )
+    parser.add_argument(
+        "--sizes",
+        help="How many times more time ranges than the config to try",
+        nargs="+",
+        type=int,
+        default=[1, 10, 100],
+    )
+    parser.add_argument(
+        "--ids", help="IDs to request for each size", type=int, default=50000
+    )
+    parser.add_argument("--workers", "-w", type=int, default=8)
+    parser.add_argument("--client", choices=["praw", "direct"], default="direct")
+    parser.add_argument(
+        "--output-format", choices=["csv", "parquet", "both"], default="csv"
+    )
+    parser.add_argument(
+        "--sampling", choices=["uniform", "adaptive"], default="uniform"
+    )
+    parser.add_argument("--hit-rate", type=float, default=0.5)
+    parser.add_argument(
+        "--latency",
+        help="Seconds the mock takes to answer each request",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument("--json", help="Save the results to this file")
+    args = parser.parse_args()
+
+    port = free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(curr_dir, "mock_reddit.py"),
+            "--port",
+            str(port),
+            "--hit-rate",
+            str(args.hit_rate),
+            "--latency",
+            str(args.latency),
+            "--jitter",
+            "0",
+            # We're measuring the collector, not the rate limiter
+            "--quota",
+            str(10**9),
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    results = []
+    try:
+        wait_for_port(port)
+        api_url = f"http://localhost:{port}"
+        print(
+            f"{'size':>6} {'ranges':>7} {'startup':>9} {'IDs/s':>9}"
+            f" {'CPU/batch':>10} {'peak RSS':>9}"
+        )
+        with tempfile.TemporaryDirectory() as config_dir:
+            for size in args.sizes:
+                config_path = os.path.join(config_dir, f"config-{size}.yaml")
+                num_ranges = make_config(args.config_file, size, args.ids, config_path)
+                result = run_case(config_path, api_url, args)
+                result.update(size=size, ranges=num_ranges)
+                results.append(result)
+                print(
+                    f"{size:>5}x {num_ranges:>7} {result['startup']:>8.3f}s"
+                    f" {result['ids_per_sec']:>9.0f}"
+                    f" {result['cpu_ms_per_batch']:>8.2f}ms"
+                    f" {result['peak_rss_mib']:>6.0f}MiB",
+                    flush=True,
+                )
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"args": vars(args), "time": time.time(), "results": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,39 @@
 from abc import ABC, abstractmethod
-from collections import defaultdict, deque
+import bisect
 import datetime
 import functools
+import heapq
 import itertools
 import numpy as np
+import numpy.typing as npt
 from typing import Generic, Optional, TypeVar
 
-import util
+from b36 import to_b36
+from sampler import IdPermutation
 
 SIZE_OF_ITERATION = 1000000
 
+ADAPTIVE_CHUNK = 10
+"""In adaptive mode, how many IDs to give to a `PermBin` each time it's picked"""
+PRIOR_STRENGTH = 10
+"""In adaptive mode, how many requests the prior for a `PermBin`'s hit rate is
+worth. The prior is centered on the hit rate of the whole `TimeRange`"""
+
+CHECK_COUNTS = False
+"""
+If true, make sure the cached totals in `BinBin`s match up with their children
+after every update. This is really slow, so only use it for debugging/testing.
+"""
+
 
 class AbstractBin(ABC):
     """A range of IDs"""
 
+    _parent: Optional["BinBin"] = None
+    """The bin containing this one, which needs to know when our counts change"""
+    _parent_index = 0
+    """Where this bin is in its parent's list of bins"""
+
     @property
     @abstractmethod
     def start_id(self) -> int:
@@ -45,10 +65,18 @@ class AbstractBin(ABC):
         """
         How many IDs in this range have not been requested yet.
 
+        IDs that have been handed out by `next_ids` but haven't been reported back
+        through `notify_requested` yet don't count as unrequested.
+
         Note: This has nothing to do with the minimum number of IDs that must be
         requested in a time range.
         """
 
+    @property
+    @abstractmethod
+    def in_flight(self) -> int:
+        """How many IDs have been handed out by `next_ids` but not reported back yet"""
+
     @property
     def needed(self) -> int:
         """How many comments we still need from this range"""
@@ -62,12 +90,58 @@ class AbstractBin(ABC):
         If `hit` is true, we were able to read the comment
         """
 
+    @abstractmethod
+    def notify_requested_many(
+        self, ids: npt.ArrayLike, hits: npt.ArrayLike | bool
+    ):
+        """
+        Like `notify_requested`, but for a whole bunch of IDs at once. Much faster
+        than calling `notify_requested` for each of them.
+
+        `hits` can either be an array the same length as `ids` or a single bool
+        for all of them
+        """
+
+    @abstractmethod
+    def notify_skipped_many(self, ids: npt.ArrayLike):
+        """
+        Record that some IDs we got from `next_ids` won't be requested after all
+        (because another run already requested them, or their request kept
+        failing). They're no longer in flight, but they don't count as hits or
+        misses, and they won't be handed out again.
+        """
+
+    @abstractmethod
+    def notify_retrying_many(self, ids: npt.ArrayLike):
+        """
+        Record that some IDs that were skipped because their requests kept failing
+        (maybe in a previous run) are going to be requested after all. They're in
+        flight again.
+        """
+
+    @abstractmethod
+    def set_shard(self, index: int, count: int):
+        """
+        Only hand out this shard's share of the IDs from now on, when `count`
+        collectors are running at once and this is the `index`th one. The shards
+        take turns going through each `PermBin`'s permutation, so they never
+        request the same IDs, and time ranges split their minimums between them.
+
+        Call this after loading previous runs, before requesting anything.
+        """
+
+    @abstractmethod
+    def leaves(self) -> list["PermBin"]:
+        """All the `PermBin`s in this range, in order"""
+
     @abstractmethod
     def next_ids(self, n: int) -> list[int]:
         """
         Generate the next n IDs in this range.
 
-        For `BinBin`s, this modifies state (though not for `PermBin`s)
+        This modifies state: the IDs returned are considered in flight until
+        `notify_requested` is called for them, so they won't be handed out again.
+        This lets us call `next_ids` again before the last batch has come back.
         """
 
     def __contains__(self, id: int) -> bool:
@@ -91,6 +165,16 @@ class PermBin(AbstractBin):
         self._end_id = end
         self._hits = 0
         self._misses = 0
+        self._in_flight = 0
+        """How many IDs we've handed out that haven't been reported back yet"""
+        self._skipped = 0
+        """How many IDs we've handed out that were skipped (see `notify_skipped_many`)"""
+        self._perm: Optional[IdPermutation] = None
+        """Order in which to request IDs, only made once we actually need it"""
+        self._shard_index = 0
+        self._shard_count = 1
+        self._shard_base = 0
+        """Position in the permutation when `set_shard` was called"""
 
     @property
     def hits(self) -> int:
@@ -100,23 +184,109 @@ class PermBin(AbstractBin):
     def misses(self) -> int:
         return self._misses
 
+    @property
+    def skipped(self) -> int:
+        return self._skipped
+
     @property
     def unrequested(self) -> int:
-        total_available = self.end_id - self.start_id
-        return total_available - self.requested
+        return self._shard_size - self._shard_position
+
+    @property
+    def _shard_size(self) -> int:
+        """How many positions in the permutation belong to this shard (all of them
+        if there's only one shard)"""
+        left = self.end_id - self.start_id - self._shard_base - self._shard_index
+        return max(0, -(-left // self._shard_count))
+
+    @property
+    def _shard_position(self) -> int:
+        """How many of this shard's positions have been handed out"""
+        return self.requested + self._skipped + self._in_flight - self._shard_base
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
 
     def next_ids(self, n: int) -> list[int]:
-        perm = np.random.default_rng(seed=[self.start_id, self.end_id]).permutation(
-            np.arange(start=self.start_id, stop=self.end_id, dtype=np.uint64)
+        # The order only depends on the start and end IDs, so previous runs' hits
+        # and misses are enough to pick up where they left off
+        if self._perm is None:
+            self._perm = IdPermutation(self.start_id, self.end_id)
+        offset = (
+            self._shard_base
+            + self._shard_index
+            + self._shard_position * self._shard_count
         )
-        return list(map(int, perm[self.requested : self.requested + n]))
+        ids = self._perm.take(offset, min(n, self.unrequested), self._shard_count)
+        ids = ids.tolist()
+        self._in_flight += len(ids)
+        if self._parent is not None:
+            self._parent._update_counts(self, 0, 0, len(ids), 0)
+        return ids
 
     def notify_requested(self, id: int, hit: bool):
-        assert id in self, f"{util.to_b36(id)} not in {self}"
+        assert id in self, f"{to_b36(id)} not in {self}"
         if hit:
-            self._hits += 1
+            self.add_requested(1, 0)
         else:
-            self._misses += 1
+            self.add_requested(0, 1)
+
+    def notify_requested_many(
+        self, ids: npt.ArrayLike, hits: npt.ArrayLike | bool
+    ):
+        ids = np.asarray(ids, dtype=np.int64)
+        hits = np.broadcast_to(np.asarray(hits, dtype=bool), ids.shape)
+        assert np.all((self.start_id <= ids) & (ids < self.end_id)), f"IDs not in {self}"
+        num_hits = int(np.count_nonzero(hits))
+        self.add_requested(num_hits, len(ids) - num_hits)
+
+    def notify_skipped_many(self, ids: npt.ArrayLike):
+        ids = np.asarray(ids, dtype=np.int64)
+        assert np.all((self.start_id <= ids) & (ids < self.end_id)), f"IDs not in {self}"
+        self.add_skipped(len(ids))
+
+    def notify_retrying_many(self, ids: npt.ArrayLike):
+        ids = np.asarray(ids, dtype=np.int64)
+        assert np.all((self.start_id <= ids) & (ids < self.end_id)), f"IDs not in {self}"
+        self.add_retrying(len(ids))
+
+    def set_shard(self, index: int, count: int):
+        assert self._in_flight == 0, f"Can't shard {self} with IDs in flight"
+        self._shard_index = index
+        self._shard_count = count
+        self._shard_base = self.requested + self._skipped
+
+    def add_skipped(self, skipped: int):
+        """Record that some IDs in this bin were skipped, without saying which"""
+        # If there aren't enough in flight, the rest are from a previous run. That
+        # can even be negative, if the run retried IDs an earlier run skipped
+        landed = max(0, min(self._in_flight, skipped))
+        self._in_flight -= landed
+        self._skipped += skipped
+        if self._parent is not None:
+            self._parent._update_counts(self, 0, 0, -landed, 0, -skipped)
+
+    def add_retrying(self, retrying: int):
+        """Record that some skipped IDs in this bin are in flight again, without
+        saying which"""
+        self._skipped -= retrying
+        self._in_flight += retrying
+        if self._parent is not None:
+            self._parent._update_counts(self, 0, 0, retrying, 0, retrying)
+
+    def add_requested(self, hits: int, misses: int):
+        """Record that we requested some IDs in this bin, without saying which"""
+        # If there aren't enough in flight, the rest are from a previous run
+        landed = min(self._in_flight, hits + misses)
+        self._in_flight -= landed
+        self._hits += hits
+        self._misses += misses
+        if self._parent is not None:
+            self._parent._update_counts(self, hits, misses, -landed, 0)
+
+    def leaves(self) -> list["PermBin"]:
+        return [self]
 
     @property
     def start_id(self):
@@ -135,31 +305,110 @@ class BinBin(Generic[T], AbstractBin):
 
     def __init__(self, bins: list[T]):
         self.bins = bins
-        self._remaining = deque(self.bins)
-        self._update_remaining()
+        self._starts = [bin.start_id for bin in bins]
+        """Start of each bin, for binary searching (the bins must be sorted)"""
+
+        # Totals over all the bins, kept up to date by `_update_counts` so that we
+        # don't have to go through every bin whenever we want to know them
+        for i, bin in enumerate(bins):
+            bin._parent = self
+            bin._parent_index = i
+
+        # Priority queue for `next_ids`. Instead of updating a bin's entry when its
+        # counts change, we just mark it as changed, and the next call to `next_ids`
+        # pushes a new entry for it. Old entries are skipped when they're popped
+        self._heap: list[tuple[float, int, int]] = []
+        """(-priority, bin index, version) for the bins we can request from"""
+        self._versions = [0] * len(bins)
+        """The version of each bin's newest entry in `_heap`"""
+
+        self._recount()
+
+    def _recount(self):
+        """Add up all the cached totals from scratch"""
+        self._hits, self._misses, self._in_flight, self._total = self._sum_counts()
+        self._needed = sum(bin.needed for bin in self.bins)
+        self._num_needy = sum(bin.needed > 0 for bin in self.bins)
+        """How many of the bins have a minimum they haven't met yet"""
+        self._changed = set(range(len(self.bins)))
+        """Bins whose counts changed since their newest entry was pushed"""
+        self._heap_needy: Optional[bool] = None
+        """Whether the priorities in `_heap` are for needy bins (see `_priority`)"""
 
     @property
     def hits(self) -> int:
-        return sum(bin.hits for bin in self.bins)
+        return self._hits
 
     @property
     def misses(self) -> int:
-        return sum(bin.misses for bin in self.bins)
+        return self._misses
 
     @property
     def unrequested(self) -> int:
-        return sum(bin.unrequested for bin in self.bins)
+        return self._total - self._hits - self._misses - self._in_flight
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
 
     @property
     def needed(self) -> int:
-        return sum(bin.needed for bin in self.bins)
+        return self._needed
+
+    def _update_counts(
+        self,
+        bin: AbstractBin,
+        hits: int,
+        misses: int,
+        in_flight: int,
+        needed: int,
+        total: int = 0,
+    ):
+        """Called by one of our bins when its counts change by the given amounts
+        (`total` only changes when IDs are skipped)"""
+        old_needed = self.needed
+        self._hits += hits
+        self._misses += misses
+        self._in_flight += in_flight
+        self._needed += needed
+        self._total += total
+        bin_needed = bin.needed
+        if (bin_needed > 0) != (bin_needed - needed > 0):
+            self._num_needy += 1 if bin_needed > 0 else -1
+        self._changed.add(bin._parent_index)
+        if self._parent is not None:
+            self._parent._update_counts(
+                self, hits, misses, in_flight, self.needed - old_needed, total
+            )
+        elif CHECK_COUNTS:
+            self.check_counts()
+
+    def _sum_counts(self) -> tuple[int, int, int, int]:
+        """Add up the hits, misses, in flight IDs, and total IDs of all the bins"""
+        hits = sum(bin.hits for bin in self.bins)
+        misses = sum(bin.misses for bin in self.bins)
+        in_flight = sum(bin.in_flight for bin in self.bins)
+        total = sum(bin.requested + bin.in_flight + bin.unrequested for bin in self.bins)
+        return hits, misses, in_flight, total
+
+    def check_counts(self):
+        """Make sure the cached totals in this bin and all bins under it are right"""
+        for bin in self.bins:
+            if isinstance(bin, BinBin):
+                bin.check_counts()
+        cached = (self._hits, self._misses, self._in_flight, self._total)
+        assert cached == self._sum_counts(), f"{cached} != {self._sum_counts()} in {self}"
+        needed = sum(bin.needed for bin in self.bins)
+        assert self._needed == needed, f"{self._needed} != {needed} in {self}"
+        num_needy = sum(bin.needed > 0 for bin in self.bins)
+        assert self._num_needy == num_needy, f"{self._num_needy} != {num_needy} in {self}"
 
     def find_bin(self, id: int) -> Optional[T]:
         """Find the bin that the given ID goes into (None if it doesn't go into any of the bins)"""
         if id in self:
-            for bin in self.bins:
-                if id in bin:
-                    return bin
+            bin = self.bins[bisect.bisect_right(self._starts, id) - 1]
+            if id in bin:
+                return bin
             raise AssertionError(
                 f"ID {id} should have fit into one of the bins in {self}"
             )
@@ -168,78 +417,184 @@ class BinBin(Generic[T], AbstractBin):
 
     def notify_requested(self, id: int, hit: bool):
         bin = self.find_bin(id)
-        assert bin is not None, f"{util.to_b36(id)} not in {self}"
+        assert bin is not None, f"{to_b36(id)} not in {self}"
         bin.notify_requested(id, hit)
 
+    def notify_requested_many(
+        self, ids: npt.ArrayLike, hits: npt.ArrayLike | bool
+    ):
+        ids = np.asarray(ids, dtype=np.int64)
+        hits = np.broadcast_to(np.asarray(hits, dtype=bool), ids.shape)
+        leaves, leaf_starts, leaf_ends = self._leaf_index
+        inds = np.searchsorted(leaf_starts, ids, side="right") - 1
+        bad = (inds < 0) | (ids >= leaf_ends[np.maximum(inds, 0)])
+        if np.any(bad):
+            raise AssertionError(
+                f"{to_b36(int(ids[bad][0]))} not in any of the bins in {self}"
+            )
+        hit_counts = np.bincount(inds[hits], minlength=len(leaves))
+        miss_counts = np.bincount(inds[~hits], minlength=len(leaves))
+        for i in np.flatnonzero(hit_counts + miss_counts):
+            leaves[i].add_requested(int(hit_counts[i]), int(miss_counts[i]))
+
+    def notify_skipped_many(self, ids: npt.ArrayLike):
+        leaves, _, _ = self._leaf_index
+        counts = self.leaf_id_counts(ids)
+        for i in np.flatnonzero(counts):
+            leaves[i].add_skipped(int(counts[i]))
+
+    def notify_retrying_many(self, ids: npt.ArrayLike):
+        leaves, _, _ = self._leaf_index
+        counts = self.leaf_id_counts(ids)
+        for i in np.flatnonzero(counts):
+            leaves[i].add_retrying(int(counts[i]))
+
+    def set_shard(self, index: int, count: int):
+        for bin in self.bins:
+            bin.set_shard(index, count)
+        self._recount()
+
+    def leaves(self) -> list[PermBin]:
+        return list(itertools.chain.from_iterable(bin.leaves() for bin in self.bins))
+
+    def leaf_bounds(self) -> tuple[np.ndarray, np.ndarray]:
+        """Start and end IDs of every `PermBin` under this bin, in order"""
+        _, starts, ends = self._leaf_index
+        return starts, ends
+
+    def leaf_counts(self) -> tuple[np.ndarray, np.ndarray]:
+        """Hits and misses of every `PermBin` under this bin, in order"""
+        leaves, _, _ = self._leaf_index
+        hits = np.array([leaf.hits for leaf in leaves], dtype=np.int64)
+        misses = np.array([leaf.misses for leaf in leaves], dtype=np.int64)
+        return hits, misses
+
+    def leaf_id_counts(self, ids: npt.ArrayLike) -> np.ndarray:
+        """How many of the given IDs are in every `PermBin` under this bin, in
+        order"""
+        ids = np.asarray(ids, dtype=np.int64)
+        leaves, leaf_starts, leaf_ends = self._leaf_index
+        inds = np.searchsorted(leaf_starts, ids, side="right") - 1
+        if np.any((inds < 0) | (ids >= leaf_ends[np.maximum(inds, 0)])):
+            raise AssertionError(f"Some of the IDs aren't in {self}")
+        return np.bincount(inds, minlength=len(leaves))
+
+    def leaf_skipped(self) -> np.ndarray:
+        """How many IDs were skipped in every `PermBin` under this bin (see
+        `notify_skipped_many`), in order"""
+        leaves, _, _ = self._leaf_index
+        return np.array([leaf.skipped for leaf in leaves], dtype=np.int64)
+
+    def add_leaf_counts(
+        self,
+        hits: np.ndarray,
+        misses: np.ndarray,
+        skipped: Optional[np.ndarray] = None,
+    ):
+        """Add to the hits, misses, and skipped IDs of every `PermBin` under this
+        bin (in the same order as `leaf_counts`)"""
+        leaves, _, _ = self._leaf_index
+        assert len(hits) == len(leaves) and len(misses) == len(leaves)
+        for i in np.flatnonzero(hits + misses):
+            leaves[i].add_requested(int(hits[i]), int(misses[i]))
+        if skipped is not None:
+            assert len(skipped) == len(leaves)
+            for i in np.flatnonzero(skipped):
+                leaves[i].add_skipped(int(skipped[i]))
+
+    @functools.cached_property
+    def _leaf_index(self) -> tuple[list[PermBin], np.ndarray, np.ndarray]:
+        """All the `PermBin`s under this bin, along with arrays of their starts and
+        ends, for looking up lots of IDs at once"""
+        leaves = self.leaves()
+        starts = np.array([leaf.start_id for leaf in leaves], dtype=np.int64)
+        ends = np.array([leaf.end_id for leaf in leaves], dtype=np.int64)
+        return leaves, starts, ends
+
     def next_ids(self, n: int) -> list[int]:
         """
         Get the next n IDs.
 
-        Every time this is called, it will rotate through the remaining bins
-        """
-        self._update_remaining()
-        any_needy = self._any_needy()
+        If any of the bins have a minimum they haven't met yet, only those bins are
+        used, and each ID goes to whichever one is furthest from its minimum (see
+        `_priority`). Otherwise, each ID goes to whichever bin has the most IDs
+        left, which spreads them out evenly.
 
-        # TODO actually prioritize bins that haven't gotten the minimum number of comments yet
-
-        # Number of IDs to request from each remaining bin
-        num_ids: dict[T, int] = defaultdict(lambda: 0)
-
-        def needed(bin: T):
-            if any_needy:
-                return min(bin.needed, bin.unrequested)
+        This takes O((n + number of bins that changed) * log(number of bins)), so it
+        stays cheap even with lots of bins.
+        """
+        any_needy = self._num_needy > 0
+        if any_needy != self._heap_needy:
+            # The priorities mean something else now, start over
+            self._heap = []
+            self._changed = set(range(len(self.bins)))
+            self._heap_needy = any_needy
+        elif len(self._heap) > 2 * len(self.bins) + n:
+            # Too many old entries, get rid of them
+            self._heap = [
+                entry for entry in self._heap if entry[2] == self._versions[entry[1]]
+            ]
+            heapq.heapify(self._heap)
+
+        for i in self._changed:
+            self._versions[i] += 1
+            bin = self.bins[i]
+            if bin.unrequested > 0 and (bin.needed > 0 or not any_needy):
+                heapq.heappush(
+                    self._heap, (-self._priority(bin, any_needy), i, self._versions[i])
+                )
+        self._changed = set()
+
+        # Number of IDs to request from each bin
+        num_ids: dict[int, int] = {}
+        while n > 0 and len(self._heap) > 0:
+            neg_priority, i, version = self._heap[0]
+            if version != self._versions[i]:
+                heapq.heappop(self._heap)
+                continue
+            count = num_ids.get(i, 0) + 1
+            num_ids[i] = count
+            n -= 1
+            # Each ID we give the bin is one less request it needs (or one less
+            # unrequested ID it has)
+            if count < self.bins[i].unrequested:
+                heapq.heapreplace(self._heap, (neg_priority + 1, i, version))
             else:
-                # If none of the bins have a minimum to meet, just look at how many IDs
-                # inside them haven't been requested yet
-                return bin.unrequested
-
-        while n > 0:
-            start_n = n
-            for bin in self._remaining:
-                if needed(bin) > num_ids[bin]:
-                    num_ids[bin] += 1
-                    n -= 1
-                    if n == 0:
-                        break
-            if start_n == n:
-                # None of the bins had anything added to them
-                break
-            self._remaining.rotate(-(n - start_n))
-
-        # If we can still request more, go up to bin.unrequested
-        while n > 0:
-            start_n = n
-            for bin in self._remaining:
-                if bin.unrequested > num_ids[bin]:
-                    num_ids[bin] += 1
-                    n -= 1
-                    if n == 0:
-                        break
-            if start_n == n:
-                # None of the bins had anything added to them
-                break
-            self._remaining.rotate(-(n - start_n))
+                heapq.heappop(self._heap)
 
+        # Requesting these marks the bins as changed, so they'll get new entries
         return list(
-            itertools.chain.from_iterable(bin.next_ids(n) for bin, n in num_ids.items())
+            itertools.chain.from_iterable(
+                self.bins[i].next_ids(count) for i, count in sorted(num_ids.items())
+            )
         )
 
-    def _update_remaining(self):
-        self._remaining = deque(bin for bin in self._remaining if bin.unrequested > 0)
-        if self._any_needy():
-            # If any of the bins still need more, keep those
-            self._remaining = deque(bin for bin in self._remaining if bin.needed > 0)
-        # But if none of the bins have a minimum to meet, don't filter them all out
+    @staticmethod
+    def _priority(bin: AbstractBin, any_needy: bool) -> float:
+        """
+        If there are needy bins, this is roughly how many more requests it'll take
+        the given bin to meet its minimum: what it still needs over its hit rate,
+        minus what's already in flight. That way, the bins that are furthest
+        behind go first, and bins that are about to meet their minimums don't get
+        more IDs than they need.
 
-    def _any_needy(self) -> bool:
-        """Do any of the bins have a minimum quota they haven't filled yet?"""
-        return any(bin.needed > 0 for bin in self._remaining)
+        If there are no needy bins, it's just the number of unrequested IDs.
+        """
+        if not any_needy:
+            return bin.unrequested
+        # Add one hit and one miss so bins we haven't requested from still work
+        hit_rate = (bin.hits + 1) / (bin.requested + 2)
+        return bin.needed / hit_rate - bin.in_flight
 
 
 @functools.total_ordering
 class TimeRange(BinBin[PermBin]):
     """For keeping track of work done in a time range"""
 
+    adaptive = False
+    """If true, `next_ids` sends more requests to the `PermBin`s with higher hit
+    rates instead of spreading them out evenly (see `_adaptive_next_ids`)"""
+
     def __init__(
         self,
         start_date: datetime.date,
@@ -276,6 +631,73 @@ class TimeRange(BinBin[PermBin]):
     def needed(self) -> int:
         return max(0, self.min - self.hits)
 
+    def set_shard(self, index: int, count: int):
+        # Split up what's still needed as evenly as possible
+        needed = self.needed
+        self.min = self.hits + needed // count + (1 if index < needed % count else 0)
+        super().set_shard(index, count)
+
+    def next_ids(self, n: int) -> list[int]:
+        if self.adaptive:
+            return self._adaptive_next_ids(n)
+        return super().next_ids(n)
+
+    def _adaptive_next_ids(self, n: int) -> list[int]:
+        """
+        Thompson sampling: guess a hit rate for every `PermBin` from a beta
+        distribution based on its hits and misses so far, and give the next
+        `ADAPTIVE_CHUNK` IDs to whichever one's guess is highest. Repeat until we
+        have n IDs.
+
+        Bins that have barely been requested have wide distributions, so they
+        still get tried every now and then, but once we know a bin is mostly
+        misses (e.g. lots of deleted comments), it mostly gets left alone.
+        """
+        bins = [bin for bin in self.bins if bin.unrequested > 0]
+        if len(bins) == 0:
+            return []
+        hits = np.array([bin.hits for bin in bins])
+        misses = np.array([bin.misses for bin in bins])
+        unrequested = np.array([bin.unrequested for bin in bins])
+
+        rate = (self.hits + 1) / (self.requested + 2)
+        alpha = rate * PRIOR_STRENGTH + hits
+        beta = (1 - rate) * PRIOR_STRENGTH + misses
+        num_chunks = -(-n // ADAPTIVE_CHUNK)
+        guesses = self._rng.beta(alpha, beta, size=(num_chunks, len(bins)))
+        num_ids = np.bincount(guesses.argmax(axis=1), minlength=len(bins))
+        num_ids = np.minimum(num_ids * ADAPTIVE_CHUNK, unrequested)
+
+        # Give whatever's left over (because some bins ran out, or because n isn't
+        # a multiple of ADAPTIVE_CHUNK) to the bins that look best on average
+        extra = n - int(num_ids.sum())
+        for i in np.argsort(-alpha / (alpha + beta)):
+            if extra <= 0:
+                break
+            more = min(extra, int(unrequested[i] - num_ids[i]))
+            num_ids[i] += more
+            extra -= more
+        # Too many if the last chunk got filled all the way
+        for i in np.argsort(alpha / (alpha + beta)):
+            if extra >= 0:
+                break
+            fewer = min(-extra, int(num_ids[i]))
+            num_ids[i] -= fewer
+            extra += fewer
+
+        ids = list(
+            itertools.chain.from_iterable(
+                bins[i].next_ids(int(num_ids[i])) for i in np.flatnonzero(num_ids)
+            )
+        )
+        assert len(ids) == min(n, int(unrequested.sum()))
+        return ids
+
+    @functools.cached_property
+    def _rng(self) -> np.random.Generator:
+        # Seeded like `IdPermutation`, so the same counts always get the same IDs
+        return np.random.default_rng(seed=[self.start_id, self.end_id])
+
     @property
     def start_id(self):
         return self._start_id
@@ -0,0 +1,274 @@
+"""
+Different ways of calling Reddit's `/api/info` endpoint.
+
+PRAW is the default. The direct client skips PRAW entirely and talks to Reddit
+with a single pooled `requests` session, which is a lot less work per request.
+"""
+
+from abc import ABC, abstractmethod
+import orjson
+import praw
+import praw.exceptions
+import prawcore
+import requests
+import requests.adapters
+import requests.auth
+import threading
+import time
+from typing import NamedTuple, Optional
+
+CLIENTS = ["praw", "direct"]
+
+USER_AGENT = "GEMSTONE CYBERLAND RESEARCH"
+
+REDDIT_URL = "https://www.reddit.com"
+OAUTH_URL = "https://oauth.reddit.com"
+ACCESS_TOKEN_PATH = "/api/v1/access_token"
+INFO_PATH = "/api/info/"
+
+TOKEN_REFRESH_MARGIN = 60
+"""Get a new bearer token once the old one has less than this many seconds left"""
+REQUEST_TIMEOUT = 30
+
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RequestFailed(Exception):
+    """The request didn't go through. It might if we try it again, if `retryable`"""
+
+    def __init__(
+        self,
+        msg: str,
+        remaining: Optional[float] = None,
+        reset_seconds: Optional[float] = None,
+        status: Optional[int] = None,
+        retryable: Optional[bool] = None,
+    ):
+        """
+        # Arguments
+        * `status` - HTTP status we got back, or None if we didn't get a response
+          (e.g. the connection failed)
+        * `retryable` - Whether to try again. By default, only if there was no
+          response, or the status is in `RETRYABLE_STATUSES`
+        """
+        super().__init__(msg)
+        self.remaining = remaining
+        """Same as `InfoResponse.remaining`, if we got a response at all"""
+        self.reset_seconds = reset_seconds
+        self.status = status
+        if retryable is None:
+            retryable = status is None or status in RETRYABLE_STATUSES
+        self.retryable = retryable
+        """False for things like bad credentials, where trying again won't help"""
+
+
+class InfoResponse(NamedTuple):
+    children: list[dict]
+    """The `data.children` list from the response, one item per comment found"""
+    remaining: Optional[float]
+    """Value of the `X-Ratelimit-Remaining` header, if we got one"""
+    reset_seconds: Optional[float]
+    """Value of the `X-Ratelimit-Reset` header, if we got one"""
+
+
+class InfoClient(ABC):
+    """Something that can get comments from Reddit by ID. Must be safe to use
+    from multiple threads at once"""
+
+    @abstractmethod
+    def info(self, fullnames: list[str]) -> InfoResponse:
+        """
+        Get info for the given fullnames (IDs with a `t1_` prefix). Raises
+        `RequestFailed` if the request failed.
+        """
+
+
+class PrawClient(InfoClient):
+    """Goes through PRAW, with one `praw.Reddit` per thread since PRAW isn't
+    thread-safe"""
+
+    def __init__(
+        self, client_id: str, client_secret: str, api_url: Optional[str] = None
+    ):
+        """
+        # Arguments
+        * `api_url` - Where to send requests instead of Reddit (see
+          `mock_reddit.py`)
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.api_url = api_url
+        self._thread_local = threading.local()
+
+    def _get_reddit(self) -> praw.Reddit:
+        """Get the Reddit instance for the current thread"""
+        reddit = getattr(self._thread_local, "reddit", None)
+        if reddit is None:
+            url_kwargs = {}
+            if self.api_url is not None:
+                url_kwargs = dict(
+                    oauth_url=self.api_url,
+                    reddit_url=self.api_url,
+                    check_for_updates=False,
+                )
+            reddit = praw.Reddit(
+                client_id=self.client_id,
+                client_secret=self.client_secret,
+                user_agent=USER_AGENT,
+                **url_kwargs,
+            )
+            self._thread_local.reddit = reddit
+        return reddit
+
+    def info(self, fullnames: list[str]) -> InfoResponse:
+        reddit = self._get_reddit()
+        try:
+            ret = reddit.request(
+                method="GET", path="api/info/", params={"id": ",".join(fullnames)}
+            )
+        except prawcore.exceptions.ResponseException as e:
+            # Includes server errors and 429s
+            raise RequestFailed(
+                f"Prawcore error: {e}",
+                *self._rate_limit(reddit),
+                status=e.response.status_code,
+            )
+        except prawcore.exceptions.RequestException as e:
+            # Didn't get a response at all
+            raise RequestFailed(f"Prawcore error: {e}", *self._rate_limit(reddit))
+        except praw.exceptions.PRAWException as e:
+            # Reddit didn't like the request itself, so there's no point retrying
+            raise RequestFailed(
+                f"Praw error: {e}", *self._rate_limit(reddit), retryable=False
+            )
+        return InfoResponse(ret["data"]["children"], *self._rate_limit(reddit))
+
+    def _rate_limit(
+        self, reddit: praw.Reddit
+    ) -> tuple[Optional[float], Optional[float]]:
+        """Get the remaining requests and seconds until reset that PRAW last saw"""
+        # todo reaching into PRAW's internals sucks, but it doesn't give us the
+        # response headers any other way
+        limiter = reddit._core._rate_limiter  # type: ignore
+        reset_seconds = None
+        if limiter.reset_timestamp is not None:
+            reset_seconds = limiter.reset_timestamp - time.time()
+        return limiter.remaining, reset_seconds
+
+
+class DirectClient(InfoClient):
+    """
+    Talks to Reddit with plain HTTP requests. All threads share one session, so
+    connections are kept alive and reused instead of each thread opening its own.
+
+    Uses an app-only bearer token (the same kind PRAW gets when it only has a
+    client ID and secret), which is fetched again a little before it expires.
+    """
+
+    def __init__(
+        self,
+        client_id: str,
+        client_secret: str,
+        pool_size: int = 1,
+        api_url: Optional[str] = None,
+    ):
+        """
+        # Arguments
+        * `pool_size` - How many connections to keep open (should be the number of
+          threads using this client)
+        * `api_url` - Where to send requests instead of Reddit (see
+          `mock_reddit.py`)
+        """
+        self.token_url = (api_url or REDDIT_URL) + ACCESS_TOKEN_PATH
+        self.info_url = (api_url or OAUTH_URL) + INFO_PATH
+        self._auth = requests.auth.HTTPBasicAuth(client_id, client_secret)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"User-Agent": USER_AGENT, "Accept-Encoding": "gzip"})
+        self._token_lock = threading.Lock()
+        self._token: Optional[str] = None
+        self._token_expires_at = 0.0
+        """When the current token expires (`time.monotonic()`)"""
+
+    def _get_token(self) -> str:
+        with self._token_lock:
+            if (
+                self._token is None
+                or time.monotonic() >= self._token_expires_at - TOKEN_REFRESH_MARGIN
+            ):
+                self._refresh_token()
+            assert self._token is not None
+            return self._token
+
+    def _refresh_token(self):
+        try:
+            resp = self.session.post(
+                self.token_url,
+                auth=self._auth,
+                data={"grant_type": "client_credentials"},
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            raise RequestFailed(f"Couldn't get a bearer token: {e}") from e
+        if resp.status_code != 200:
+            raise RequestFailed(
+                f"Got {resp.status_code} from {resp.url} getting a bearer token",
+                status=resp.status_code,
+            )
+        resp_dict = resp.json()
+        self._token = resp_dict["access_token"]
+        self._token_expires_at = time.monotonic() + resp_dict["expires_in"]
+
+    def info(self, fullnames: list[str]) -> InfoResponse:
+        token = self._get_token()
+        try:
+            resp = self.session.get(
+                self.info_url,
+                params={"id": ",".join(fullnames), "raw_json": 1},
+                headers={"Authorization": f"bearer {token}"},
+                timeout=REQUEST_TIMEOUT,
+            )
+        except requests.RequestException as e:
+            raise RequestFailed(f"Request error: {e}") from e
+
+        remaining = resp.headers.get("X-Ratelimit-Remaining")
+        reset_seconds = resp.headers.get("X-Ratelimit-Reset")
+        rate_limit = (
+            None if remaining is None else float(remaining),
+            None if reset_seconds is None else float(reset_seconds),
+        )
+        if resp.status_code == 401:
+            # Token got revoked or something, get a new one next time. If the
+            # credentials are bad, getting the new one will fail for good
+            with self._token_lock:
+                if self._token == token:
+                    self._token = None
+            raise RequestFailed(f"Got 401 from {resp.url}", *rate_limit)
+        if resp.status_code != 200:
+            raise RequestFailed(
+                f"Got {resp.status_code} from {resp.url}",
+                *rate_limit,
+                status=resp.status_code,
+            )
+
+        children = orjson.loads(resp.content)["data"]["children"]
+        return InfoResponse(children, *rate_limit)
+
+
+def make_client(
+    name: str,
+    client_id: str,
+    client_secret: str,
+    workers: int,
+    api_url: Optional[str] = None,
+) -> InfoClient:
+    """Make the client with the given name (one of `CLIENTS`)"""
+    assert name in CLIENTS, f"Unknown client {name}"
+    if name == "direct":
+        return DirectClient(
+            client_id, client_secret, pool_size=workers, api_url=api_url
+        )
+    return PrawClient(client_id, client_secret, api_url=api_url)
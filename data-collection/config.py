@@ -1,5 +1,6 @@
 """For loading the data collector's config"""
 
+from b36 import from_b36
 from bins import TimeRange
 
 import datetime
@@ -34,19 +35,20 @@ class Config:
         start_date: datetime.date = config["timeStart"]
         curr_start = start_date
         for i, time_range in enumerate(time_ranges_raw):
-            start_id = int(time_range["start"], 36)
+            start_id = from_b36(time_range["start"])
             if "end" in time_range:
-                end_id = int(time_range["end"], 36)
+                end_id = from_b36(time_range["end"])
             elif i + 1 < len(time_ranges_raw):
-                end_id = int(time_ranges_raw[i + 1]["start"], 36)
+                end_id = from_b36(time_ranges_raw[i + 1]["start"])
             else:
                 raise AssertionError(
                     f"An end ID should've been given for time range {time_range}"
                 )
             prev_time = curr_start
-            year = curr_start.year + (curr_start.month + time_step) // 12
-            month = (curr_start.month + time_step) % 12
-            curr_start = curr_start.replace(year=year, month=month)
+            years, month = divmod(curr_start.month - 1 + time_step, 12)
+            curr_start = curr_start.replace(
+                year=curr_start.year + years, month=month + 1
+            )
             time_ranges.append(
                 TimeRange(
                     start_date=prev_time,
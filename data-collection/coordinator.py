@@ -0,0 +1,270 @@
+"""
+Running several collectors at once, each with its own Reddit credentials, so we
+get more requests per minute than one app is allowed.
+
+Each set of credentials gets its own process running a `gems_runner` (a shard).
+The shards split every `PermBin`'s permutation between them, so they never
+request the same ID, and they split each time range's minimum so they all stop
+around when the time range has enough hits. Each shard writes to its own
+directory inside the run's directory, and those get merged back together at the
+end (see `writers.merge_shards`).
+
+The shards send their progress back to the coordinator through a queue, and the
+coordinator runs the dashboard server for all of them.
+"""
+
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import queue
+import shutil
+import signal
+import time
+from typing import Optional
+
+from bins import BinBinBin
+from config import CONFIG_FILE_NAME, Config
+from feed import BATCH, DONE, LATENCY, FeedServer
+from idset import IdSet
+from runner import (
+    LOG_FORMAT,
+    PROGRAM_DATA_FILE_NAME,
+    DeferredInterrupt,
+    gems_runner,
+    get_formatted_time,
+    load_run,
+)
+import util
+from writers import SHARD_DIR_PREFIX, merge_shards
+
+SHARD_JOIN_TIMEOUT = 60
+"""How long to wait for each shard to finish closing before giving up on it"""
+
+
+def load_credentials() -> list[tuple[str, str]]:
+    """
+    Get every set of credentials from the environment. The first set is
+    `REDDIT_ID` and `REDDIT_SECRET`, and any more are `REDDIT_ID_2` and
+    `REDDIT_SECRET_2`, `REDDIT_ID_3` and `REDDIT_SECRET_3`, and so on
+    """
+    credentials = []
+    suffix = ""
+    while True:
+        client_id = os.getenv("REDDIT_ID" + suffix)
+        secret = os.getenv("REDDIT_SECRET" + suffix)
+        if client_id is None or secret is None:
+            return credentials
+        credentials.append((client_id, secret))
+        suffix = f"_{len(credentials) + 1}"
+
+
+def _run_shard(
+    index: int,
+    credentials: list[tuple[str, str]],
+    config: Config,
+    output_dir: str,
+    run_dir: str,
+    log_level: int,
+    praw_log_level: int,
+    progress_queue,
+    runner_kwargs: dict,
+):
+    """What each shard's process runs"""
+    client_id, secret = credentials[index]
+    runner = None
+    try:
+        runner = gems_runner(
+            config,
+            client_id,
+            secret,
+            output_dir=output_dir,
+            prev_file=None,
+            log_level=log_level,
+            praw_log_level=praw_log_level,
+            port=None,
+            run_dir=os.path.join(run_dir, f"{SHARD_DIR_PREFIX}{index}"),
+            shard=(index, len(credentials)),
+            progress_queue=progress_queue,
+            **runner_kwargs,
+        )
+        while runner.run_step():
+            pass
+    finally:
+        try:
+            if runner is not None:
+                runner.close()
+        finally:
+            progress_queue.put((DONE, index))
+
+
+class Coordinator:
+    def __init__(
+        self,
+        config: Config,
+        credentials: list[tuple[str, str]],
+        output_dir: str,
+        log_level: int,
+        praw_log_level: int,
+        port: int,
+        dashboard_rate: float = 4,
+        **runner_kwargs,
+    ):
+        """
+        # Arguments
+        * `credentials` - Client ID and secret for each shard
+        * `runner_kwargs` - Passed on to each shard's `gems_runner` (`workers`,
+          `output_format`, `client`, etc.)
+        """
+        self.credentials = credentials
+        self.time_ranges = BinBinBin(config.time_ranges)
+        """Progress of all the shards put together"""
+        self.sampling = runner_kwargs.get("sampling", "uniform")
+        self.timestamp = get_formatted_time()
+
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+        prev_runs = util.get_runs()
+        # The shards retry what previous runs gave up on, but rebuilding a
+        # checkpoint needs to know what those were
+        failed = IdSet()
+        for run_num in sorted(prev_runs):
+            load_run(self.time_ranges, None, prev_runs[run_num], failed)
+        self.run_dir = os.path.join(output_dir, f"run_{len(prev_runs)}")
+        os.mkdir(self.run_dir)
+        shutil.copyfile(config.path, os.path.join(self.run_dir, CONFIG_FILE_NAME))
+
+        # Not using basicConfig here, since the shards would inherit it and log
+        # into our file instead of their own
+        self.logger = logging.getLogger("coordinator")
+        self.logger.setLevel(logging.DEBUG)
+        file_handler = logging.FileHandler(
+            os.path.join(self.run_dir, util.LOG_FILE_NAME)
+        )
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        self.logger.addHandler(file_handler)
+        stderr_handler = logging.StreamHandler()
+        stderr_handler.setLevel(log_level)
+        self.logger.addHandler(stderr_handler)
+
+        # Fork so the shards don't have to import everything and reload the config
+        # todo this won't work on Windows
+        ctx = multiprocessing.get_context("fork")
+        self.queue = ctx.Queue()
+        self.shards = [
+            ctx.Process(
+                target=_run_shard,
+                name=f"{SHARD_DIR_PREFIX}{i}",
+                args=(
+                    i,
+                    credentials,
+                    config,
+                    output_dir,
+                    self.run_dir,
+                    log_level,
+                    praw_log_level,
+                    self.queue,
+                    runner_kwargs,
+                ),
+            )
+            for i in range(len(credentials))
+        ]
+        for shard in self.shards:
+            shard.start()
+        self._done: set[int] = set()
+        """Shards that have finished and closed their files"""
+        self.logger.info(f"Started {len(self.shards)} shards")
+
+        # Only made after forking so the shards don't get a copy of the socket
+        self.feed = FeedServer(port, self.time_ranges, dashboard_rate, self.logger)
+        # Ctrl+C goes to the shards too, so all we have to do is keep going until
+        # they've stopped
+        self.interrupt = DeferredInterrupt()
+
+    def _handle(self, msg: tuple):
+        if msg[0] == BATCH:
+            _, ids, hits = msg
+            self.time_ranges.notify_requested_many(ids, hits)
+            self.feed.record_batch(ids, hits)
+        elif msg[0] == LATENCY:
+            self.feed.record_latency(msg[1])
+        elif msg[0] == DONE:
+            self._done.add(msg[1])
+            self.logger.info(f"Shard {msg[1]} is done")
+
+    def _drain(self, timeout: Optional[float] = None):
+        """Handle every message in the queue, waiting up to `timeout` seconds for
+        the first one"""
+        try:
+            if timeout is None:
+                msg = self.queue.get_nowait()
+            else:
+                msg = self.queue.get(timeout=timeout)
+            while True:
+                self._handle(msg)
+                msg = self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _running(self) -> bool:
+        return any(
+            i not in self._done and shard.is_alive()
+            for i, shard in enumerate(self.shards)
+        )
+
+    def run_step(self) -> bool:
+        self._drain(self.feed.min_interval)
+        self.feed.poll()
+        return self._running()
+
+    def close(self):
+        """Waits for the shards to finish, then merges their outputs"""
+        if self._running() and self.interrupt.signal_received is None:
+            # We're stopping early for some reason other than Ctrl+C, so the
+            # shards don't know to stop yet
+            for i, shard in enumerate(self.shards):
+                if i not in self._done and shard.pid is not None:
+                    os.kill(shard.pid, signal.SIGINT)
+        deadline = time.monotonic() + SHARD_JOIN_TIMEOUT
+        while self._running() and time.monotonic() < deadline:
+            self._drain(self.feed.min_interval)
+            self.feed.poll()
+        for i, shard in enumerate(self.shards):
+            shard.join(max(0, deadline - time.monotonic()))
+            if shard.is_alive():
+                self.logger.error(f"Shard {i} didn't stop, killing it")
+                shard.kill()
+                shard.join()
+            elif shard.exitcode != 0:
+                self.logger.error(f"Shard {i} exited with code {shard.exitcode}")
+        self._drain()
+        self.feed.poll(force=True)
+        self.feed.close()
+
+        merge_shards(self.run_dir)
+        # The shards don't tell us which IDs they skipped, but it's in their
+        # (merged) checkpoints
+        checkpoint = util.load_checkpoint(self.run_dir)
+        if checkpoint is not None:
+            zeros = np.zeros_like(checkpoint["skipped"])
+            self.time_ranges.add_leaf_counts(zeros, zeros, checkpoint["skipped"])
+
+        program_data = {
+            "timestamp": self.timestamp,
+            "sampling": self.sampling,
+            "shards": len(self.shards),
+            "time_ranges": {
+                str(time_range.start_date): {
+                    "hits": [bin.hits for bin in time_range.bins],
+                    "misses": [bin.misses for bin in time_range.bins],
+                    "skipped": [bin.skipped for bin in time_range.bins],
+                }
+                for time_range in self.time_ranges.bins
+            },
+        }
+        with open(
+            os.path.join(self.run_dir, PROGRAM_DATA_FILE_NAME), "w"
+        ) as program_data_f:
+            json.dump(program_data, program_data_f, indent=2)
+        self.interrupt.restore()
@@ -0,0 +1,88 @@
+"""
+Turning the comments Reddit sends back from `/api/info` into rows to write out.
+
+This runs on the request threads, right after each response comes back, so the
+main thread only has to hand the rows off to the writers.
+"""
+
+import numpy as np
+from typing import NamedTuple
+
+from b36 import from_b36_array
+from util import AUTOMOD_ID, COMMENT_COLS, EXTRA_FIELDS
+
+SKIPPED_AUTOMOD = "is by automod"
+SKIPPED_EMPTY = "was empty"
+SKIPPED_REMOVED = "was [removed]"
+SKIPPED_DELETED = "was [deleted]"
+
+
+class DecodedBatch(NamedTuple):
+    rows: list[list]
+    """One row per comment worth keeping (see `writers` for what a row looks like)"""
+    hit_ids: np.ndarray
+    """IDs of the comments in `rows`, as ints"""
+    skipped: list[tuple[str, str]]
+    """ID and reason for every comment we got back but are counting as a miss"""
+
+
+class RowDecoder:
+    def __init__(self, extra_fields: list[str] = []):
+        """
+        # Arguments
+        * `extra_fields` - Fields from `util.EXTRA_FIELDS` to collect too
+        """
+        for field in extra_fields:
+            assert field in EXTRA_FIELDS, f"Unknown extra field {field}"
+        self.extra_fields = list(extra_fields)
+        self.columns = COMMENT_COLS + self.extra_fields
+        """Names of the fields in each row"""
+
+    def decode(self, children: list[dict]) -> DecodedBatch:
+        """
+        Turn the `data.children` list from a response into rows, skipping
+        comments by automod and comments that are empty, removed, or deleted
+        """
+        rows = []
+        skipped = []
+        extra_fields = self.extra_fields
+        for child in children:
+            data = child["data"]
+            id = data["id"]
+            body = data["body"]
+            author_id = data.get("author_fullname") or ""
+            author_id = author_id.removeprefix("t2_")
+            # Consider all of these misses
+            if author_id == AUTOMOD_ID:
+                skipped.append((id, SKIPPED_AUTOMOD))
+                continue
+            if len(body) == 0:
+                skipped.append((id, SKIPPED_EMPTY))
+                continue
+            if body == "[removed]":
+                skipped.append((id, SKIPPED_REMOVED))
+                continue
+            if body == "[deleted]":
+                skipped.append((id, SKIPPED_DELETED))
+                continue
+
+            row = [
+                id,
+                int(data["created_utc"]),
+                data["subreddit"],
+                author_id,
+                data["parent_id"],
+                data["link_id"],
+                data["ups"],
+                data["downs"],
+                body,
+            ]
+            # Only the author can be empty
+            if None in row or "" in (id, row[2], row[4], row[5]):
+                raise ValueError(f"Got a comment with missing fields: {child}")
+            if len(extra_fields) > 0:
+                row.extend([data.get(field) for field in extra_fields])
+            rows.append(row)
+
+        hit_ids = from_b36_array([row[0] for row in rows])
+        return DecodedBatch(rows, hit_ids, skipped)
@@ -0,0 +1,271 @@
+"""
+The protocol the collector uses to push progress to the dashboard (`webapp.py`),
+plus the server side of it.
+
+Every message is a frame: a 4-byte big-endian payload length, a 1-byte message
+type, and then the payload. There are two kinds of messages:
+- `LAYOUT`: Sent once when a client connects. The payload is a JSON list of the
+  start dates of all the time ranges. After this, time ranges are referred to by
+  their index in this list.
+- `UPDATE`: Throughput stats (`UPDATE_HEADER`), followed by one `BIN_RECORD` for
+  every time range that changed since the last update. The first update a client
+  gets has every time range in it.
+
+The server only sends updates at most `max_rate` times a second, no matter how
+often batches come back, and only includes time ranges whose counts changed.
+"""
+
+from collections import deque
+import json
+import logging
+import numpy as np
+import selectors
+import socket
+import struct
+import time
+
+from bins import BinBinBin
+
+LAYOUT = 1
+UPDATE = 2
+
+FRAME_HEADER = struct.Struct("!IB")
+"""Payload length and message type"""
+
+UPDATE_HEADER = struct.Struct("!ddQ")
+"""IDs requested per second, average request latency (seconds), and total number
+of batches so far"""
+
+BIN_RECORD = np.dtype(
+    [("index", ">u4"), ("min", ">u4"), ("hits", ">u4"), ("misses", ">u4")]
+)
+"""Counts for one time range"""
+
+MAX_BACKLOG = 1 << 20
+"""If a client has this many bytes waiting to be sent to it, it's too slow, so
+drop it"""
+
+
+def encode_frame(msg_type: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(payload), msg_type) + payload
+
+
+def encode_layout(start_dates: list[str]) -> bytes:
+    return encode_frame(LAYOUT, json.dumps(start_dates).encode())
+
+
+def encode_update(
+    records: np.ndarray, ids_per_sec: float, latency: float, num_batches: int
+) -> bytes:
+    """`records` must have the `BIN_RECORD` dtype"""
+    header = UPDATE_HEADER.pack(ids_per_sec, latency, num_batches)
+    return encode_frame(UPDATE, header + records.astype(BIN_RECORD).tobytes())
+
+
+def decode_update(payload: bytes) -> tuple[np.ndarray, float, float, int]:
+    """Returns the bin records, IDs per second, latency, and number of batches"""
+    ids_per_sec, latency, num_batches = UPDATE_HEADER.unpack_from(payload)
+    records = np.frombuffer(payload, dtype=BIN_RECORD, offset=UPDATE_HEADER.size)
+    return records, ids_per_sec, latency, num_batches
+
+
+class FrameReader:
+    """Splits the bytes coming in from a socket back up into messages"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[tuple[int, bytes]]:
+        """Add data and return all the (message type, payload) pairs that are
+        complete now"""
+        self._buffer.extend(data)
+        frames = []
+        while len(self._buffer) >= FRAME_HEADER.size:
+            length, msg_type = FRAME_HEADER.unpack_from(self._buffer)
+            end = FRAME_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            frames.append((msg_type, bytes(self._buffer[FRAME_HEADER.size : end])))
+            del self._buffer[:end]
+        return frames
+
+
+BATCH = "batch"
+LATENCY = "latency"
+DONE = "done"
+
+
+class QueueFeed:
+    """
+    Stands in for `FeedServer` in a shard's process (see `coordinator.py`), and
+    sends everything to the coordinator, which has the actual `FeedServer`.
+
+    Messages are tuples: (`BATCH`, IDs, hits), (`LATENCY`, seconds), or (`DONE`,
+    shard index).
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def record_latency(self, seconds: float):
+        self.queue.put((LATENCY, seconds))
+
+    def record_batch(self, ids: np.ndarray, hits: np.ndarray):
+        self.queue.put((BATCH, ids, hits))
+
+    def poll(self, force: bool = False):
+        pass
+
+    def close(self):
+        pass
+
+
+class FeedServer:
+    """Accepts dashboard connections and pushes updates to them"""
+
+    def __init__(
+        self,
+        port: int,
+        time_ranges: BinBinBin,
+        max_rate: float,
+        logger: logging.Logger,
+    ):
+        """
+        # Arguments
+        * `port` - Port to listen on
+        * `max_rate` - Most updates to send per second
+        """
+        self.time_ranges = time_ranges
+        self.min_interval = 1 / max_rate
+        self.logger = logger
+        self.sel = selectors.DefaultSelector()
+        self._clients: dict[socket.socket, bytearray] = {}
+        """Each client, along with the bytes we still need to send it"""
+
+        self._sent = np.zeros(len(time_ranges.bins), dtype=BIN_RECORD)
+        """What the clients were last told about each time range"""
+        self._sent["index"] = np.arange(len(time_ranges.bins))
+        self._last_update = 0.0
+
+        self._latencies: deque[float] = deque()
+        self._num_ids = 0
+        self._num_batches = 0
+        self._stats_since = time.monotonic()
+        self._ids_per_sec = 0.0
+        self._latency = 0.0
+
+        server_sock = socket.socket()
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_sock.bind(("localhost", port))
+        server_sock.listen(100)
+        server_sock.setblocking(False)
+        self.sel.register(server_sock, selectors.EVENT_READ, False)
+
+    def record_latency(self, seconds: float):
+        """Record how long a request took. Safe to call from any thread"""
+        self._latencies.append(seconds)
+
+    def record_batch(self, ids: np.ndarray, hits: np.ndarray):
+        """Record that a batch was processed (the counts themselves are read
+        from the time ranges when sending updates)"""
+        self._num_ids += len(ids)
+        self._num_batches += 1
+
+    def poll(self, force: bool = False):
+        """
+        Handle new connections and messages, and send an update if it's been long
+        enough since the last one (or if `force` is true)
+        """
+        for key, _mask in self.sel.select(0):
+            is_client = key.data
+            if is_client:
+                self._read(key.fileobj)  # type: ignore
+            else:
+                self._accept(key.fileobj)  # type: ignore
+
+        now = time.monotonic()
+        if force or now - self._last_update >= self.min_interval:
+            self._send_update(now)
+        self._flush()
+
+    def close(self):
+        for fd in list(self.sel.get_map()):
+            key = self.sel.get_key(fd)
+            self._remove_conn(key.fileobj)  # type: ignore
+
+    def _current(self) -> np.ndarray:
+        records = self._sent.copy()
+        for i, time_range in enumerate(self.time_ranges.bins):
+            records[i] = (i, time_range.min, time_range.hits, time_range.misses)
+        return records
+
+    def _send_update(self, now: float):
+        elapsed = now - self._stats_since
+        if elapsed > 0:
+            self._ids_per_sec = self._num_ids / elapsed
+        latencies = [self._latencies.popleft() for _ in range(len(self._latencies))]
+        if len(latencies) > 0:
+            self._latency = sum(latencies) / len(latencies)
+        self._num_ids = 0
+        self._stats_since = now
+        self._last_update = now
+
+        current = self._current()
+        changed = current[current != self._sent]
+        self._sent = current
+        if len(self._clients) == 0:
+            return
+        msg = encode_update(changed, self._ids_per_sec, self._latency, self._num_batches)
+        for backlog in self._clients.values():
+            backlog.extend(msg)
+
+    def _flush(self):
+        for conn, backlog in list(self._clients.items()):
+            if len(backlog) == 0:
+                continue
+            try:
+                sent = conn.send(backlog)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self._remove_conn(conn)
+                continue
+            del backlog[:sent]
+            if len(backlog) > MAX_BACKLOG:
+                self.logger.warning(f"{conn} is too far behind, dropping it")
+                self._remove_conn(conn)
+
+    def _accept(self, sock: socket.socket):
+        """Accept a new connection and send it everything it needs to catch up"""
+        conn, addr = sock.accept()
+        self.logger.info(f"Accepted connection from {addr}")
+        conn.setblocking(False)
+        self.sel.register(conn, selectors.EVENT_READ, True)
+        start_dates = [str(time_range.start_date) for time_range in self.time_ranges.bins]
+        self._clients[conn] = bytearray(
+            encode_layout(start_dates)
+            + encode_update(
+                self._current(), self._ids_per_sec, self._latency, self._num_batches
+            )
+        )
+
+    def _read(self, conn: socket.socket):
+        """Receive a message from the dashboard. We're not actually using this yet,
+        but we might want to allow stopping the server from the dashboard at some point
+        """
+        try:
+            data = conn.recv(1)
+        except:
+            self._remove_conn(conn)
+            return
+        if not data:
+            self._remove_conn(conn)
+            return
+
+        self.logger.warning(f"Got {data!r} from {conn}, I don't know what to do with it")
+
+    def _remove_conn(self, conn: socket.socket):
+        self.logger.info(f"Closing {conn}")
+        self.sel.unregister(conn)
+        self._clients.pop(conn, None)
+        conn.close()
@@ -1,17 +1,39 @@
 #!/usr/bin/env python
 """
 Find IDs for a bunch of timestamps and generate a config based on that
+
+Comment IDs go up pretty steadily with time, so instead of bisecting, each
+boundary's ID is guessed by interpolating between the timestamps of the closest
+comments we know of on either side, and the probes for it are spread out around
+that guess. Every boundary gets probed in the same request.
+
+Every ID we've ever asked about (hit or miss) is kept in a cache file, so IDs
+are never requested twice, and running this again with a different time step
+starts out with all the comments found last time. Usually that's enough to get
+most boundaries in one or two requests.
 """
 
 import argparse
 import datetime
 import logging
+import numpy as np
+import os
 from typing import Optional
+
+from b36 import from_b36, from_b36_array, to_b36, to_b36_array
 import util
 
-NOT_THIS_FUCKING_ID_AGAIN = {int("c3ctzso", 36), int("c3ctzsq", 36), int("f22fgrh", 36)}
+NOT_THIS_FUCKING_ID_AGAIN = {
+    from_b36("c3ctzso"),
+    from_b36("c3ctzsq"),
+    from_b36("f22fgrh"),
+}
+"""Comments whose timestamps are way off from the IDs around them. These are
+treated as misses"""
 
-reddit = util.init_reddit()
+REQUEST_PER_CALL = 100
+
+curr_dir = os.path.dirname(__file__)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -27,203 +49,321 @@ handler = logging.StreamHandler()
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
-parser = argparse.ArgumentParser(
-    description="Find IDs at the border of some time ranges to generate a config.yaml"
-)
-parser.add_argument("time_first", help="Start of first time range")
-parser.add_argument("time_last", help="End of last time range")
-parser.add_argument("time_step", help="Length of each time range, in months", type=int)
-parser.add_argument("start_id", help="Lower bound on ID (inclusive)")
-parser.add_argument("end_id", help="Upper bound on ID (inclusive)")
-args = parser.parse_args()
-
-time_first = datetime.datetime.combine(
-    date=datetime.datetime.fromisoformat(args.time_first),
-    time=datetime.time(0, 0, 0),
-    tzinfo=datetime.timezone.utc,
-)
-time_last = datetime.datetime.combine(
-    date=datetime.datetime.fromisoformat(args.time_last),
-    time=datetime.time(0, 0, 0),
-    tzinfo=datetime.timezone.utc,
-)
-time_step: int = args.time_step
-
-low = int(args.start_id, 36)
-high = int(args.end_id, 36)
-
-time_ranges = []
-curr = time_first
-while curr < time_last:
-    time_ranges.append(curr)
-    if curr.month + time_step <= 12:
-        curr = curr.replace(month=curr.month + time_step)
-    else:
-        curr = curr.replace(year=curr.year + 1, month=1)
-
-if curr != time_last:
-    logger.warning("Time ranges didn't fit exactly")
-time_ranges.append(min(curr, time_last))
-
-logger.debug(f"{time_ranges=}")
-
-bounds: dict[
-    datetime.datetime,
-    tuple[
-        Optional[int],
-        Optional[datetime.datetime],
-        Optional[int],
-        Optional[datetime.datetime],
-    ],
-] = {range_start: (None, None, None, None) for range_start in time_ranges}
-bounds[time_first] = (low, None, None, None)
-bounds[time_ranges[len(time_ranges) - 1]] = (None, None, high, None)
-
-# todo avoid re-requesting IDs that were misses
-
-# todo there are almost certainly off-by-ones lurking around here
 
+class ProbeCache:
+    """Every ID we've requested, along with the timestamps of the ones that were
+    hits. Stored as an `.npz` file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hit_ids = np.array([], dtype=np.int64)
+        """Sorted"""
+        self.hit_times = np.array([], dtype=np.int64)
+        """Unix timestamp for each of `hit_ids`"""
+        self.missed_ids = np.array([], dtype=np.int64)
+        """Sorted"""
+        if os.path.exists(path):
+            with np.load(path) as f:
+                self.hit_ids = f["hit_ids"]
+                self.hit_times = f["hit_times"]
+                self.missed_ids = f["missed_ids"]
+            logger.info(
+                f"Loaded {len(self.hit_ids)} hits and {len(self.missed_ids)} misses"
+                f" from {path}"
+            )
+
+    def add(self, ids: np.ndarray, found: dict[int, int]):
+        """Add the results of requesting `ids`. `found` maps the IDs that were hits
+        to their timestamps"""
+        found = {
+            id: time
+            for id, time in found.items()
+            if id not in NOT_THIS_FUCKING_ID_AGAIN
+        }
+        new_hits = np.fromiter(found.keys(), dtype=np.int64, count=len(found))
+        new_times = np.fromiter(found.values(), dtype=np.int64, count=len(found))
+        hit_ids = np.concatenate([self.hit_ids, new_hits])
+        order = np.argsort(hit_ids, kind="stable")
+        self.hit_ids = hit_ids[order]
+        self.hit_times = np.concatenate([self.hit_times, new_times])[order]
+        self.missed_ids = np.union1d(self.missed_ids, ids[~np.isin(ids, new_hits)])
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                hit_ids=self.hit_ids,
+                hit_times=self.hit_times,
+                missed_ids=self.missed_ids,
+            )
+        os.replace(tmp_path, self.path)
+
+    def probed(self, ids: np.ndarray) -> np.ndarray:
+        return np.isin(ids, self.hit_ids) | np.isin(ids, self.missed_ids)
+
+    def brackets(
+        self, targets: np.ndarray, low: int, high: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        For each target timestamp, find the last hit before it and the first hit
+        at or after it, only looking at IDs between `low` and `high` (inclusive).
+
+        Returns the lower IDs, their timestamps, the upper IDs, and their
+        timestamps. If there's no hit on one side, the ID is `low - 1` or `high`
+        and the timestamp is -1.
+        """
+        start, end = np.searchsorted(self.hit_ids, [low, high + 1])
+        ids = self.hit_ids[start:end]
+        # Treat timestamps as never going down, so the few comments that are out
+        # of order can't make a mess of things
+        times = np.maximum.accumulate(self.hit_times[start:end])
+        i = np.searchsorted(times, targets, side="left")
+        has_low = i > 0
+        has_high = i < len(ids)
+        low_i = np.maximum(i - 1, 0)
+        high_i = np.minimum(i, len(ids) - 1)
+        if len(ids) == 0:
+            ids = times = np.zeros(1, dtype=np.int64)
+        return (
+            np.where(has_low, ids[low_i], low - 1),
+            np.where(has_low, times[low_i], -1),
+            np.where(has_high, ids[high_i], high),
+            np.where(has_high, times[high_i], -1),
+        )
 
-def bounds_str():
+    def num_unprobed(self, lows: np.ndarray, highs: np.ndarray) -> np.ndarray:
+        """How many IDs strictly between each low and high haven't been requested
+        (there are no hits between them if they came from `brackets`)"""
+        missed = np.searchsorted(self.missed_ids, highs, side="left") - np.searchsorted(
+            self.missed_ids, lows, side="right"
+        )
+        return np.maximum(highs - lows - 1 - missed, 0)
+
+
+def pick_probes(
+    cache: ProbeCache,
+    low: int,
+    low_time: int,
+    high: int,
+    high_time: int,
+    target: Optional[int],
+    n: int,
+) -> np.ndarray:
+    """
+    Pick up to `n` unrequested IDs strictly between `low` and `high` to narrow
+    down where `target` is. If there's no target (because we don't know the time
+    at one end, or because there's more than one target in there), they're just
+    spread out evenly
+    """
+    gap = high - low - 1
+    if target is not None:
+        guess = low + (target - low_time) / (high_time - low_time) * (high - low)
+    else:
+        guess = (low + high) / 2
+    if gap <= 4 * n:
+        # Small enough to just look at everything near the guess
+        candidates = np.arange(low + 1, high, dtype=np.int64)
+    else:
+        if target is not None:
+            # Spread out around the guess. The window's narrow enough that if the
+            # guess is any good, the next bracket is way smaller, but wide enough
+            # that missing it still cuts off a decent chunk
+            half_width = max(n, gap / (16 * n))
+        else:
+            half_width = gap / 2
+        candidates = np.linspace(guess - half_width, guess + half_width, n + 2)[1:-1]
+        candidates = np.unique(np.clip(np.round(candidates), low + 1, high - 1))
+        candidates = candidates.astype(np.int64)
+    candidates = candidates[~cache.probed(candidates)]
+    # Keep the ones closest to the guess
+    candidates = candidates[np.argsort(np.abs(candidates - guess), kind="stable")[:n]]
+    return np.sort(candidates)
+
+
+def search(
+    cache: ProbeCache,
+    targets: np.ndarray,
+    low: int,
+    high: int,
+    limit: int,
+    probes_per_round: int,
+):
+    """Keep probing until every target's bracket has nothing left to request in it
+    or we've done `limit` rounds"""
+    reddit = None
+    for round_num in range(limit):
+        lows, low_times, highs, high_times = cache.brackets(targets, low, high)
+        exact = high_times == targets
+        unresolved = np.flatnonzero(~exact & (cache.num_unprobed(lows, highs) > 0))
+        if len(unresolved) == 0:
+            logger.info(f"Done after {round_num} rounds")
+            return
+        logger.debug(f"Round {round_num}, {len(unresolved)} boundaries left")
+
+        unresolved = unresolved[:probes_per_round]
+        per_boundary = probes_per_round // len(unresolved)
+        # Targets with the same bracket have to share it, or they'd all pick the
+        # same probes
+        _, first, counts = np.unique(
+            lows[unresolved], return_index=True, return_counts=True
+        )
+        probes = []
+        for j, count in zip(unresolved[first], counts):
+            known_times = low_times[j] >= 0 and high_times[j] > low_times[j]
+            if count > 1 and known_times:
+                for k in range(j, j + count):
+                    probes.append(
+                        pick_probes(
+                            cache,
+                            lows[k],
+                            low_times[k],
+                            highs[k],
+                            high_times[k],
+                            targets[k],
+                            per_boundary,
+                        )
+                    )
+            else:
+                probes.append(
+                    pick_probes(
+                        cache,
+                        lows[j],
+                        low_times[j],
+                        highs[j],
+                        high_times[j],
+                        targets[j] if known_times else None,
+                        per_boundary * count,
+                    )
+                )
+        ids = np.unique(np.concatenate(probes))
+        if len(ids) == 0:
+            logger.error("Nothing left to probe, but some boundaries aren't done")
+            return
+
+        if reddit is None:
+            reddit = util.init_reddit()
+        fullnames = ["t1_" + id for id in to_b36_array(ids)]
+        comments = list(reddit.info(fullnames=fullnames))
+        found_ids = from_b36_array([comment.id for comment in comments])
+        found = {
+            int(id): int(comment.created_utc)
+            for id, comment in zip(found_ids, comments)
+        }
+        logger.info(f"Requested {len(ids)}, got {len(found)} hits")
+        cache.add(ids, found)
+        cache.save()
+    logger.warning(f"Gave up after {limit} rounds")
+
+
+def add_months(time: datetime.datetime, months: int) -> datetime.datetime:
+    years, month = divmod(time.month - 1 + months, 12)
+    return time.replace(year=time.year + years, month=month + 1)
+
+
+def to_datetime(timestamp: int) -> Optional[datetime.datetime]:
+    if timestamp < 0:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+
+
+def bounds_str(
+    time_ranges: list[datetime.datetime],
+    brackets: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+) -> str:
     res = []
-    for range_start, (low, low_time, high, high_time) in bounds.items():
+    for range_start, low, low_time, high, high_time in zip(time_ranges, *brackets):
         res.append(
-            str(range_start)
-            + ", "
-            + ("-".center(7) if low is None else util.to_b36(low))
-            + "-"
-            + ("-".center(7) if high is None else util.to_b36(high))
-            + ", "
-            + str(low_time)
-            + "-"
-            + str(high_time)
-            + ("" if low is None or high is None else ", space: " + str(high - low))
+            f"{range_start}, {to_b36(low)}-{to_b36(high)},"
+            f" {to_datetime(low_time)}-{to_datetime(high_time)}, space: {high - low}"
         )
     return "\n".join(res)
 
 
-def search(limit: int):
-    if limit == 0:
-        logger.info("Done, exiting")
-        return
-
-    request_ranges = []
-    """Holds (low, high) tuples representing ranges of IDs to request between"""
-    curr_start = None
-    for range_start in time_ranges:
-        low, _, high, _ = bounds[range_start]
-        if low is not None:
-            curr_start = low
-        else:
-            assert curr_start is not None, f"{range_start=!s}, bounds={bounds_str()}"
-
-        if high is not None:
-            assert (
-                curr_start is not None
-            ), f"{range_start=!s}, {high=}, bounds={bounds_str()}"
-            if curr_start < high:
-                request_ranges.append((curr_start, high))
-                curr_start = high
-
-    if len(request_ranges) == 0:
-        logger.info(f"Done with {limit} iterations to go!")
-        return
-
-    logger.debug(
-        str([f"{util.to_b36(low)}-{util.to_b36(high)}" for low, high in request_ranges])
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Find IDs at the border of some time ranges to generate a"
+        " config.yaml"
     )
+    parser.add_argument("time_first", help="Start of first time range")
+    parser.add_argument("time_last", help="End of last time range")
+    parser.add_argument(
+        "time_step", help="Length of each time range, in months", type=int
+    )
+    parser.add_argument("start_id", help="Lower bound on ID (inclusive)")
+    parser.add_argument("end_id", help="Upper bound on ID (inclusive)")
+    parser.add_argument(
+        "--cache",
+        help="File to keep every ID requested in, so they're never requested again",
+        default=os.path.join(curr_dir, "find-ids-cache.npz"),
+    )
+    parser.add_argument(
+        "--rounds", help="Most requests to make", default=25, type=int
+    )
+    parser.add_argument(
+        "--probes",
+        help="How many IDs to request each round",
+        default=REQUEST_PER_CALL,
+        type=int,
+    )
+    args = parser.parse_args()
 
-    num_requests = [0] * len(request_ranges)
-    """Number of requests allotted per range"""
-    num_left = 100
-    while num_left > 0:
-        added = False
-        for i, (start, end) in enumerate(request_ranges):
-            if num_left == 0:
-                break
-            if num_requests[i] + 1 < end - start:
-                num_requests[i] += 1
-                num_left -= 1
-                added = True
-        if not added:
-            break
-
-    ids = []
-    for i, (n, (start, end)) in enumerate(zip(num_requests, request_ranges)):
-        if start == end:
-            continue
-        ids.extend(range(start, end, (end - start) // (n + 1)))
-    fullnames = ["t1_" + util.to_b36(id).lower() for id in ids]
-
-    comments = list(reddit.info(fullnames=fullnames))
-    for comment in comments:
-        id = int(comment.id, 36)
-        unix_timestamp: int = comment.created_utc
-        time = datetime.datetime.fromtimestamp(unix_timestamp, tz=datetime.timezone.utc)
-
-        if id in NOT_THIS_FUCKING_ID_AGAIN:
-            continue
-
-        for range_start in bounds.keys():
-            low, low_time, high, high_time = bounds[range_start]
-            if time < range_start:
-                if low is None or low < id:
-                    assert (
-                        high is None or id <= high
-                    ), f"id={util.to_b36(id)} {time=!s}, {range_start=!s} bounds={bounds_str()}"
-                    low = id
-                    low_time = time
-            elif range_start < time:
-                if high is None or id < high:
-                    assert (
-                        low is None or low <= id
-                    ), f"id={util.to_b36(id)} {time=!s}, {range_start=!s} bounds:\n{bounds_str()}"
-                    high = id
-                    high_time = time
-            else:
-                # This comment's good enough
-                low = id
-                low_time = time
-                high = id
-                high_time = time
-            bounds[range_start] = low, low_time, high, high_time
-
-    if len(comments) == 0:
-        logger.error("No comments!")
-        return
-    else:
-        logger.info(f"New bounds:")
-        logger.info(bounds_str())
-
-    search(limit - 1)
-
-
-search(25)
-
-logger.info(bounds_str())
-
-print(f"timeStart: {time_ranges[0].date()}")
-print(f"timeStep: {time_step} # months")
-print(f"timeRanges:")
-for i, range_start in enumerate(time_ranges):
-    low, low_time, high, high_time = bounds[range_start]
-    assert low is not None and high is not None, f"{range_start=}"
-    if low == high:
-        id = low
-        comment = f"Time: {low_time}"
-    elif low + 1 == high:
-        assert low_time < range_start < high_time
-        id = high
-        comment = f"Time: {high_time}"
-    else:
-        id = (low + high) // 2
-        comment = f"Average of {util.to_b36(low)} ({low_time}) and {util.to_b36(high)} ({high_time})"
-
-    if i < len(time_ranges) - 1:
-        print(f"- start: {util.to_b36(id)} # {comment}")
-        print(f"  min: 200 # default")
-    else:
-        print(f"  end: {util.to_b36(id)} # {comment}")
+    time_first = datetime.datetime.combine(
+        date=datetime.datetime.fromisoformat(args.time_first),
+        time=datetime.time(0, 0, 0),
+        tzinfo=datetime.timezone.utc,
+    )
+    time_last = datetime.datetime.combine(
+        date=datetime.datetime.fromisoformat(args.time_last),
+        time=datetime.time(0, 0, 0),
+        tzinfo=datetime.timezone.utc,
+    )
+    time_step: int = args.time_step
+
+    low = from_b36(args.start_id)
+    high = from_b36(args.end_id)
+
+    time_ranges = []
+    curr = time_first
+    while curr < time_last:
+        time_ranges.append(curr)
+        curr = add_months(curr, time_step)
+
+    if curr != time_last:
+        logger.warning("Time ranges didn't fit exactly")
+    time_ranges.append(min(curr, time_last))
+
+    logger.debug(f"{time_ranges=}")
+
+    targets = np.array([int(time.timestamp()) for time in time_ranges], dtype=np.int64)
+    cache = ProbeCache(args.cache)
+    search(cache, targets, low, high, args.rounds, args.probes)
+
+    brackets = cache.brackets(targets, low, high)
+    logger.info(bounds_str(time_ranges, brackets))
+
+    print(f"timeStart: {time_ranges[0].date()}")
+    print(f"timeStep: {time_step} # months")
+    print(f"timeRanges:")
+    unprobed = cache.num_unprobed(brackets[0], brackets[2])
+    for i, (low_id, low_time, high_id, high_time) in enumerate(zip(*brackets)):
+        if high_time == targets[i] or unprobed[i] == 0:
+            # Everything between the two is a miss, so the upper one is the first
+            # comment in this time range
+            id = high_id
+            comment = f"Time: {to_datetime(high_time)}"
+        else:
+            id = (low_id + high_id) // 2
+            comment = (
+                f"Average of {to_b36(low_id)} ({to_datetime(low_time)})"
+                f" and {to_b36(high_id)} ({to_datetime(high_time)})"
+            )
+
+        if i < len(time_ranges) - 1:
+            print(f"- start: {to_b36(id)} # {comment}")
+            print(f"  min: 200 # default")
+        else:
+            print(f"  end: {to_b36(id)} # {comment}")
 
 """
 Example output for `python find_ids.py 2008-01-01 2024-01-01 6 c020000 k000000`:
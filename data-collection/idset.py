@@ -0,0 +1,215 @@
+"""
+A compressed set of comment IDs, for remembering every ID we've ever requested.
+
+IDs are split up into chunks of 65536 by their upper bits, like in a Roaring
+bitmap. Chunks with only a few IDs in them store their lower 16 bits in a sorted
+array, and chunks with lots of IDs in them store a bitmap. Since we only request
+a tiny fraction of all IDs, most chunks are small arrays, so this takes about 2
+bytes per ID instead of a bit for every ID there is.
+"""
+
+import numpy as np
+import numpy.typing as npt
+import os
+from typing import Iterable
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+MAX_ARRAY_SIZE = 4096
+"""Chunks with more IDs than this become bitmaps (which are 8 KiB, same as an
+array of 4096 `uint16`s)"""
+
+
+class IdSet:
+    def __init__(self, ids: npt.ArrayLike = ()):
+        self._chunks: dict[int, np.ndarray] = {}
+        """Maps the upper bits of IDs to either a sorted `uint16` array of the lower
+        bits or a `uint64` bitmap"""
+        self._len = 0
+        self.add_many(ids)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, id: int) -> bool:
+        chunk = self._chunks.get(id >> CHUNK_BITS)
+        if chunk is None:
+            return False
+        low = id & (CHUNK_SIZE - 1)
+        if chunk.dtype == np.uint64:
+            return bool((chunk[low >> 6] >> np.uint64(low & 63)) & np.uint64(1))
+        i = np.searchsorted(chunk, low)
+        return i < len(chunk) and chunk[i] == low
+
+    def contains_many(self, ids: npt.ArrayLike) -> np.ndarray:
+        """Check which of the given IDs are in the set"""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        res = np.zeros(len(ids), dtype=bool)
+        for key, inds, lows in self._split(ids):
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                res[inds] = _chunk_contains(chunk, lows)
+        return res
+
+    def add_many(self, ids: npt.ArrayLike) -> np.ndarray:
+        """
+        Add the given IDs. Returns which of them were already in the set (or
+        showed up earlier in `ids`)
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        dupes = np.zeros(len(ids), dtype=bool)
+        if len(ids) == 0:
+            return dupes
+        # Anything after the first occurrence of an ID is a duplicate
+        _, first = np.unique(ids, return_index=True)
+        dupes[:] = True
+        dupes[first] = False
+
+        for key, inds, lows in self._split(ids):
+            new = ~dupes[inds]
+            chunk = self._chunks.get(key)
+            if chunk is not None:
+                present = _chunk_contains(chunk, lows)
+                dupes[inds[present]] = True
+                new &= ~present
+            lows = lows[new]
+            if len(lows) == 0:
+                continue
+            self._chunks[key] = _chunk_add(chunk, lows)
+            self._len += len(lows)
+        return dupes
+
+    def update(self, other: "IdSet"):
+        """Add all the IDs in another set"""
+        for key, chunk in other._chunks.items():
+            ours = self._chunks.get(key)
+            if ours is None:
+                self._chunks[key] = chunk.copy()
+                self._len += _chunk_len(chunk)
+            else:
+                self._len -= _chunk_len(ours)
+                merged = _chunk_add(ours, _chunk_lows(chunk))
+                self._chunks[key] = merged
+                self._len += _chunk_len(merged)
+
+    def __or__(self, other: "IdSet") -> "IdSet":
+        res = IdSet()
+        res.update(self)
+        res.update(other)
+        return res
+
+    def __and__(self, other: "IdSet") -> "IdSet":
+        res = IdSet()
+        for key, chunk in self._chunks.items():
+            if key in other._chunks:
+                lows = _chunk_lows(chunk)
+                lows = lows[_chunk_contains(other._chunks[key], lows)]
+                if len(lows) > 0:
+                    res._chunks[key] = _chunk_add(None, lows)
+                    res._len += len(lows)
+        return res
+
+    def to_array(self) -> np.ndarray:
+        """All the IDs in the set, sorted"""
+        if len(self._chunks) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(
+            [
+                (key << CHUNK_BITS) + _chunk_lows(self._chunks[key]).astype(np.int64)
+                for key in sorted(self._chunks)
+            ]
+        )
+
+    def save(self, path: str):
+        """Save to an `.npz` file"""
+        keys = np.array(sorted(self._chunks), dtype=np.int64)
+        chunks = [self._chunks[key] for key in keys]
+        is_bitmap = np.array([chunk.dtype == np.uint64 for chunk in chunks], bool)
+        # Store everything as uint16s, since bitmaps are just 4096 uint16s
+        data = [chunk.view(np.uint16) for chunk in chunks]
+        lengths = np.array([len(d) for d in data], dtype=np.int64)
+        if len(data) == 0:
+            data = [np.array([], dtype=np.uint16)]
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                keys=keys,
+                is_bitmap=is_bitmap,
+                lengths=lengths,
+                data=np.concatenate(data),
+            )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str) -> "IdSet":
+        res = IdSet()
+        with np.load(path) as f:
+            keys, is_bitmap, lengths, data = (
+                f["keys"],
+                f["is_bitmap"],
+                f["lengths"],
+                f["data"],
+            )
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        for i, key in enumerate(keys.tolist()):
+            chunk = data[bounds[i] : bounds[i + 1]].copy()
+            if is_bitmap[i]:
+                chunk = chunk.view(np.uint64)
+            res._chunks[key] = chunk
+            res._len += _chunk_len(chunk)
+        return res
+
+    def _split(
+        self, ids: np.ndarray
+    ) -> Iterable[tuple[int, np.ndarray, np.ndarray]]:
+        """Group IDs by chunk, giving the chunk key, the indices of the IDs in
+        that chunk, and their lower bits"""
+        if np.any(ids < 0):
+            raise ValueError(f"Negative IDs: {ids[ids < 0][:10]}")
+        keys = ids >> CHUNK_BITS
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.diff(sorted_keys, prepend=-1))
+        ends = np.append(starts[1:], len(ids))
+        lows = (ids & (CHUNK_SIZE - 1)).astype(np.uint16)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            inds = order[start:end]
+            yield int(sorted_keys[start]), inds, lows[inds]
+
+
+def _chunk_len(chunk: np.ndarray) -> int:
+    if chunk.dtype == np.uint64:
+        return int(np.unpackbits(chunk.view(np.uint8)).sum())
+    return len(chunk)
+
+
+def _chunk_lows(chunk: np.ndarray) -> np.ndarray:
+    """The lower bits of every ID in a chunk, sorted"""
+    if chunk.dtype == np.uint64:
+        bits = np.unpackbits(chunk.view(np.uint8), bitorder="little")
+        return np.flatnonzero(bits).astype(np.uint16)
+    return chunk
+
+
+def _chunk_contains(chunk: np.ndarray, lows: np.ndarray) -> np.ndarray:
+    if chunk.dtype == np.uint64:
+        words = chunk[lows >> 6]
+        return ((words >> (lows & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+    i = np.searchsorted(chunk, lows)
+    return chunk[np.minimum(i, len(chunk) - 1)] == lows
+
+
+def _chunk_add(chunk, lows: np.ndarray) -> np.ndarray:
+    """Add some lower bits that aren't in the chunk yet (which can be None)"""
+    if chunk is not None and chunk.dtype == np.uint64:
+        bits = np.zeros(CHUNK_SIZE, dtype=np.uint8)
+        bits[lows] = 1
+        return chunk | np.packbits(bits, bitorder="little").view(np.uint64)
+    merged = np.union1d(chunk, lows) if chunk is not None else np.unique(lows)
+    merged = merged.astype(np.uint16)
+    if len(merged) <= MAX_ARRAY_SIZE:
+        return merged
+    bits = np.zeros(CHUNK_SIZE, dtype=np.uint8)
+    bits[merged] = 1
+    return np.packbits(bits, bitorder="little").view(np.uint64)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+A fake Reddit to point the collector at (with `--api-url`), so we can see how
+fast it goes without using up our actual rate limit.
+
+It only knows `/api/v1/access_token` and `/api/info/`. Whether an ID is a hit,
+and what the comment looks like, is made up from the ID itself, so the same ID
+always gets the same comment. Rate limit headers work like Reddit's: there's a
+quota of requests per window, and once it's used up, requests get a 429 until the
+window resets.
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import orjson
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from b36 import from_b36_array, to_b36
+
+HASH_MULTIPLIER = 2654435761
+"""For turning IDs into (deterministic) random-looking numbers"""
+
+EPOCH_ID = 26151671487
+"""ID of a comment made at `EPOCH_TIME` (`c0i12v3`, the first ID in config.yaml)"""
+EPOCH_TIME = 1262304000
+SECONDS_PER_ID = 0.83
+"""Pretend comments are made at this steady a rate (roughly what 2010 was like)"""
+
+WORDS = "the of and to a in is it you that he was for on are with as i his they".split()
+
+
+def _hash(id: int, salt: int) -> float:
+    """A number in [0, 1) that only depends on the ID and the salt"""
+    return ((id * HASH_MULTIPLIER + salt * 40503) % (1 << 32)) / (1 << 32)
+
+
+def make_comment(id: int, b36_id: str) -> dict:
+    body = " ".join(WORDS[int(_hash(id, i) * len(WORDS))] for i in range(3 + id % 20))
+    return {
+        "kind": "t1",
+        "data": {
+            "id": b36_id,
+            "name": "t1_" + b36_id,
+            "created_utc": float(EPOCH_TIME + int((id - EPOCH_ID) * SECONDS_PER_ID)),
+            "subreddit": f"sub{id % 50}",
+            "author_fullname": f"t2_{to_b36(id % 100000 + 1000)}",
+            "parent_id": f"t3_{to_b36(id // 1000)}",
+            "link_id": f"t3_{to_b36(id // 1000)}",
+            "ups": id % 10,
+            "downs": 0,
+            "body": body,
+            "body_html": f'&lt;div class="md"&gt;&lt;p&gt;{body}&lt;/p&gt;&lt;/div&gt;',
+            "depth": id % 5,
+            "gilded": 0,
+            "total_awards_received": 0,
+            "collapsed": False,
+            "distinguished": None,
+        },
+    }
+
+
+class RateLimit:
+    """Reddit-style fixed-window rate limit"""
+
+    def __init__(self, quota: int, window: float):
+        self.quota = quota
+        self.window = window
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._used = 0
+
+    def take(self) -> tuple[bool, dict[str, str]]:
+        """Use up a request if there are any left. Returns whether there were, and
+        the headers to send back"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= self.window:
+                self._window_start = now
+                self._used = 0
+            allowed = self._used < self.quota
+            if allowed:
+                self._used += 1
+            reset = self.window - (now - self._window_start)
+            headers = {
+                "X-Ratelimit-Used": str(self._used),
+                "X-Ratelimit-Remaining": f"{float(self.quota - self._used):.1f}",
+                "X-Ratelimit-Reset": str(max(int(reset), 0)),
+            }
+            return allowed, headers
+
+
+class MockRedditHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    """So connections get kept alive, like with the real thing"""
+
+    # Set by `make_server`
+    hit_rate: float
+    deleted_rate: float
+    latency: float
+    jitter: float
+    rate_limit: RateLimit
+    verbose: bool
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/api/v1/access_token":
+            self._send(404, b"{}")
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        token = {
+            "access_token": "mock-token",
+            "token_type": "bearer",
+            "expires_in": 86400,
+            "scope": "*",
+        }
+        self._send(200, json.dumps(token).encode())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/api/info":
+            self._send(404, b"{}")
+            return
+
+        allowed, headers = self.rate_limit.take()
+        if not allowed:
+            self._send(429, b'{"message": "Too Many Requests", "error": 429}', headers)
+            return
+
+        if self.latency > 0 or self.jitter > 0:
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+
+        fullnames = parse_qs(url.query).get("id", [""])[0].split(",")
+        b36_ids = [fullname[3:] for fullname in fullnames if fullname.startswith("t1_")]
+        ids = from_b36_array(b36_ids).tolist()
+        children = []
+        for id, b36_id in zip(ids, b36_ids):
+            if _hash(id, 0) >= self.hit_rate:
+                continue
+            comment = make_comment(id, b36_id)
+            if _hash(id, 1) < self.deleted_rate:
+                comment["data"]["body"] = "[deleted]"
+            children.append(comment)
+        listing = {
+            "kind": "Listing",
+            "data": {"after": None, "dist": len(children), "children": children},
+        }
+        self._send(200, orjson.dumps(listing), headers)
+
+    def _send(self, status: int, body: bytes, headers: dict[str, str] = {}):
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            body = gzip.compress(body, compresslevel=5)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.verbose:
+            super().log_message(format, *args)
+
+
+def make_server(
+    port: int,
+    hit_rate: float = 0.5,
+    deleted_rate: float = 0.05,
+    latency: float = 0.2,
+    jitter: float = 0.1,
+    quota: int = 1000,
+    window: float = 600,
+    verbose: bool = False,
+) -> http.server.ThreadingHTTPServer:
+    """
+    # Arguments
+    * `hit_rate` - Fraction of IDs that come back at all
+    * `deleted_rate` - Fraction of those that come back as [deleted]
+    * `latency` - Seconds to wait before answering each `/api/info` request
+    * `jitter` - Up to this many more seconds are added to the latency at random
+    * `quota` - Requests allowed in each rate limit window
+    * `window` - Length of the rate limit window, in seconds
+    """
+    handler = type(
+        "Handler",
+        (MockRedditHandler,),
+        dict(
+            hit_rate=hit_rate,
+            deleted_rate=deleted_rate,
+            latency=latency,
+            jitter=jitter,
+            rate_limit=RateLimit(quota, window),
+            verbose=verbose,
+        ),
+    )
+    server = http.server.ThreadingHTTPServer(("localhost", port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pretend to be Reddit's /api/info")
+    parser.add_argument("--port", "-p", type=int, default=8080)
+    parser.add_argument("--hit-rate", type=float, default=0.5)
+    parser.add_argument("--deleted-rate", type=float, default=0.05)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.1, help="Extra random seconds per request"
+    )
+    parser.add_argument(
+        "--quota", type=int, default=1000, help="Requests allowed per window"
+    )
+    parser.add_argument(
+        "--window", type=float, default=600, help="Rate limit window, in seconds"
+    )
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args()
+
+    server = make_server(
+        args.port,
+        hit_rate=args.hit_rate,
+        deleted_rate=args.deleted_rate,
+        latency=args.latency,
+        jitter=args.jitter,
+        quota=args.quota,
+        window=args.window,
+        verbose=args.verbose,
+    )
+    print(f"Listening on http://localhost:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
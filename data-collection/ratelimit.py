@@ -0,0 +1,85 @@
+"""For keeping several requests in flight without going over Reddit's rate limit"""
+
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    A token bucket that gets refilled based on the rate limit headers Reddit sends
+    back (`X-Ratelimit-Remaining` and `X-Ratelimit-Reset`).
+
+    Every request takes a token. Whenever we get new headers, the refill rate is
+    set so that the requests we have left get spread out evenly until the reset.
+    Once the reset time passes, the bucket is filled back up, since we'll have a
+    whole new quota by then.
+
+    This is shared by all the threads making requests.
+    """
+
+    def __init__(self, capacity: int, initial_rate: float = 1.0):
+        """
+        # Arguments
+        * `capacity` - Most tokens the bucket can hold, i.e. the biggest burst of
+          requests we'll send at once
+        * `initial_rate` - Tokens per second to refill at until we've gotten any
+          headers back
+        """
+        self.capacity = capacity
+        self._cond = threading.Condition()
+        self._tokens = float(capacity)
+        self._rate = initial_rate
+        self._reset_at: Optional[float] = None
+        """When our quota resets (`time.monotonic()`), if we know"""
+        self._in_flight = 0
+        """Requests that have been sent but haven't been counted by Reddit yet"""
+        self._last_refill = time.monotonic()
+
+    def acquire(self):
+        """Block until we're allowed to send another request"""
+        with self._cond:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    return
+                self._cond.wait(self._time_to_next_token())
+
+    def release(self, remaining: Optional[float], reset_seconds: Optional[float]):
+        """
+        Call this once the response for a request comes back (or the request fails).
+
+        # Arguments
+        * `remaining` - Value of the `X-Ratelimit-Remaining` header, if we got one
+        * `reset_seconds` - Value of the `X-Ratelimit-Reset` header, if we got one
+        """
+        with self._cond:
+            self._in_flight -= 1
+            if remaining is not None and reset_seconds is not None:
+                self._refill()
+                reset_seconds = max(reset_seconds, 0)
+                self._reset_at = time.monotonic() + reset_seconds
+                # Requests we've already sent off aren't reflected in `remaining` yet
+                available = max(0.0, remaining - self._in_flight)
+                self._tokens = min(self._tokens, available)
+                self._rate = (available - self._tokens) / max(reset_seconds, 1)
+            self._cond.notify_all()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self._reset_at is not None and now >= self._reset_at:
+            self._tokens = float(self.capacity)
+            self._reset_at = None
+        else:
+            elapsed = now - self._last_refill
+            self._tokens = min(self.capacity, self._tokens + elapsed * self._rate)
+        self._last_refill = now
+
+    def _time_to_next_token(self) -> float:
+        """How long to wait before checking for tokens again"""
+        wait = (1 - self._tokens) / self._rate if self._rate > 0 else 1.0
+        if self._reset_at is not None:
+            wait = min(wait, self._reset_at - time.monotonic())
+        return max(wait, 0.01)
@@ -1,36 +1,34 @@
-import csv
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import datetime
 import json
 import logging
+import numpy as np
 from typing import Optional
 import os
-import praw
-import praw.models
-import praw.exceptions
-import prawcore
-import selectors
 import shutil
 import signal
-import socket
 import time
 
+from b36 import to_b36_array
 from bins import BinBinBin
+from clients import RequestFailed, make_client
 from config import CONFIG_FILE_NAME, Config
+from decode import SKIPPED_AUTOMOD, DecodedBatch, RowDecoder
+from feed import FeedServer, QueueFeed
+from idset import IdSet
+from ratelimit import TokenBucket
 import util
-from util import (
-    AUTHOR_ID,
-    AUTOMOD_ID,
-    COMMENT_COLS,
-    COMMENTS_FILE_NAME,
-    ID,
-    MISSED_FILE_NAME,
-)
-
-USER_AGENT = "GEMSTONE CYBERLAND RESEARCH"
+from util import ID, LOG_FILE_NAME
+from writers import GroupCommitter, make_writers, merge_shards, recover_run
+
 REQUEST_PER_CALL = 100
+MAX_TRIES = 3
+"""Give up on a batch after its request fails this many times"""
+RETRY_BACKOFF = 1.0
+"""Seconds to wait before retrying a batch the first time, doubled every time after"""
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
-LOG_FILE_NAME = "run.log"
 PROGRAM_DATA_FILE_NAME = "program_data.json"
 
 
@@ -38,30 +36,140 @@ def get_formatted_time():
     return time.strftime("%Y-%m-%d-%H-%M-%S")
 
 
-class ProtectedBlock:
+def load_run(
+    time_ranges: BinBinBin,
+    known: Optional[IdSet],
+    run_path: str,
+    failed: Optional[IdSet] = None,
+):
+    """
+    Add the hits, misses, and skipped IDs from a previous run to `time_ranges`,
+    add the IDs it requested to `known` (if given), and add the IDs it gave up on
+    to `failed` (if given), so they can be tried again. Runs should be loaded in
+    order, so `failed` has the ones earlier runs gave up on.
+
+    This only needs the run's checkpoint and ID sets. If it doesn't have them
+    (e.g. because it crashed), they're made from its CSVs, and saved so that we
+    don't need to read its CSVs again next time.
+    """
+    # A coordinator that crashed might not have gotten to merge its shards yet
+    merge_shards(run_path)
+    loaded_checkpoint = _load_checkpoint(time_ranges, run_path)
+    run_known = util.load_known_ids(run_path)
+    if not loaded_checkpoint or run_known is None:
+        recover_run(run_path)
+        if util.has_comments(run_path):
+            hits = IdSet(util.load_comments(run_path, columns=[ID])[ID].to_numpy())
+        else:
+            # Only wrote Parquet and crashed, so its comments are gone (see
+            # `recover_run`). They'll just get requested again
+            hits = IdSet()
+        run_known = hits, IdSet(util.load_misses(run_path))
+        if not loaded_checkpoint:
+            skipped = util.load_skipped_ids(run_path)
+            # IDs that earlier runs gave up on and this run tried again
+            retried = IdSet()
+            if failed is not None:
+                retried = failed & (run_known[0] | run_known[1] | skipped)
+            _rebuild_checkpoint(time_ranges, run_path, *run_known, skipped, retried)
+        util.save_known_ids(run_path, *run_known)
+    if known is not None:
+        for ids in run_known:
+            known.update(ids)
+    if failed is not None:
+        failed.update(util.load_failed_ids(run_path))
+
+
+def _load_checkpoint(time_ranges: BinBinBin, run_path: str) -> bool:
+    """
+    Add the hits, misses, and skipped IDs from a previous run's checkpoint.
+
+    Returns false if there's no checkpoint or it was made with different bins.
+    """
+    checkpoint = util.load_checkpoint(run_path)
+    if checkpoint is None:
+        return False
+    starts, ends = time_ranges.leaf_bounds()
+    if not (
+        np.array_equal(checkpoint["starts"], starts)
+        and np.array_equal(checkpoint["ends"], ends)
+    ):
+        return False
+    time_ranges.add_leaf_counts(
+        checkpoint["hits"], checkpoint["misses"], checkpoint["skipped"]
+    )
+    return True
+
+
+def _rebuild_checkpoint(
+    time_ranges: BinBinBin,
+    run_path: str,
+    hits: IdSet,
+    misses: IdSet,
+    skipped: IdSet,
+    retried: IdSet,
+):
+    """
+    Add the hits, misses, and skipped IDs from a previous run's IDs, and save a
+    checkpoint for that run. `retried` are the IDs that earlier runs gave up on
+    and this run tried again, which were already counted as skipped.
+
+    A run that crashed didn't get to save the IDs it skipped, so their spots in
+    the permutations get handed out again. That's fine, since the ones that were
+    already requested get skipped again (see `gems_runner._skip_known`)
     """
-    A context manager to protect a block from being interrupted by Ctrl+C.
+    hits_before, misses_before = time_ranges.leaf_counts()
+    time_ranges.notify_requested_many(hits.to_array(), True)
+    time_ranges.notify_requested_many(misses.to_array(), False)
+    hits_after, misses_after = time_ranges.leaf_counts()
+    skipped_counts = time_ranges.leaf_id_counts(skipped.to_array())
+    skipped_counts -= time_ranges.leaf_id_counts(retried.to_array())
+    zeros = np.zeros_like(skipped_counts)
+    time_ranges.add_leaf_counts(zeros, zeros, skipped_counts)
+    util.save_checkpoint(
+        run_path,
+        *time_ranges.leaf_bounds(),
+        hits_after - hits_before,
+        misses_after - misses_before,
+        skipped_counts,
+    )
+
+
+class DeferredInterrupt:
+    """
+    Holds off Ctrl+C until the runner gets to a point where it's safe to stop,
+    i.e. between batches. This is installed once for the whole run instead of
+    around every batch, since swapping signal handlers twice per batch adds up.
+
+    Pressing Ctrl+C a second time stops immediately. Whatever was half-written
+    then gets cleaned up using the journal the next time the run is loaded.
 
-    Copied from https://stackoverflow.com/a/21919644.
+    Based on https://stackoverflow.com/a/21919644.
     """
 
-    def __enter__(self):
+    def __init__(self):
         self.signal_received = None
         self.old_handler = signal.signal(signal.SIGINT, self.handler)
 
     def handler(self, sig, frame):
+        if self.signal_received is not None:
+            raise KeyboardInterrupt
         self.signal_received = (sig, frame)
 
-    def __exit__(self, _type, _value, _traceback):
-        signal.signal(signal.SIGINT, self.old_handler)
+    def check(self):
+        """If we were interrupted at some point, time to die now"""
         if self.signal_received is not None:
-            # We were interrupted at some point, time to die now
+            self.restore()
             if callable(self.old_handler):
                 self.old_handler(*self.signal_received)
             else:
                 # TODO should we even bother handling this?
                 exit(1)
 
+    def restore(self):
+        """Put back whatever handler was there before"""
+        signal.signal(signal.SIGINT, self.old_handler)
+
 
 class gems_runner:
     def __init__(
@@ -73,22 +181,72 @@ class gems_runner:
         prev_file: Optional[str],
         log_level: int,
         praw_log_level: int,
-        port: int,
+        port: Optional[int],
+        workers: int = 1,
+        output_format: str = "csv",
+        dashboard_rate: float = 4,
+        client: str = "praw",
+        extra_fields: list[str] = [],
+        sampling: str = "uniform",
+        run_dir: Optional[str] = None,
+        shard: tuple[int, int] = (0, 1),
+        progress_queue=None,
+        api_url: Optional[str] = None,
     ) -> None:
+        """
+        # Arguments
+        * `workers` - How many requests to have in flight at once
+        * `output_format` - What to write comments as (one of `writers.OUTPUT_FORMATS`)
+        * `dashboard_rate` - Most updates to send to the dashboard per second
+        * `client` - How to make requests to Reddit (one of `clients.CLIENTS`)
+        * `extra_fields` - Fields to collect on top of the usual ones (see
+          `util.EXTRA_FIELDS`)
+        * `sampling` - "uniform" to spread requests out evenly within each time
+          range, or "adaptive" to favor parts of it with higher hit rates (see
+          `TimeRange.adaptive`)
+        * `run_dir` - Where to put this run's data, if not in a new `run_$n`
+          directory. Used by shards, which go inside the coordinator's run
+          directory (which isn't loaded as a previous run)
+        * `shard` - Which shard this is and how many there are (see
+          `AbstractBin.set_shard`)
+        * `progress_queue` - If given, send progress to the coordinator through
+          this instead of running the dashboard server (`port` is ignored)
+        * `api_url` - Where to send requests instead of Reddit (see
+          `mock_reddit.py`)
+        """
         self.output_dir = output_dir
         self.client_id = client_id
         self.reddit_secret = reddit_secret
         self.time_ranges = BinBinBin(config.time_ranges)
+        self.sampling = sampling
+        for time_range in self.time_ranges.bins:
+            time_range.adaptive = sampling == "adaptive"
         self.timestamp = get_formatted_time()
-        self.sel = selectors.DefaultSelector()
 
         # Open files and directores loading data from there
         if not os.path.isdir(output_dir):
             os.mkdir(output_dir)  # make output directory if it dose not exits
 
-        curr_run = self.load_prev_runs(prev_file)
-
-        self.run_dir = os.path.join(output_dir, f"run_{curr_run}")
+        self.known = IdSet()
+        """Every ID that's been requested, by previous runs or this one"""
+        self._run_hits = IdSet()
+        self._run_misses = IdSet()
+        self._run_skipped = IdSet()
+        self._run_failed = IdSet()
+        """IDs this run gave up on because their requests kept failing"""
+        prev_failed = IdSet()
+        curr_run = self.load_prev_runs(prev_file, run_dir, prev_failed)
+        self._prev_counts = self.time_ranges.leaf_counts()
+        """Hits and misses per `PermBin` from before this run, for the checkpoint"""
+        self._prev_skipped = self.time_ranges.leaf_skipped()
+        """Skipped IDs per `PermBin` from before this run, for the checkpoint"""
+        shard_index, num_shards = shard
+        if num_shards > 1:
+            self.time_ranges.set_shard(shard_index, num_shards)
+
+        if run_dir is None:
+            run_dir = os.path.join(output_dir, f"run_{curr_run}")
+        self.run_dir = run_dir
         """Where all the data for this run goes"""
         os.mkdir(self.run_dir)
 
@@ -96,46 +254,57 @@ class gems_runner:
         self.logger = self._init_logging("gems_runner", log_level, praw_log_level)
         self.logger.info("Logging started")
 
-        # Come back and fix this
-        # TODO wait fix what?
-        comments_path = os.path.join(self.run_dir, COMMENTS_FILE_NAME)
-
-        self.main_csv_f = open(comments_path, "w")
-        self.main_csv = csv.writer(self.main_csv_f)
-        self.main_csv.writerow(COMMENT_COLS)
-
-        missed_path = os.path.join(self.run_dir, MISSED_FILE_NAME)
-        self.missed_comments_file = open(missed_path, "w")
-        """Store IDs of comments that Reddit didn't return any info for"""
+        self.committer = GroupCommitter(
+            make_writers(output_format, self.run_dir, extra_fields), self.run_dir
+        )
+        """Writes comments and misses out in groups of batches"""
 
         # Store the config for each run so that we can ensure that new runs are
         # compatible with previous ones
         # TODO actually check that new runs are compatible with previous runs
         shutil.copyfile(config.path, os.path.join(self.run_dir, CONFIG_FILE_NAME))
 
-        # Start reddit
-        self.reddit = praw.Reddit(
-            client_id=self.client_id,
-            client_secret=self.reddit_secret,
-            user_agent=USER_AGENT,
+        self.client = make_client(client, client_id, reddit_secret, workers, api_url)
+        """What we use to talk to Reddit"""
+        self.decoder = RowDecoder(extra_fields)
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="request"
         )
+        self.rate_limiter = TokenBucket(capacity=workers)
+        self._pending: deque[tuple[int, list[int], int, Future]] = deque()
+        """Batches that have been sent off (with how many times they've been tried),
+        in the order they were requested"""
+        self._retry: deque[tuple[list[int], int]] = deque()
+        """Batches whose requests failed and need to be sent again, and how many
+        times they've been tried"""
+        self._num_batches = 0
+        self._retry_failed(prev_failed, shard)
+
+        if progress_queue is not None:
+            self.feed = QueueFeed(progress_queue)
+        else:
+            assert port is not None, "Need a port for the dashboard"
+            self.feed = FeedServer(port, self.time_ranges, dashboard_rate, self.logger)
 
-        server_sock = socket.socket()
-        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_sock.bind(("localhost", port))
-        server_sock.listen(100)
-        server_sock.setblocking(False)
-        self.sel.register(server_sock, selectors.EVENT_READ, False)
+        self.interrupt = DeferredInterrupt()
 
         self.logger.info("init complete")
 
-    def load_prev_runs(self, prev_file: Optional[str]):
+    def load_prev_runs(
+        self,
+        prev_file: Optional[str],
+        run_dir: Optional[str] = None,
+        failed: Optional[IdSet] = None,
+    ):
         """
         Load previous runs.
 
-        If prev_file is given, loads the number of hits and misses for each bin from
-        there. Otherwise, loads all previous runs to get the same info. The latter
-        is less dangerous in case the bins change.
+        If prev_file is given, loads the number of hits, misses, and skipped IDs
+        for each bin from there. Otherwise, loads all previous runs to get the same
+        info. The latter is less dangerous in case the bins change. If `run_dir` is
+        inside one of the runs, that run isn't loaded, since it's the one we're in.
+        The IDs previous runs gave up on are added to `failed` (if given).
         Returns the current run number.
         """
         if prev_file is not None:
@@ -156,59 +325,61 @@ class gems_runner:
                         )
                     hits = data.get("hits", [])
                     misses = data.get("misses", [])
-                    if len(time_bin.bins) != len(hits) or len(time_bin.bins) != len(
-                        misses
+                    # Older program data didn't keep track of skipped IDs
+                    skipped = data.get("skipped", [0] * len(hits))
+                    if any(
+                        len(time_bin.bins) != len(counts)
+                        for counts in (hits, misses, skipped)
                     ):
                         raise Exception(
-                            f"Expected {len(time_bin.bins)} hits and misses"
-                            f", program data for {start_date} contained"
-                            f" {len(hits)} hits and {len(misses)} misses"
+                            f"Expected {len(time_bin.bins)} hits, misses, and"
+                            f" skipped, program data for {start_date} contained"
+                            f" {len(hits)} hits, {len(misses)} misses, and"
+                            f" {len(skipped)} skipped"
                         )
-                    for bin, num_hits, num_misses in zip(time_bin.bins, hits, misses):
-                        # todo modifying private fields sucks but I don't care at the moment
-                        bin._hits += num_hits
-                        bin._misses += num_misses
+                    for bin, num_hits, num_misses, num_skipped in zip(
+                        time_bin.bins, hits, misses, skipped
+                    ):
+                        bin.add_requested(num_hits, num_misses)
+                        bin.add_skipped(num_skipped)
             return 0
 
         prev_runs = util.get_runs()
+        if run_dir is not None:
+            prev_runs = {
+                run_num: run_path
+                for run_num, run_path in prev_runs.items()
+                if not os.path.abspath(run_dir).startswith(
+                    os.path.abspath(run_path) + os.sep
+                )
+            }
         prev_run_nums = sorted(list(prev_runs.keys()))
         if len(prev_run_nums) == 0:
             # This is the first run
             return 0
         else:
             assert len(prev_run_nums) == max(prev_run_nums) + 1, "Missing run detected"
-            for run_path in prev_runs.values():
-                comments = util.load_comments(run_path)
-                comments[ID].apply(
-                    lambda id: self.time_ranges.notify_requested(id, True)
-                )
-                del comments
-                misses = util.load_misses(run_path)
-                for id in misses:
-                    self.time_ranges.notify_requested(id, False)
+            for run_num in prev_run_nums:
+                load_run(self.time_ranges, self.known, prev_runs[run_num], failed)
             return len(prev_run_nums)
 
-    def accept(self, sock: socket.socket):
-        """Accept a new connection"""
-        conn, addr = sock.accept()
-        self.logger.info(f"Accepted connection from {addr}")
-        conn.setblocking(False)
-        self.sel.register(conn, selectors.EVENT_READ, True)
-
-    def read(self, conn: socket.socket):
-        """Receive a message from the dashboard. We're not actually using this yet,
-        but we might want to allow stopping the server from the dashboard at some point
+    def _retry_failed(self, failed: IdSet, shard: tuple[int, int]):
         """
-        try:
-            data = conn.recv(1)
-        except:
-            self.remove_conn(conn)
-            return
-        if not data:
-            self.remove_conn(conn)
+        Queue up the IDs that previous runs gave up on to be tried again, unless
+        they've been requested since. With more than one shard, each one takes the
+        IDs that are its index mod the number of shards.
+        """
+        ids = failed.to_array()
+        ids = ids[~self.known.contains_many(ids)]
+        shard_index, num_shards = shard
+        ids = ids[ids % num_shards == shard_index]
+        if len(ids) == 0:
             return
-
-        self.logger.warn(f"Got {data!r} from {conn}, I don't know what to do with it")
+        self.logger.info(f"Retrying {len(ids)} IDs that previous runs gave up on")
+        self.time_ranges.notify_retrying_many(ids)
+        self.known.add_many(ids)
+        for start in range(0, len(ids), REQUEST_PER_CALL):
+            self._retry.append((ids[start : start + REQUEST_PER_CALL].tolist(), 0))
 
     def create_err(self, err_msg: str, logger: logging.Logger):
         """logs error and kills program
@@ -262,157 +433,185 @@ class gems_runner:
 
         return logger
 
-    def request_batch(self, id_ints: list[int]):
+    def request_batch(self, i: int, id_ints: list[int], tries: int = 0) -> DecodedBatch:
         """
-        Requests the given IDs in a single API call.
+        Requests the given IDs in a single API call and decodes the response. This
+        runs on one of the executor's threads, so it must not touch the bins or the
+        output files.
 
-        Make sure that there are no more than `REQUEST_PER_CALL` (100) of them
+        Make sure that there are no more than `REQUEST_PER_CALL` (100) of them.
+        Raises `RequestFailed` if the request failed. If this batch has been tried
+        before (`tries` times), waits a bit first.
         """
-        i = None  # TODO idk what to assign to this
-        self.logger.debug(f"Attempting group {i} of size {REQUEST_PER_CALL}")
-        ids = [util.to_b36(int(id)) for id in id_ints]
-
+        self.logger.debug(f"Attempting group {i} of size {len(id_ints)}")
+        fullnames = ["t1_" + id for id in to_b36_array(id_ints)]
+        if tries > 0:
+            time.sleep(RETRY_BACKOFF * 2 ** (tries - 1))
+
+        self.rate_limiter.acquire()
+        start = time.monotonic()
+        remaining = reset_seconds = None
         try:
-            ret = self.reddit.request(
-                method="GET",
-                path="api/info/",
-                params={"id": ",".join("t1_" + id for id in ids)},
-            )
-        except prawcore.exception.ServerError as e:
-            self.logger.error(f"Prawcore error: "{e})
-            self.logger.error(f"Batch {i} of size {REQUEST_PER_CALL}")
-            self.logger.error("Skipping to next batch")
-            return
-        except praw.exceptions.PRAWException as e:
-            self.logger.error(f"Praw error: {e}")
-            self.logger.error(
-                f"Praw through a exeception in batch {i} of size {REQUEST_PER_CALL}"
+            resp = self.client.info(fullnames)
+            remaining, reset_seconds = resp.remaining, resp.reset_seconds
+        except RequestFailed as e:
+            remaining, reset_seconds = e.remaining, e.reset_seconds
+            raise
+        finally:
+            self.rate_limiter.release(remaining, reset_seconds)
+            self.feed.record_latency(time.monotonic() - start)
+
+        return self.decoder.decode(resp.children)
+
+    def process_batch(self, i: int, id_ints: list[int], batch: DecodedBatch):
+        """
+        Record the results of a batch requested by `request_batch` and write them
+        out. Only ever called from the main thread, in the order the batches were
+        requested.
+        """
+        for id, reason in batch.skipped:
+            level = logging.DEBUG if reason == SKIPPED_AUTOMOD else logging.INFO
+            self.logger.log(level, f"Comment {id} {reason}")
+
+        id_ints = np.asarray(id_ints, dtype=np.int64)
+        hits = np.isin(id_ints, batch.hit_ids)
+        if np.count_nonzero(hits) != len(batch.hit_ids):
+            raise Exception(f"Got comments we didn't ask for in batch {i}")
+
+        self.committer.add(batch.rows, list(to_b36_array(id_ints[~hits])))
+        self.time_ranges.notify_requested_many(id_ints, hits)
+        self._run_hits.add_many(id_ints[hits])
+        self._run_misses.add_many(id_ints[~hits])
+        self.feed.record_batch(id_ints, hits)
+
+        self.logger.debug(f"Completed group {i} of size {len(id_ints)}")
+
+    def _fill_pipeline(self):
+        """Send off more batches until there are `self.workers` of them in flight"""
+        while len(self._pending) < self.workers and self.time_ranges.needed > 0:
+            tries = 0
+            if len(self._retry) > 0:
+                next_ids, tries = self._retry.popleft()
+            else:
+                next_ids = self.time_ranges.next_ids(REQUEST_PER_CALL)
+                if len(next_ids) == 0:
+                    break
+                next_ids = self._skip_known(next_ids)
+                if len(next_ids) == 0:
+                    continue
+            i = self._num_batches
+            self._num_batches += 1
+            self.logger.debug(
+                f"Requesting {len(next_ids)}: {','.join(to_b36_array(next_ids))}"
             )
-            return
+            future = self.executor.submit(self.request_batch, i, next_ids, tries)
+            self._pending.append((i, next_ids, tries, future))
+
+    def _skip_known(self, ids: list[int]) -> list[int]:
+        """Get rid of IDs that were already requested, which can happen if another
+        collector requested them in parallel and its runs were merged into ours"""
+        id_arr = np.asarray(ids, dtype=np.int64)
+        already_known = self.known.add_many(id_arr)
+        if not np.any(already_known):
+            return ids
+        self.logger.warning(
+            f"Skipping {np.count_nonzero(already_known)} IDs that were already requested"
+        )
+        self.time_ranges.notify_skipped_many(id_arr[already_known])
+        self._run_skipped.add_many(id_arr[already_known])
+        return id_arr[~already_known].tolist()
 
-        comments = ret["data"]["children"]
+    def _finish_batch(self) -> None:
+        """Wait for the oldest batch in flight and process it"""
+        i, ids, tries, future = self._pending.popleft()
+        try:
+            batch = future.result()
+        except RequestFailed as e:
+            self.logger.error(str(e))
+            self.logger.error(f"Batch {i} of size {len(ids)}")
+            tries += 1
+            if not e.retryable:
+                self.logger.error("Skipping this batch, retrying won't help")
+            elif tries < MAX_TRIES:
+                self.logger.error("Will retry this batch")
+                self._retry.append((ids, tries))
+                return
+            else:
+                self.logger.error(f"Skipping this batch after {tries} tries")
+            self._give_up(ids)
+            return
+        self.process_batch(i, ids, batch)
 
-        misses = set(id_ints)
-        rows = []
-        for comment in comments:
-            try:
-                data = comment["data"]
-                id = data["id"]
-                body = data["body"]
-                author_id = data.get("author_fullname") or ""
-                author_id = author_id.removeprefix("t2_")
-                if author_id == AUTOMOD_ID:
-                    self.logger.debug(f"Comment {id} is by automod, skipping")
-                    continue
-                if len(body) == 0:
-                    # Consider an empty comment a miss
-                    self.logger.info(f"Comment {id} was empty")
-                    continue
-                if body == "[removed]" or body == "[deleted]":
-                    # Consider a deleted comment a miss
-                    self.logger.info(f"Comment {id} was {body}")
-                    continue
-                fields = [
-                    id,
-                    int(data["created_utc"]),
-                    data["subreddit"],
-                    author_id,
-                    data["parent_id"],
-                    data["link_id"],
-                    data["ups"],
-                    data["downs"],
-                    util.multiline_to_csv(body),
-                ]
-                rows.append(fields)
-                for col_name, field in zip(COMMENT_COLS, fields):
-                    assert field is not None, col_name
-                    if col_name != AUTHOR_ID:
-                        assert field != "", col_name
-                id_int = int(id, 36)
-                self.time_ranges.notify_requested(id_int, True)
-                misses.remove(id_int)
-            except:
-                raise Exception(f"Got exception while processing {comment}")
-
-        # We write these at the end to avoid writing some rows and then having to error
-        self.main_csv.writerows(rows)
-        for id in misses:
-            self.time_ranges.notify_requested(id, False)
-            self.missed_comments_file.write(f"{util.to_b36(id)}\n")
-
-        self.main_csv_f.flush()
-
-        self.logger.debug(f"Completed group {i} of size {REQUEST_PER_CALL}")
+    def _give_up(self, ids: list[int]):
+        """Skip IDs whose requests kept failing. They're saved to the run's
+        `failed-ids.npz`, so the next run tries them again"""
+        self.time_ranges.notify_skipped_many(ids)
+        self._run_skipped.add_many(ids)
+        self._run_failed.add_many(ids)
 
     def run_step(self) -> bool:
         # TODO figure out how to use tqdm with this
-        if self.time_ranges.needed == 0:
+        self._fill_pipeline()
+        if len(self._pending) == 0:
             self.logger.info(
                 "Done! Got minimum number of comments for every time range"
             )
             self.logger.info(self.time_ranges.bins)
             return False
-        next_ids = self.time_ranges.next_ids(REQUEST_PER_CALL)
-        self.logger.debug(
-            f"Requesting {len(next_ids)}: {','.join(map(util.to_b36, next_ids))}"
-        )
 
-        with ProtectedBlock():
-            self.request_batch(next_ids)
-
-        # Send updates to dashboard client(s)
-        header = b"Date,Min,Hits,Misses"
-        rows = [
-            f"{bin.start_date},{bin.min},{bin.hits},{bin.misses}".encode()
-            for bin in self.time_ranges.bins
-        ]
-        msg = header + b"\n" + b"\n".join(rows)
-        for fd in list(self.sel.get_map()):
-            key = self.sel.get_key(fd)
-            if key.data:  # Is a client socket, not the server socket
-                conn: socket.socket = key.fileobj  # type: ignore
-                try:
-                    conn.setblocking(False)
-                    conn.send(msg)
-                except:
-                    self.remove_conn(conn)
-
-        events = self.sel.select(0)
-        for key, _mask in events:
-            is_client = key.data
-            if is_client:
-                # This isn't necessary yet, but at some point, we might want to
-                # receive messages from the dashboard
-                self.read(key.fileobj)  # type: ignore
-            else:
-                self.accept(key.fileobj)  # type: ignore
-        return True
+        self._finish_batch()
 
-    def remove_conn(self, conn: socket.socket):
-        self.logger.info(f"Closing {conn}")
-        self.sel.unregister(conn)
-        conn.close()
+        self.feed.poll()
+        self.interrupt.check()
+        return True
 
     def close(self):
-        """Closes all open files."""
-        self.main_csv_f.close()
-        self.missed_comments_file.close()
-
-        program_data = {
-            "timestamp": self.timestamp,
-            "time_ranges": {
-                str(time_range.start_date): {
-                    "hits": [bin.hits for bin in time_range.bins],
-                    "misses": [bin.misses for bin in time_range.bins],
-                }
-                for time_range in self.time_ranges.bins
-            },
-        }
-        with open(
-            os.path.join(self.run_dir, PROGRAM_DATA_FILE_NAME), "w"
-        ) as program_data_f:
-            json.dump(program_data, program_data_f, indent=2)
-
-        for fd in list(self.sel.get_map()):
-            key = self.sel.get_key(fd)
-            self.remove_conn(key.fileobj)  # type: ignore
+        """Waits for any requests still in flight, then closes all open files."""
+        try:
+            try:
+                while len(self._pending) > 0:
+                    self._finish_batch()
+            finally:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            # Never got to these, so leave them for the next run
+            while len(self._retry) > 0:
+                self._give_up(self._retry.popleft()[0])
+
+            self.committer.close()
+
+            self.feed.poll(force=True)
+            self.feed.close()
+
+            program_data = {
+                "timestamp": self.timestamp,
+                "sampling": self.sampling,
+                "time_ranges": {
+                    str(time_range.start_date): {
+                        "hits": [bin.hits for bin in time_range.bins],
+                        "misses": [bin.misses for bin in time_range.bins],
+                        "skipped": [bin.skipped for bin in time_range.bins],
+                    }
+                    for time_range in self.time_ranges.bins
+                },
+            }
+            with open(
+                os.path.join(self.run_dir, PROGRAM_DATA_FILE_NAME), "w"
+            ) as program_data_f:
+                json.dump(program_data, program_data_f, indent=2)
+
+            hits, misses = self.time_ranges.leaf_counts()
+            prev_hits, prev_misses = self._prev_counts
+            util.save_checkpoint(
+                self.run_dir,
+                *self.time_ranges.leaf_bounds(),
+                hits - prev_hits,
+                misses - prev_misses,
+                self.time_ranges.leaf_skipped() - self._prev_skipped,
+            )
+            util.save_known_ids(self.run_dir, self._run_hits, self._run_misses)
+            util.save_skipped_ids(self.run_dir, self._run_skipped)
+            util.save_failed_ids(self.run_dir, self._run_failed)
+        finally:
+            # Even if saving failed, so Ctrl+C works normally again
+            self.interrupt.restore()
+
@@ -0,0 +1,79 @@
+"""
+Deterministic pseudorandom orderings of ID ranges that never get materialized.
+
+`PermBin`s used to shuffle all of their IDs with NumPy every time they were asked
+for more, which meant allocating a million-element array just to grab a few IDs.
+`IdPermutation` gives the same kind of shuffled, non-repeating order, but it can
+compute the ID at any position directly.
+"""
+
+import numpy as np
+
+NUM_ROUNDS = 4
+"""Number of Feistel rounds. 4 is plenty for shuffling, we're not doing crypto"""
+
+_MUL_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MUL_2 = np.uint64(0x94D049BB133111EB)
+_SHIFT_1 = np.uint64(30)
+_SHIFT_2 = np.uint64(27)
+_SHIFT_3 = np.uint64(31)
+
+
+class IdPermutation:
+    """
+    A pseudorandom bijection from positions `0..end - start` to IDs in
+    `range(start, end)`.
+
+    This is a small Feistel network over the smallest even number of bits that
+    covers the range. Anything that lands outside the range gets encrypted again
+    ("cycle walking") until it lands inside, which keeps it a bijection. The keys
+    only depend on `start` and `end`, so the ID at a given position is always the
+    same no matter when (or in which run) it's asked for.
+    """
+
+    def __init__(self, start: int, end: int):
+        """
+        # Arguments
+        * `start` - First ID in this range (inclusive)
+        * `end` - End of this range (exclusive)
+        """
+        assert start < end, f"Empty range {start}-{end}"
+        self.start = start
+        self.size = end - start
+        half_bits = max(1, ((self.size - 1).bit_length() + 1) // 2)
+        self._half_bits = np.uint64(half_bits)
+        self._half_mask = np.uint64((1 << half_bits) - 1)
+        self._keys = np.random.default_rng(seed=[start, end]).integers(
+            0, 2**64, size=NUM_ROUNDS, dtype=np.uint64, endpoint=False
+        )
+
+    def take(self, offset: int, n: int, step: int = 1) -> np.ndarray:
+        """
+        Get the IDs at n positions starting at `offset`, `step` apart (or fewer,
+        if that goes past the end of the range)
+        """
+        stop = min(offset + n * step, self.size)
+        if offset >= stop:
+            return np.empty(0, dtype=np.uint64)
+        x = self._encrypt(np.arange(offset, stop, step, dtype=np.uint64))
+        size = np.uint64(self.size)
+        outside = np.flatnonzero(x >= size)
+        while len(outside) > 0:
+            x[outside] = self._encrypt(x[outside])
+            outside = outside[x[outside] >= size]
+        return x + np.uint64(self.start)
+
+    def _encrypt(self, x: np.ndarray) -> np.ndarray:
+        left = x >> self._half_bits
+        right = x & self._half_mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self._half_bits) | right
+
+    def _round(self, x: np.ndarray, key: np.uint64) -> np.ndarray:
+        """Round function (SplitMix64's finalizer, truncated to half a block)"""
+        x = x ^ key
+        x = (x ^ (x >> _SHIFT_1)) * _MUL_1
+        x = (x ^ (x >> _SHIFT_2)) * _MUL_2
+        x = x ^ (x >> _SHIFT_3)
+        return x & self._half_mask
@@ -1,17 +1,28 @@
 import configparser
-from datetime import datetime
 from glob import glob
 import numpy as np
 import os
 import pandas as pd
 import praw
 import praw.models
+import pyarrow as pa
+import pyarrow.parquet as pq
 import re
 import sys
 from typing import Any, Optional
 
+from b36 import from_b36_array
+from idset import IdSet
+
 COMMENTS_FILE_NAME = "comments.csv"
+COMMENTS_PARQUET_FILE_NAME = "comments.parquet"
 MISSED_FILE_NAME = "missed-ids.txt"
+CHECKPOINT_FILE_NAME = "checkpoint.npz"
+HIT_IDS_FILE_NAME = "hit-ids.npz"
+MISSED_IDS_FILE_NAME = "missed-ids.npz"
+SKIPPED_IDS_FILE_NAME = "skipped-ids.npz"
+FAILED_IDS_FILE_NAME = "failed-ids.npz"
+LOG_FILE_NAME = "run.log"
 
 AUTOMOD_ID = "6l4z3"
 """ID of automod user (base 36, not int)"""
@@ -22,11 +33,6 @@ out_dir = os.path.join(_curr_dir, "out")
 """The directory in which all the runs are"""
 
 
-def to_b36(id: int) -> str:
-    """Get the base 36 repr of an ID to pass to Reddit or store"""
-    return np.base_repr(id, 36).lower()
-
-
 def get_runs() -> dict[int, str]:
     """Get the path to each run, mapped from the run number"""
 
@@ -36,29 +42,98 @@ def get_runs() -> dict[int, str]:
     }
 
 
-def load_comments(*paths: str) -> pd.DataFrame:
+def has_comments(run_path: str) -> bool:
+    return any(
+        os.path.exists(os.path.join(run_path, file_name))
+        for file_name in (COMMENTS_FILE_NAME, COMMENTS_PARQUET_FILE_NAME)
+    )
+
+
+def load_comments(*paths: str, columns: Optional[list[str]] = None) -> pd.DataFrame:
     """
-    Load multiple CSVs with comment data into a single dataframe
+    Load multiple CSV or Parquet files with comment data into a single dataframe
+
+    For each path, if it's a file, load that file. If it's a folder, load
+    "folder/comments.parquet" if there is one and it can be read, otherwise
+    "folder/comments.csv".
 
-    For each path, if it's a file, load that file. If it's a folder, load "folder/comments.csv"
+    If `columns` is given, only those columns are loaded. Parquet files don't
+    even have to read the others.
+
+    Note that bodies from CSVs have newlines escaped (see `multiline_to_csv`,
+    and `csv_to_multiline` to undo it), while bodies from Parquet files are
+    exactly what Reddit gave us.
     """
     dfs = []
     for path in paths:
         if os.path.isdir(path):
-            path = os.path.join(path, COMMENTS_FILE_NAME)
+            parquet_path = os.path.join(path, COMMENTS_PARQUET_FILE_NAME)
+            csv_path = os.path.join(path, COMMENTS_FILE_NAME)
+            # If the collector crashed, the Parquet file can't be read, but the
+            # CSV (if there is one) is fine
+            if os.path.exists(parquet_path) and (
+                not os.path.exists(csv_path) or is_readable_parquet(parquet_path)
+            ):
+                path = parquet_path
+            else:
+                path = csv_path
         if not os.path.exists(path):
             raise FileNotFoundError(path)
 
-        dfs.append(pd.read_csv(path))
+        if path.endswith(".parquet"):
+            dfs.append(_read_comments_parquet(path, columns))
+        else:
+            df = pd.read_csv(
+                path,
+                usecols=columns,
+                dtype=_CSV_DTYPES,
+                # Only a missing author should be NaN. Someone could totally
+                # comment "NaN", and that should stay a string
+                keep_default_na=False,
+                na_values={
+                    AUTHOR_ID: [""],
+                    # Extra fields can be missing too
+                    **{field: [""] for field in EXTRA_FIELDS},
+                },
+            )
+            if ID in df:
+                df[ID] = from_b36_array(df[ID].to_numpy())
+            dfs.append(df)
 
     df = pd.concat(dfs, axis=0, ignore_index=True)
-    df[BODY] = df[BODY].apply(str)
-    df[ID] = df[ID].apply(lambda id: int(str(id), 36))
-    df[TIME] = df[TIME].map(lambda ts: datetime.fromtimestamp(ts))
-    df = sort_comments(df)
+    if BODY in df:
+        df[BODY] = df[BODY].astype(str)
+    if TIME in df:
+        df[TIME] = pd.to_datetime(df[TIME], unit="s")
+    if ID in df:
+        df = sort_comments(df)
     return df
 
 
+def is_readable_parquet(path: str) -> bool:
+    """
+    Whether a Parquet file was closed properly. One that was still being written
+    when the collector crashed doesn't have a footer, so it can't be read at all
+    """
+    try:
+        pq.read_metadata(path)
+        return True
+    except (pa.ArrowInvalid, OSError):
+        return False
+
+
+def _read_comments_parquet(path: str, columns: Optional[list[str]]) -> pd.DataFrame:
+    """Read a comments.parquet file, with the time as a Unix timestamp (like in
+    the CSVs) so both kinds of files can be handled the same way afterwards"""
+    table = pq.read_table(path, columns=columns)
+    if TIME in table.column_names:
+        i = table.column_names.index(TIME)
+        # Parquet might've stored it as milliseconds, so go through seconds first
+        seconds = table[TIME].cast(pa.timestamp("s", tz="UTC")).cast(pa.int64())
+        table = table.set_column(i, TIME, seconds)
+    return table.to_pandas()
+
+
 def sort_comments(df: pd.DataFrame) -> pd.DataFrame:
     return df.sort_values([ID]).reset_index(drop=True)
 
@@ -76,8 +151,139 @@ def load_misses(*paths: str) -> pd.Series:
         if not os.path.exists(path):
             raise FileNotFoundError(path)
         with open(path, "r") as f:
-            misses.extend(int(id, 36) for id in f.readlines())
-    return pd.Series(misses).sort_values()
+            misses.append(from_b36_array(f.read().split()))
+    if len(misses) == 0:
+        # np.concatenate can't handle an empty list
+        return pd.Series([], dtype=np.int64)
+    return pd.Series(np.concatenate(misses), dtype=np.int64).sort_values()
+
+
+def load_checkpoint(run_path: str) -> Optional[dict[str, np.ndarray]]:
+    """
+    Load the checkpoint for a run (None if it doesn't have one).
+
+    The checkpoint has the start and end ID of every `PermBin`, along with the
+    number of hits and misses that run got in each of them, and how many IDs it
+    skipped in each of them (under the keys "starts", "ends", "hits", "misses",
+    and "skipped")
+    """
+    path = os.path.join(run_path, CHECKPOINT_FILE_NAME)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as checkpoint:
+        loaded = {key: checkpoint[key] for key in checkpoint.files}
+    # Older checkpoints didn't keep track of skipped IDs
+    loaded.setdefault("skipped", np.zeros_like(loaded["hits"]))
+    return loaded
+
+
+def save_checkpoint(
+    run_path: str,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    hits: np.ndarray,
+    misses: np.ndarray,
+    skipped: np.ndarray,
+):
+    """Save a run's checkpoint (see `load_checkpoint`)"""
+    path = os.path.join(run_path, CHECKPOINT_FILE_NAME)
+    # Write to a temporary file first so we never leave half a checkpoint behind
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f, starts=starts, ends=ends, hits=hits, misses=misses, skipped=skipped
+        )
+    os.replace(tmp_path, path)
+
+
+def load_known_ids(run_path: str) -> Optional[tuple[IdSet, IdSet]]:
+    """
+    Load the sets of IDs a run got hits and misses for (None if it doesn't have
+    them, e.g. because it crashed). These have the same IDs as its CSVs, but can
+    be loaded and merged way faster
+    """
+    hits_path = os.path.join(run_path, HIT_IDS_FILE_NAME)
+    misses_path = os.path.join(run_path, MISSED_IDS_FILE_NAME)
+    if not (os.path.exists(hits_path) and os.path.exists(misses_path)):
+        return None
+    return IdSet.load(hits_path), IdSet.load(misses_path)
+
+
+def save_known_ids(run_path: str, hits: IdSet, misses: IdSet):
+    """Save the sets of IDs a run got hits and misses for (see `load_known_ids`)"""
+    hits.save(os.path.join(run_path, HIT_IDS_FILE_NAME))
+    misses.save(os.path.join(run_path, MISSED_IDS_FILE_NAME))
+
+
+def load_skipped_ids(run_path: str) -> IdSet:
+    """
+    Load the set of IDs a run handed out but never requested (see
+    `bins.AbstractBin.notify_skipped_many`). Empty if it doesn't have one, e.g.
+    because it crashed
+    """
+    path = os.path.join(run_path, SKIPPED_IDS_FILE_NAME)
+    if not os.path.exists(path):
+        return IdSet()
+    return IdSet.load(path)
+
+
+def save_skipped_ids(run_path: str, skipped: IdSet):
+    """Save the set of IDs a run skipped (see `load_skipped_ids`)"""
+    skipped.save(os.path.join(run_path, SKIPPED_IDS_FILE_NAME))
+
+
+def load_failed_ids(run_path: str) -> IdSet:
+    """
+    Load the set of IDs a run skipped because their requests kept failing, so
+    they can be tried again. Empty if it doesn't have one
+    """
+    path = os.path.join(run_path, FAILED_IDS_FILE_NAME)
+    if not os.path.exists(path):
+        return IdSet()
+    return IdSet.load(path)
+
+
+def save_failed_ids(run_path: str, failed: IdSet):
+    """Save the set of IDs a run gave up on (see `load_failed_ids`)"""
+    failed.save(os.path.join(run_path, FAILED_IDS_FILE_NAME))
+
+
+def sampling_weights(ids: np.ndarray, *run_paths: str) -> np.ndarray:
+    """
+    Weight for each of the given comment IDs, for turning what we collected back
+    into something like a uniform sample of all the IDs: the number of IDs in the
+    `PermBin` it's from over the number we requested from that `PermBin`. Uses
+    the checkpoints of the given runs, which should be every run the comments
+    came from.
+
+    Every ID in a `PermBin` is equally likely to be requested, but in adaptive
+    mode some `PermBin`s get requested a lot more than others, so weighting each
+    comment by this gets back to something like a uniform sample.
+
+    Only matters if some of the runs used adaptive sampling. Otherwise, the
+    weights within a time range are all pretty much the same.
+    """
+    starts = ends = None
+    requested = 0
+    for run_path in run_paths:
+        checkpoint = load_checkpoint(run_path)
+        if checkpoint is None:
+            raise FileNotFoundError(
+                f"No checkpoint in {run_path}, run the collector again to make one"
+            )
+        if starts is None:
+            starts, ends = checkpoint["starts"], checkpoint["ends"]
+        elif not np.array_equal(starts, checkpoint["starts"]):
+            raise ValueError(f"{run_path} used different bins from the other runs")
+        requested = requested + checkpoint["hits"] + checkpoint["misses"]
+    assert starts is not None and ends is not None, "No runs given"
+
+    ids = np.asarray(ids, dtype=np.int64)
+    inds = np.searchsorted(starts, ids, side="right") - 1
+    if np.any(inds < 0) or np.any(ids >= ends[np.maximum(inds, 0)]):
+        raise ValueError("Some of the IDs aren't in any of the bins")
+    weights = (ends - starts) / np.maximum(requested, 1)
+    return weights[inds]
 
 
 def init_reddit() -> praw.Reddit:
@@ -152,6 +358,19 @@ def multiline_to_csv(s: str) -> str:
     )
 
 
+ESCAPED_NEWLINE_RE = re.compile(r"\\(\\?)n")
+"""A newline or a literal "\\n" escaped by `multiline_to_csv`"""
+
+
+def csv_to_multiline(s: str) -> str:
+    """
+    Undo `multiline_to_csv`
+
+    Replace "\\n" with newlines, and "\\\\n" with a literal "\\n"
+    """
+    return ESCAPED_NEWLINE_RE.sub(lambda m: r"\n" if m.group(1) else "\n", s)
+
+
 # Column names
 ID = "id"
 """Column for comment ID"""
@@ -182,6 +401,32 @@ COMMENT_COLS = [
 ]
 
 
+EXTRA_FIELDS = {
+    "depth": int,
+    "gilded": int,
+    "total_awards_received": int,
+    "collapsed": bool,
+    "distinguished": str,
+    "body_html": str,
+}
+"""Other fields that can be collected along with `COMMENT_COLS`, along with
+their types. They're written after the usual columns, in the order they were
+asked for. Reddit doesn't always send these, so they can be missing"""
+
+_CSV_DTYPES = {
+    ID: str,
+    TIME: np.int64,
+    SR_NAME: str,
+    AUTHOR_ID: str,
+    PARENT_FULLNAME: str,
+    POST_ID: str,
+    UPVOTES: np.int64,
+    DOWNVOTES: np.int64,
+    BODY: str,
+}
+"""Types of the columns in comments.csv (IDs are parsed from base 36 afterwards)"""
+
+
 POST_COLS = ["id", "time", "subreddit", "author", "title", "body", "num_comments"]
 
 
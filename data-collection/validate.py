@@ -3,25 +3,41 @@
 """
 Check if the data we collected is messed up somehow
 
-Can be used as either a script or as a module/library/whatever (call `validate.validate()`)
+Can be used as either a script or as a module/library/whatever (call
+`validate.validate()` on data you've already loaded, or `validate.validate_runs()`
+to go through runs one at a time without loading all of them at once)
 
-TODO make this more thorough. Right now, it just checks that all the files exist,
-there aren't duplicate hit or miss IDs, and the IDs increase with the timestamps
-
-TODO check for NaNs
+Right now, it checks that all the files exist, the runs used the same bins as the
+current config, there aren't duplicate hit or miss IDs, no IDs are both hits and
+misses, there are no unexpected NaNs, and the IDs increase with the timestamps
 """
 
+import numpy as np
 import os
 import pandas as pd
-from typing import Any, Callable, Iterable, Optional
+from typing import Any, Callable, Iterable, NamedTuple, Optional
 
+from b36 import to_b36_array
+from config import CONFIG_FILE_NAME, Config
+from idset import IdSet
 import util
-from util import COMMENTS_FILE_NAME, MISSED_FILE_NAME
+from util import COMMENTS_FILE_NAME, COMMENTS_PARQUET_FILE_NAME, MISSED_FILE_NAME
+
+
+class CheckResult(NamedTuple):
+    """What a check found"""
+
+    name: str
+    """Name of the function that did the check"""
+    ok: bool
+    message: str
+    details: Any = None
+    """Whatever the check function returned (bad rows, bad IDs, etc.)"""
 
 
 _checks = {}
-"""Maps functions that get bad rows or whatever to functions that print errors
-and return a list of issues"""
+"""Maps functions that get bad rows or whatever to functions that turn those into
+`CheckResult`s"""
 
 
 def _check(
@@ -32,31 +48,29 @@ def _check(
     def decorator(f):
         fn_name = f.__name__
 
-        def make_err(res):
-            msg = error_msg if isinstance(error_msg, str) else error_msg(res)
-            print(f"❌ {msg} (call validate.{fn_name} for more info)")
-            return msg
-
-        def check_fn(*args, **kwargs):
+        def check_fn(*args, verbose: bool = True, **kwargs) -> CheckResult:
             res = f(*args, **kwargs)
             if is_error is not None:
-                if is_error(res):
-                    return [make_err(res)]
-            elif isinstance(res, pd.DataFrame):
-                if len(res) > 0:
-                    err = [make_err(res)]
-                    print("Bad rows:")
-                    print(res)
-                    return err
-            elif isinstance(res, list):
-                if len(res) > 0:
-                    err = [make_err(res)]
-                    return err
-            elif res is not None:
+                failed = is_error(res)
+            elif isinstance(res, (pd.DataFrame, list)):
+                failed = len(res) > 0
+            elif res is None:
+                failed = False
+            else:
                 raise ValueError(f"No idea how to handle {res}")
 
-            print("✅", happy_msg)
-            return []
+            if not failed:
+                if verbose:
+                    print("✅", happy_msg)
+                return CheckResult(fn_name, True, happy_msg, res)
+
+            msg = error_msg if isinstance(error_msg, str) else error_msg(res)
+            if verbose:
+                print(f"❌ {msg} (call validate.{fn_name} for more info)")
+                if isinstance(res, pd.DataFrame):
+                    print("Bad rows:")
+                    print(res)
+            return CheckResult(fn_name, False, msg, res)
 
         _checks[f] = check_fn
 
@@ -65,15 +79,42 @@ def _check(
     return decorator
 
 
-def run_check(f: Callable, *args, **kwargs) -> list[str]:
-    return _checks[f](*args, **kwargs)
+def run_check(f: Callable, *args, verbose: bool = True, **kwargs) -> CheckResult:
+    return _checks[f](*args, verbose=verbose, **kwargs)
+
+
+def _some_ids(ids: list[str]) -> str:
+    if len(ids) < 10:
+        return ", ".join(map(str, ids))
+    return ", ".join(map(str, ids[:10])) + ", ..."
 
 
 @_check(happy_msg="No missing runs", error_msg=lambda runs: f"Missing runs: {runs}")
 def missing_runs(run_nums: Iterable[int]):
+    run_nums = set(run_nums)
     return [i for i in range(max(run_nums)) if i not in run_nums]
 
 
+@_check(
+    happy_msg="All runs used the same bins as the current config",
+    error_msg=lambda runs: f"Runs with different bins from the current config: {runs}",
+)
+def incompatible_runs(runs: dict[int, str], config: Config) -> list[int]:
+    """Find runs whose config has different time range boundaries (and therefore
+    different bins) from the given config"""
+    expected = [(tr.start_id, tr.end_id) for tr in config.time_ranges]
+    bad = []
+    for run_num, run_path in sorted(runs.items()):
+        config_path = os.path.join(run_path, CONFIG_FILE_NAME)
+        if not os.path.exists(config_path):
+            # Runs from before we started saving configs
+            continue
+        run_config = Config.load(config_path)
+        if [(tr.start_id, tr.end_id) for tr in run_config.time_ranges] != expected:
+            bad.append(run_num)
+    return bad
+
+
 @_check(
     happy_msg="Found no duplicate comment IDs",
     error_msg="Found comments with duplicate IDs",
@@ -86,15 +127,25 @@ def duplicate_comments(df: pd.DataFrame) -> pd.DataFrame:
 @_check(
     happy_msg="Found no duplicate misses",
     error_msg=lambda dupes: f"Found {len(dupes)} duplicate misses: "
-    + (
-        ", ".join(map(str, dupes))
-        if len(dupes) < 10
-        else ", ".join(map(str, dupes[:10])) + ", ..."
-    ),
+    + _some_ids(dupes),
 )
 def duplicate_misses(misses: pd.Series) -> list[str]:
-    """Find duplicate misses (assumes they're sorted)"""
-    return [util.to_b36(id) for id in misses[misses.duplicated(keep=False)]]
+    """Find duplicate misses"""
+    misses_arr = misses.to_numpy()
+    dupes = IdSet().add_many(misses_arr)
+    return list(to_b36_array(np.unique(misses_arr[dupes])))
+
+
+@_check(
+    happy_msg="Found no IDs that were both hits and misses",
+    error_msg=lambda both: f"Found {len(both)} IDs that were both hits and misses: "
+    + _some_ids(both),
+)
+def hits_and_misses(df: pd.DataFrame, misses: pd.Series) -> list[str]:
+    """Find IDs that show up both in the comments and in the misses"""
+    ids = df[util.ID].to_numpy()
+    both = ids[IdSet(misses.to_numpy()).contains_many(ids)]
+    return list(to_b36_array(np.unique(both)))
 
 
 @_check(
@@ -103,34 +154,123 @@ def duplicate_misses(misses: pd.Series) -> list[str]:
 )
 def find_out_of_order_ids(df: pd.DataFrame) -> Optional[pd.DataFrame]:
     """Find the first two comment where their IDs don't increase with their timestamps"""
-    for i in range(len(df) - 1):
-        curr = df.iloc[i]
-        next = df.iloc[i + 1]
-        if curr.time > next.time:
-            return df.iloc[i : i + 2]
+    if not df[util.ID].is_monotonic_increasing:
+        df = util.sort_comments(df)
+    times = df[util.TIME].to_numpy()
+    bad = np.flatnonzero(times[1:] < times[:-1])
+    if len(bad) > 0:
+        return df.iloc[bad[0] : bad[0] + 2]
     return None
 
-def unexpected_nans(df: pd.DataFrame) -> Optional[pd.DataFrame]:
-    """Find rows with NaNs in unexpected places"""
-    pass
 
-def validate(df: pd.DataFrame, misses: pd.Series):
-    """Print out any problems detected in the data"""
-    _validate_helper(df, misses, [])
-
-
-def _validate_helper(df: pd.DataFrame, misses: pd.Series, issues: list[str]):
-    """
-    This helper just exists so that a list of previously found issues can be passed
-    in when we're running this as a script
+@_check(
+    happy_msg="Found no unexpected NaNs",
+    error_msg="Found rows with unexpected NaNs",
+)
+def unexpected_nans(df: pd.DataFrame) -> pd.DataFrame:
+    """Find rows with NaNs in unexpected places (only the author and extra fields
+    can be missing)"""
+    cols = [
+        col for col in df.columns if col in util.COMMENT_COLS and col != util.AUTHOR_ID
+    ]
+    return df[df[cols].isna().any(axis=1)]
+
+
+def validate(df: pd.DataFrame, misses: pd.Series) -> list[CheckResult]:
+    """Print out any problems detected in the data, and return the results of
+    all the checks"""
+    results = _validate_helper(df, misses, verbose=True)
+    _print_summary(results)
+    return results
+
+
+def _validate_helper(
+    df: pd.DataFrame, misses: pd.Series, verbose: bool
+) -> list[CheckResult]:
+    """Run the checks that need all the comments and misses at once"""
+    return [
+        run_check(duplicate_comments, df, verbose=verbose),
+        run_check(duplicate_misses, misses, verbose=verbose),
+        run_check(hits_and_misses, df, misses, verbose=verbose),
+        run_check(find_out_of_order_ids, df, verbose=verbose),
+        run_check(unexpected_nans, df, verbose=verbose),
+    ]
+
+
+def validate_runs(
+    runs: dict[int, str], config: Optional[Config] = None, verbose: bool = True
+) -> list[CheckResult]:
     """
+    Check all the given runs (mapped from run number, like `util.get_runs()`).
 
-    issues.extend(run_check(duplicate_comments, df))
+    Runs are loaded one at a time. Checks that only need one run's rows (like
+    the NaN check) are done on each run, and only the IDs and timestamps are
+    kept around for the checks that need everything.
 
-    issues.extend(run_check(duplicate_misses, misses))
+    If `config` is given, also make sure the runs used the same bins as it.
+    """
+    results = [run_check(missing_runs, runs.keys(), verbose=verbose)]
+    if config is not None:
+        results.append(run_check(incompatible_runs, runs, config, verbose=verbose))
+
+    ids = []
+    times = []
+    misses = []
+    nan_rows = []
+    for _, run_dir in sorted(runs.items()):
+        if os.path.exists(os.path.join(run_dir, COMMENTS_FILE_NAME)) or os.path.exists(
+            os.path.join(run_dir, COMMENTS_PARQUET_FILE_NAME)
+        ):
+            df = util.load_comments(run_dir)
+            nan_rows.append(unexpected_nans(df))
+            ids.append(df[util.ID].to_numpy())
+            times.append(df[util.TIME].to_numpy())
+            del df
+        else:
+            results.append(_missing_file(run_dir, COMMENTS_FILE_NAME, verbose))
 
-    issues.extend(run_check(find_out_of_order_ids, df))
+        if os.path.exists(os.path.join(run_dir, MISSED_FILE_NAME)):
+            misses.append(util.load_misses(run_dir).to_numpy())
+        else:
+            results.append(_missing_file(run_dir, MISSED_FILE_NAME, verbose))
 
+    if len(ids) > 0:
+        df = util.sort_comments(
+            pd.DataFrame({util.ID: np.concatenate(ids), util.TIME: np.concatenate(times)})
+        )
+    else:
+        df = pd.DataFrame([], columns=[util.ID, util.TIME])
+    all_misses = pd.Series(
+        np.sort(np.concatenate(misses)) if len(misses) > 0 else [], dtype=np.int64
+    )
+
+    results.extend(
+        [
+            run_check(duplicate_comments, df, verbose=verbose),
+            run_check(duplicate_misses, all_misses, verbose=verbose),
+            run_check(hits_and_misses, df, all_misses, verbose=verbose),
+            run_check(find_out_of_order_ids, df, verbose=verbose),
+            # The bad rows were already found one run at a time, so this just
+            # reports them
+            run_check(
+                unexpected_nans,
+                pd.concat(nan_rows) if len(nan_rows) > 0 else pd.DataFrame(),
+                verbose=verbose,
+            ),
+        ]
+    )
+    return results
+
+
+def _missing_file(run_dir: str, file_name: str, verbose: bool) -> CheckResult:
+    msg = f"No {file_name} in {run_dir}"
+    if verbose:
+        print(f"❌ {msg}")
+    return CheckResult("missing_file", False, msg, os.path.join(run_dir, file_name))
+
+
+def _print_summary(results: list[CheckResult]):
+    issues = [result.message for result in results if not result.ok]
     if len(issues) > 0:
         print("Found issues:")
         for issue in issues:
@@ -141,42 +281,10 @@ def _validate_helper(df: pd.DataFrame, misses: pd.Series, issues: list[str]):
 
 if __name__ == "__main__":
     runs = util.get_runs()
-    run_nums = sorted(list(runs.keys()))
 
-    if len(run_nums) == 0:
+    if len(runs) == 0:
         print("No runs")
         exit(1)
 
-    issues = []
-
-    issues.extend(run_check(missing_runs, run_nums))
-
-    comments_files = []
-    misses_files = []
-
-    for run_dir in runs.values():
-        if os.path.exists(os.path.join(run_dir, COMMENTS_FILE_NAME)):
-            comments_files.append(run_dir)
-        else:
-            msg = f"No {COMMENTS_FILE_NAME} in {run_dir}"
-            print(f"❌ {msg}")
-            issues.append(msg)
-
-        if os.path.exists(os.path.join(run_dir, MISSED_FILE_NAME)):
-            misses_files.append(run_dir)
-        else:
-            msg = f"No {MISSED_FILE_NAME} in {run_dir}"
-            print(f"❌ {msg}")
-            issues.append(msg)
-
-    if len(comments_files) > 0:
-        df = util.load_comments(*comments_files)
-    else:
-        df = pd.DataFrame([], columns=util.COMMENT_COLS)
-
-    if len(misses_files) > 0:
-        misses = util.load_misses(*misses_files)
-    else:
-        misses = pd.Series([])
-
-    _validate_helper(df, misses, issues)
+    config_path = os.path.join(os.path.dirname(__file__), CONFIG_FILE_NAME)
+    _print_summary(validate_runs(runs, Config.load(config_path)))
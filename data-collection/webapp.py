@@ -1,11 +1,14 @@
 import argparse
-from io import StringIO
+import json
 import logging
+import numpy as np
 import pandas as pd
 import selectors
 import socket
 import streamlit as st
 
+import feed
+
 logger = logging.Logger("dashboard")
 
 parser = argparse.ArgumentParser(
@@ -24,6 +27,8 @@ sel = selectors.DefaultSelector()
 
 st.set_page_config(page_title="Data collector dashboard", layout="wide")
 
+stats = st.empty()
+
 col1, col2 = st.columns(2)
 
 col1_elems = col1.container()
@@ -33,8 +38,14 @@ misses_graph = col1_elems.empty()
 col2_elems = col2.container()
 hit_rate_graph = col2_elems.empty()
 
+reader = feed.FrameReader()
+
+df = pd.DataFrame(columns=["Date", "Min", "Hits", "Misses"])
+"""Latest counts for each time range, indexed by the server's time range index"""
+
+
 def read(conn: socket.socket):
-    data = conn.recv(1024)
+    data = conn.recv(1 << 16)
     if not data:
         logger.error(f"Closing {conn} (reason: got empty message)")
         sel.unregister(conn)
@@ -42,12 +53,46 @@ def read(conn: socket.socket):
         logger.info("Done")
         exit()
 
-    logger.debug(f"Got {data!r}")
-    draw_graph(data.decode())
+    # The server already makes sure it doesn't send too many updates, but if we
+    # fell behind and got a bunch at once, only draw once
+    updated = False
+    for msg_type, payload in reader.feed(data):
+        if msg_type == feed.LAYOUT:
+            set_layout(json.loads(payload))
+        elif msg_type == feed.UPDATE:
+            apply_update(payload)
+            updated = True
+        else:
+            logger.warning(f"Unknown message type {msg_type}")
+    if updated:
+        draw_graph()
+
+
+def set_layout(start_dates: list[str]):
+    global df
+    df = pd.DataFrame(
+        {
+            "Date": start_dates,
+            "Min": np.zeros(len(start_dates), dtype=np.int64),
+            "Hits": np.zeros(len(start_dates), dtype=np.int64),
+            "Misses": np.zeros(len(start_dates), dtype=np.int64),
+        }
+    )
+
+
+def apply_update(payload: bytes):
+    records, ids_per_sec, latency, num_batches = feed.decode_update(payload)
+    inds = records["index"].astype(np.int64)
+    df.loc[inds, "Min"] = records["min"].astype(np.int64)
+    df.loc[inds, "Hits"] = records["hits"].astype(np.int64)
+    df.loc[inds, "Misses"] = records["misses"].astype(np.int64)
+    stats.markdown(
+        f"**{ids_per_sec:.1f}** IDs/sec, **{latency * 1000:.0f}** ms per request,"
+        f" **{num_batches}** batches so far"
+    )
 
 
-def draw_graph(csv: str):
-    df = pd.read_csv(StringIO(csv))
+def draw_graph():
     df["Hit rate"] = df["Hits"] / (df["Hits"] + df["Misses"])
     hits_graph.bar_chart(df, x="Date", y="Hits")
     misses_graph.bar_chart(df, x="Date", y="Misses")
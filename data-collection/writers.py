@@ -0,0 +1,392 @@
+"""
+Different ways to write out the comments we collect.
+
+The runner hands each batch of rows to every writer it has. A row is a list with
+one field per column in `util.COMMENT_COLS`, followed by any extra fields that
+were asked for (see `util.EXTRA_FIELDS`). The ID is in base 36, the time is a
+Unix timestamp, and the body is exactly what Reddit gave us.
+"""
+
+from abc import ABC, abstractmethod
+import csv
+from glob import glob
+import json
+import logging
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shutil
+import time
+from typing import Optional
+
+from b36 import from_b36_array
+from idset import IdSet
+import util
+from util import (
+    AUTHOR_ID,
+    BODY,
+    COMMENT_COLS,
+    DOWNVOTES,
+    EXTRA_FIELDS,
+    ID,
+    PARENT_FULLNAME,
+    POST_ID,
+    SR_NAME,
+    TIME,
+    UPVOTES,
+)
+
+OUTPUT_FORMATS = ["csv", "parquet", "both"]
+
+PARQUET_SCHEMA = pa.schema(
+    [
+        (ID, pa.int64()),
+        (TIME, pa.timestamp("s", tz="UTC")),
+        (SR_NAME, pa.dictionary(pa.int32(), pa.string())),
+        (AUTHOR_ID, pa.string()),
+        (PARENT_FULLNAME, pa.string()),
+        (POST_ID, pa.string()),
+        (UPVOTES, pa.int64()),
+        (DOWNVOTES, pa.int64()),
+        (BODY, pa.string()),
+    ]
+)
+
+_EXTRA_FIELD_TYPES = {int: pa.int64(), bool: pa.bool_(), str: pa.string()}
+
+PARQUET_ROW_GROUP_SIZE = 50000
+"""How many rows to buffer before writing them out as a row group"""
+
+JOURNAL_FILE_NAME = "journal.jsonl"
+SHARD_DIR_PREFIX = "shard_"
+
+COMMIT_IDS = 5000
+"""Commit once this many comments and misses are buffered"""
+COMMIT_SECONDS = 5.0
+"""Commit once it's been this long since the last commit"""
+
+
+class CommentWriter(ABC):
+    """Somewhere to put the comments we collect"""
+
+    @abstractmethod
+    def write_rows(self, rows: list[list]):
+        """Write a batch of rows (see the module docs for what a row looks like)"""
+
+    def flush(self):
+        """Called every time a group of batches is committed. Only needs to do
+        something if the writer should get data to disk that often"""
+
+    def committed_size(self) -> Optional[int]:
+        """How big the file is after the last `flush` (None if the file can't be
+        recovered after a crash anyway)"""
+        return None
+
+    @abstractmethod
+    def close(self):
+        """Write out anything still buffered and close the file"""
+
+
+class CsvCommentWriter(CommentWriter):
+    """Writes `comments.csv`, flushing and syncing it every commit"""
+
+    def __init__(self, path: str, extra_fields: list[str] = []):
+        self._file = open(path, "w")
+        self._csv = csv.writer(self._file)
+        self._csv.writerow(COMMENT_COLS + extra_fields)
+
+    def write_rows(self, rows: list[list]):
+        body_ind = COMMENT_COLS.index(BODY)
+        for row in rows:
+            row = list(row)
+            row[body_ind] = util.multiline_to_csv(row[body_ind])
+            self._csv.writerow(row)
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def committed_size(self) -> Optional[int]:
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetCommentWriter(CommentWriter):
+    """
+    Writes `comments.parquet`, with typed columns (integer IDs, a timestamp, and
+    dictionary-encoded subreddit names).
+
+    Rows are buffered and written in row groups of `row_group_size`. Note that
+    the file isn't readable until it's been closed, so if the collector crashes,
+    whatever was in it is lost. Write CSV alongside it if that matters.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        extra_fields: list[str] = [],
+        row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+    ):
+        self.schema = PARQUET_SCHEMA
+        for field in extra_fields:
+            self.schema = self.schema.append(
+                pa.field(field, _EXTRA_FIELD_TYPES[EXTRA_FIELDS[field]])
+            )
+        self._writer = pq.ParquetWriter(path, self.schema)
+        self.row_group_size = row_group_size
+        self._buffer: list[list] = []
+
+    def write_rows(self, rows: list[list]):
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.row_group_size:
+            self._write_row_group()
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+    def _write_row_group(self):
+        if len(self._buffer) == 0:
+            return
+        columns = dict(zip(self.schema.names, map(list, zip(*self._buffer))))
+        columns[ID] = from_b36_array(columns[ID])
+        arrays = []
+        for field in self.schema:
+            if pa.types.is_dictionary(field.type):
+                array = pa.array(columns[field.name], type=field.type.value_type)
+                arrays.append(array.dictionary_encode())
+            else:
+                arrays.append(pa.array(columns[field.name], type=field.type))
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self._buffer = []
+
+
+def make_writers(
+    output_format: str, run_dir: str, extra_fields: list[str] = []
+) -> list[CommentWriter]:
+    """Make the writers for the given output format (one of `OUTPUT_FORMATS`)"""
+    assert output_format in OUTPUT_FORMATS, f"Unknown output format {output_format}"
+    writers: list[CommentWriter] = []
+    if output_format in ("csv", "both"):
+        writers.append(
+            CsvCommentWriter(
+                os.path.join(run_dir, util.COMMENTS_FILE_NAME), extra_fields
+            )
+        )
+    if output_format in ("parquet", "both"):
+        writers.append(
+            ParquetCommentWriter(
+                os.path.join(run_dir, util.COMMENTS_PARQUET_FILE_NAME), extra_fields
+            )
+        )
+    return writers
+
+
+class GroupCommitter:
+    """
+    Buffers comments and misses in memory and writes them all out together once
+    enough of them pile up (or enough time passes), instead of after every batch.
+
+    After each group is written and flushed, a line recording how big each file
+    is gets appended to the run's journal. If the collector crashes partway
+    through writing a group, `recover_run` cuts the files back to the last
+    committed sizes, so the comments and misses on disk always line up and at
+    most one group is lost.
+    """
+
+    def __init__(
+        self,
+        comment_writers: list[CommentWriter],
+        run_dir: str,
+        commit_ids: int = COMMIT_IDS,
+        commit_seconds: float = COMMIT_SECONDS,
+    ):
+        self.comment_writers = comment_writers
+        self.commit_ids = commit_ids
+        self.commit_seconds = commit_seconds
+        self._missed_file = open(os.path.join(run_dir, util.MISSED_FILE_NAME), "w")
+        """Store IDs of comments that Reddit didn't return any info for"""
+        self._journal = open(os.path.join(run_dir, JOURNAL_FILE_NAME), "a")
+        self._rows: list[list] = []
+        self._misses: list[str] = []
+        self._num_batches = 0
+        self._last_commit = time.monotonic()
+
+    def add(self, rows: list[list], misses: list[str]):
+        """Add a batch's rows and missed IDs (in base 36), committing if it's time"""
+        self._rows.extend(rows)
+        self._misses.extend(misses)
+        self._num_batches += 1
+        if (
+            len(self._rows) + len(self._misses) >= self.commit_ids
+            or time.monotonic() - self._last_commit >= self.commit_seconds
+        ):
+            self.commit()
+
+    def commit(self):
+        """Write out everything that's buffered"""
+        self._last_commit = time.monotonic()
+        if self._num_batches == 0:
+            return
+        for writer in self.comment_writers:
+            writer.write_rows(self._rows)
+            writer.flush()
+        self._missed_file.write("".join(f"{id}\n" for id in self._misses))
+        self._missed_file.flush()
+        os.fsync(self._missed_file.fileno())
+
+        sizes = {util.MISSED_FILE_NAME: self._missed_file.tell()}
+        for writer in self.comment_writers:
+            size = writer.committed_size()
+            if size is not None:
+                sizes[util.COMMENTS_FILE_NAME] = size
+        self._journal.write(
+            json.dumps({"batches": self._num_batches, "sizes": sizes}) + "\n"
+        )
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+        self._rows = []
+        self._misses = []
+        self._num_batches = 0
+
+    def close(self):
+        self.commit()
+        for writer in self.comment_writers:
+            writer.close()
+        self._missed_file.close()
+        self._journal.close()
+
+
+def recover_run(run_dir: str):
+    """
+    Cut a run's comments.csv and missed-ids.txt back to how big they were at the
+    last commit in its journal, getting rid of anything from a group that was
+    only partly written. Does nothing to them if the run doesn't have a journal.
+
+    A comments.parquet that wasn't closed (see `ParquetCommentWriter`) is
+    deleted, since it can't be read.
+    """
+    journal_path = os.path.join(run_dir, JOURNAL_FILE_NAME)
+    if os.path.exists(journal_path):
+        _truncate_to_journal(run_dir, journal_path)
+
+    parquet_path = os.path.join(run_dir, util.COMMENTS_PARQUET_FILE_NAME)
+    if os.path.exists(parquet_path) and not util.is_readable_parquet(parquet_path):
+        # It never got its footer, so nothing in it can be read. If the run was
+        # writing CSV too, the same comments are in there
+        logging.warning(f"Removing {parquet_path}, which wasn't closed properly")
+        os.remove(parquet_path)
+
+
+def _truncate_to_journal(run_dir: str, journal_path: str):
+    last_commit = None
+    with open(journal_path) as f:
+        for line in f:
+            try:
+                last_commit = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line might've been cut off
+                break
+    sizes = {} if last_commit is None else last_commit["sizes"]
+    for file_name in (util.COMMENTS_FILE_NAME, util.MISSED_FILE_NAME):
+        path = os.path.join(run_dir, file_name)
+        if not os.path.exists(path):
+            continue
+        # With no commits, only comments.csv's header should be there
+        size = sizes.get(file_name)
+        if size is None:
+            if file_name != util.COMMENTS_FILE_NAME:
+                size = 0
+            else:
+                with open(path) as f:
+                    f.readline()
+                    size = f.tell()
+        if os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+
+def merge_shards(run_dir: str):
+    """
+    Combine the outputs of all the shards in a run (see `coordinator.py`) into
+    the run directory itself, so it looks like any other run, then delete the
+    shards' directories. Does nothing if the run doesn't have any shards.
+
+    The checkpoint and ID sets are only merged if every shard has them. Otherwise
+    they're left out, and they'll get rebuilt from the merged CSVs.
+    """
+    # Not picking up the shards' logs, which get moved to shard_$i.log
+    shard_dirs = sorted(
+        filter(os.path.isdir, glob(os.path.join(run_dir, SHARD_DIR_PREFIX + "*"))),
+        key=lambda path: int(path.rsplit("_", maxsplit=1)[1]),
+    )
+    if len(shard_dirs) == 0:
+        return
+    for shard_dir in shard_dirs:
+        recover_run(shard_dir)
+
+    def shard_paths(file_name: str) -> list[str]:
+        paths = [os.path.join(shard_dir, file_name) for shard_dir in shard_dirs]
+        return [path for path in paths if os.path.exists(path)]
+
+    csv_paths = shard_paths(util.COMMENTS_FILE_NAME)
+    if len(csv_paths) > 0:
+        with open(os.path.join(run_dir, util.COMMENTS_FILE_NAME), "wb") as out:
+            for i, path in enumerate(csv_paths):
+                with open(path, "rb") as f:
+                    header = f.readline()
+                    if i == 0:
+                        out.write(header)
+                    shutil.copyfileobj(f, out)
+
+    # recover_run deleted the ones from shards that crashed. If those shards
+    # wrote CSV too, leave the Parquet file out, so the (complete) merged CSV
+    # gets used instead of a Parquet file that's missing comments
+    parquet_paths = shard_paths(util.COMMENTS_PARQUET_FILE_NAME)
+    tables = [pq.read_table(path) for path in parquet_paths]
+    if len(tables) > 0 and (len(tables) == len(shard_dirs) or len(csv_paths) == 0):
+        pq.write_table(
+            pa.concat_tables(tables),
+            os.path.join(run_dir, util.COMMENTS_PARQUET_FILE_NAME),
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+        )
+
+    with open(os.path.join(run_dir, util.MISSED_FILE_NAME), "wb") as out:
+        for path in shard_paths(util.MISSED_FILE_NAME):
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, out)
+
+    checkpoints = [util.load_checkpoint(shard_dir) for shard_dir in shard_dirs]
+    if all(checkpoint is not None for checkpoint in checkpoints):
+        # Every shard has the same bins, it just counted different IDs in them
+        first = checkpoints[0]
+        assert first is not None
+        hits, misses, skipped = (
+            sum(checkpoint[key] for checkpoint in checkpoints)  # type: ignore
+            for key in ("hits", "misses", "skipped")
+        )
+        util.save_checkpoint(
+            run_dir, first["starts"], first["ends"], hits, misses, skipped
+        )
+
+    known = [util.load_known_ids(shard_dir) for shard_dir in shard_dirs]
+    if all(shard_known is not None for shard_known in known):
+        hits, misses, skipped, failed = IdSet(), IdSet(), IdSet(), IdSet()
+        for shard_dir, shard_known in zip(shard_dirs, known):
+            assert shard_known is not None
+            hits.update(shard_known[0])
+            misses.update(shard_known[1])
+            skipped.update(util.load_skipped_ids(shard_dir))
+            failed.update(util.load_failed_ids(shard_dir))
+        util.save_known_ids(run_dir, hits, misses)
+        util.save_skipped_ids(run_dir, skipped)
+        util.save_failed_ids(run_dir, failed)
+
+    for shard_dir in shard_dirs:
+        log_path = os.path.join(shard_dir, util.LOG_FILE_NAME)
+        if os.path.exists(log_path):
+            shutil.move(log_path, shard_dir + ".log")
+        shutil.rmtree(shard_dir)
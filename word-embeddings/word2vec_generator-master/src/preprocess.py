@@ -4,48 +4,121 @@
 @author: A.Akdogan with modifications from Terra Oh
 """
 
+import functools
+import json
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
 import re
 from nltk.corpus import stopwords
 
 
-def clean_process(df, target_column):
-    
-    def clean_data(text):
-        
-        text = re.sub(r'[^ \nA-Za-z0-9À-ÖØ-öø-ÿ/]+', '', text)
-        text = re.sub(r'[\\/×\^\]\[÷]', '', text)
-        
-        return text
-
-    def change_lower(text):
-        
-        return text.lower()
-    
-    def remover(text):
-        
-        text_tokens = text.split(" ")
-        final_list = [word for word in text_tokens if not word in stopwords_list]
-        text = ' '.join(final_list)
-        
-        return text
-    
-    def get_w2vdf(df):
-        
-        w2v_df = pd.DataFrame(df[target_column]).values.tolist()
-        for i in range(len(w2v_df)):
-            w2v_df[i] = w2v_df[i][0].split(" ")
-            
-        return w2v_df
-    
-    stopwords_list = stopwords.words("english")
-    df[[target_column]] = df[[target_column]].astype(str)
-    df[target_column] = df[target_column].apply(change_lower)
-    df[target_column] = df[target_column].apply(clean_data)
-    df[target_column] = df[target_column].apply(remover)
-    w2v_df = get_w2vdf(df)
-    
-    return w2v_df
-            
-    
+CLEAN_RE = re.compile(r'[^ \nA-Za-z0-9À-ÖØ-öø-ÿ]+')
+"""Everything that isn't a letter, digit, space or newline. This is what the
+two regexes we used to run one after the other add up to (the second only took
+out `/`, since everything else it took out was already gone)"""
+
+ESCAPED_NEWLINE_RE = re.compile(r'\\(\\?)n')
+"""Same as in data-collection's util.py"""
+
+CHUNK_SIZE = 50000
+
+
+def csv_to_multiline(text):
+    """
+    Undo the collector's `multiline_to_csv`, which escapes newlines in CSV bodies.
+    Same as `csv_to_multiline` in data-collection's util.py
+    """
+    return ESCAPED_NEWLINE_RE.sub(lambda m: r'\n' if m.group(1) else '\n', text)
+
+
+def _clean_chunk(texts, stop_words):
+    texts = texts.map(csv_to_multiline)
+    texts = texts.str.lower().str.replace(CLEAN_RE, '', regex=True)
+    return texts.map(
+        lambda text: ' '.join(word for word in text.split() if word not in stop_words)
+    )
+
+
+class CleanedCorpus:
+    """
+    Cleaned comments, kept as strings and only split into token lists while
+    iterating, which takes a lot less memory than a list of lists. Can be
+    iterated over more than once, which gensim needs.
+    """
+
+    def __init__(self, texts):
+        self.texts = texts
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __iter__(self):
+        for text in self.texts:
+            yield text.split()
+
+
+def clean_process(df, target_column, workers=1):
+    """
+    Turn newlines the collector escaped back into newlines, lowercase, take out
+    everything but letters and digits, split on whitespace and drop stopwords,
+    all in one pass. With `workers` > 1, chunks of comments
+    get cleaned in that many processes.
+    """
+    stop_words = frozenset(stopwords.words("english"))
+    texts = df[target_column].fillna('').astype(str)
+    chunks = [texts.iloc[i : i + CHUNK_SIZE] for i in range(0, len(texts), CHUNK_SIZE)]
+    clean = functools.partial(_clean_chunk, stop_words=stop_words)
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            cleaned = pool.map(clean, chunks)
+    else:
+        cleaned = [clean(chunk) for chunk in chunks]
+    texts = pd.concat(cleaned) if cleaned else texts
+
+    return CleanedCorpus(texts)
+
+
+class TokenizedCorpus:
+    """
+    Tokens cached by data-analysis/corpus_cache.py (use `--preset w2v` so they're
+    cleaned the same way as `clean_process`). Loaded memory-mapped, and token
+    lists are only made while iterating, so it can be bigger than memory.
+    Can be iterated over more than once, which gensim needs.
+    """
+
+    CACHE_VERSION = 3
+    """Has to match `CACHE_VERSION` in corpus_cache.py"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != self.CACHE_VERSION:
+            raise ValueError(
+                f"{path} is from corpus_cache.py version {meta.get('version')}, "
+                f"expected {self.CACHE_VERSION}. Run corpus_cache.py again"
+            )
+        if meta.get("preset") != "w2v":
+            raise ValueError(
+                f"{path} was made with --preset {meta.get('preset')}, not w2v"
+            )
+        with open(os.path.join(path, "vocab.json")) as f:
+            self.vocab = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        tokens_path = os.path.join(path, "tokens.bin")
+        if os.path.getsize(tokens_path) > 0:
+            self.tokens = np.memmap(tokens_path, dtype=np.int32, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        vocab = self.vocab
+        offsets = self.offsets
+        for i in range(len(self)):
+            tokens = self.tokens[offsets[i] : offsets[i + 1]].tolist()
+            yield [vocab[token] for token in tokens]
 
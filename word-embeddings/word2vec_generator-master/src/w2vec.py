@@ -4,7 +4,7 @@
 @author: A.Akdogan with modifications from Terra Oh
 """
 
-from preprocess import clean_process
+from preprocess import TokenizedCorpus, clean_process
 from training import train_w2v
 import pandas as pd
 import argparse
@@ -12,17 +12,22 @@ import argparse
 
 class W2vec:
     
-    def __init__(self, csv_path, target_column, sep):
+    def __init__(self, csv_path, target_column, sep, tokens_path=None, workers=1):
         
         self.csv_path = csv_path
         self.target_column = target_column
         self.sep = sep
+        self.tokens_path = tokens_path
+        self.workers = workers
         
     def main(self):
         
         print("Start...")
-        df = pd.read_csv(self.csv_path, sep = self.sep)
-        w2v_df = clean_process(df, self.target_column)
+        if self.tokens_path is not None:
+            w2v_df = TokenizedCorpus(self.tokens_path)
+        else:
+            df = pd.read_csv(self.csv_path, sep = self.sep)
+            w2v_df = clean_process(df, self.target_column, self.workers)
         print("1/3 - The training process begins. ")
         w2v_model = train_w2v(w2v_df)
         print("2/3 - Training completed.")
@@ -38,12 +43,16 @@ class W2vec:
 if __name__ == "__main__":
     
     ap = argparse.ArgumentParser()
-    ap.add_argument("-c", "--csv_path", required=True)
-    ap.add_argument("-t", "--target_column", required=True)
+    ap.add_argument("-c", "--csv_path")
+    ap.add_argument("-t", "--target_column")
     ap.add_argument("-s", "--sep", required=False, default=",")
+    ap.add_argument("--tokens", required=False, help="corpus_cache.py directory to use instead of the csv")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1, help="Processes to clean the csv with")
     args = vars(ap.parse_args())
+    if args["tokens"] is None and (args["csv_path"] is None or args["target_column"] is None):
+        ap.error("-c and -t are required without --tokens")
     
-    W2vec(args["csv_path"], args["target_column"], args["sep"]).main()
+    W2vec(args["csv_path"], args["target_column"], args["sep"], args["tokens"], args["workers"]).main()
     
     
  